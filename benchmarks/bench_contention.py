@@ -0,0 +1,107 @@
+"""Readers plus one writer on the same database file, with SQLite's default settings and with the tuning profile in
+cm3d.connection. Reader processes fetch pages of one biological replica's measurements (as /query/data does) while a
+writer process adds studies (as add-study / uploads do). Reports reader latency, writer throughput and "database is
+locked" errors.
+
+    python benchmarks/bench_contention.py --measurements 300000 --readers 3 --seconds 20
+"""
+import multiprocessing
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from bench_ingest import make_workbook
+from cm3d.connection import tune
+from cm3d.database import get_filtered_page
+from cm3d.ingest import insert_study, parse_workbook
+from cm3d.synthetic import populate
+
+# a short, indexed read, so that time spent waiting on locks rather than scanning dominates
+FILTER = "biological_replica.id = {replica} and measurement.value < 8000"
+
+
+def make_engine(path, profile, read_only=False):
+    uri = f'sqlite:///file:{path}?uri=true' + ('&mode=ro' if read_only else '')
+    engine = create_engine(uri, future=True)
+    return tune(engine, read_only) if profile == 'tuned' else engine
+
+
+def reader(path, profile, deadline, results):
+    Session = sessionmaker(bind=make_engine(path, profile, read_only=True))
+    rng = random.Random()
+    latencies, errors = list(), 0
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            with Session() as session:
+                get_filtered_page(session, FILTER.format(replica=rng.randint(1, 1000)), limit=50)
+            latencies.append(time.perf_counter() - start)
+        except OperationalError:
+            errors += 1
+    results.put(('reader', latencies, errors))
+
+
+def writer(path, profile, deadline, results, rows):
+    Session = sessionmaker(bind=make_engine(path, profile))
+    records = parse_workbook(make_workbook(rows))
+    latencies, errors = list(), 0
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            with Session() as session:
+                insert_study(session, records, b'workbook', 'benchmark')
+                session.commit()
+            latencies.append(time.perf_counter() - start)
+        except OperationalError:
+            errors += 1
+    results.put(('writer', latencies, errors))
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else float('nan')
+
+
+@click.command()
+@click.option('--measurements', default=300_000, show_default=True)
+@click.option('--readers', default=3, show_default=True)
+@click.option('--seconds', default=20, show_default=True)
+@click.option('--rows', default=5000, show_default=True, help='rows per Test- worksheet of each study written')
+def main(measurements, readers, seconds, rows):
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in ['default', 'tuned']:
+            path = Path(directory) / f'{profile}.db'
+            engine = create_engine(f'sqlite:///{path}', future=True)
+            populate(engine, measurements=measurements)
+            with engine.connect() as connection:
+                connection.execute(text(f"PRAGMA journal_mode = {'wal' if profile == 'tuned' else 'delete'}"))
+            engine.dispose()
+
+            results = multiprocessing.Queue()
+            deadline = time.time() + seconds
+            processes = [multiprocessing.Process(target=reader, args=(path, profile, deadline, results))
+                         for _ in range(readers)]
+            processes.append(multiprocessing.Process(target=writer, args=(path, profile, deadline, results, rows)))
+            for process in processes:
+                process.start()
+            collected = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+
+            read = [latency for role, latencies, _ in collected if role == 'reader' for latency in latencies]
+            written = [latency for role, latencies, _ in collected if role == 'writer' for latency in latencies]
+            read_errors = sum(errors for role, _, errors in collected if role == 'reader')
+            write_errors = sum(errors for role, _, errors in collected if role == 'writer')
+            click.echo(f'{profile:<8} reads {len(read) / seconds:7.1f}/s  p50 {percentile(read, 50) * 1000:7.1f}ms  '
+                       f'p95 {percentile(read, 95) * 1000:7.1f}ms  max {max(read, default=0) * 1000:7.1f}ms  '
+                       f'errors {read_errors}   writes {len(written)} studies  errors {write_errors}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Times the saved filters in filters.json before and after `cm3d-cli migrate` adds the secondary indexes
+
+    python benchmarks/bench_filters.py --measurements 1000000
+"""
+import importlib.resources
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from cm3d import FILTERS_FILENAME, resources
+from cm3d.database import get_filtered
+from cm3d.migration import migrate
+from cm3d.model import Base
+from cm3d.synthetic import populate
+
+
+def time_filters(Session, filters, repeat):
+    timings = dict()
+    for name, sql_where in filters.items():
+        best = None
+        for _ in range(repeat):
+            with Session() as session:
+                start = time.perf_counter()
+                records = get_filtered(session, sql_where)
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = (best, len(records))
+    return timings
+
+
+@click.command()
+@click.option('--measurements', default=200_000, show_default=True)
+@click.option('--repeat', default=3, show_default=True)
+def main(measurements, repeat):
+    filters = json.loads(importlib.resources.read_text(resources, FILTERS_FILENAME))
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f'sqlite:///{Path(directory) / "bench.db"}', future=True)
+        populate(engine, studies=20, measurements=measurements)
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    connection.execute(text(f'DROP INDEX {index.name}'))
+        Session = sessionmaker(bind=engine)
+        before = time_filters(Session, filters, repeat)
+        migrate(engine)
+        after = time_filters(Session, filters, repeat)
+        engine.dispose()
+
+    click.echo(f'{"filter":<24} {"rows":>8} {"no indexes":>11} {"indexes":>9}')
+    for name in filters:
+        click.echo(f'{name:<24} {after[name][1]:>8} {before[name][0]:>10.3f}s {after[name][0]:>8.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Compares the columnar ingest in cm3d.ingest (parse_workbook + insert_study) with the original iterrows/ORM ingest,
+on the same in-memory worksheets so Excel parsing is left out
+
+    python benchmarks/bench_ingest.py --rows 20000
+"""
+import random
+import time
+
+import click
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cm3d.ingest import insert_study, parse_workbook
+from cm3d.model import Base, Biological_replica, Group, Measurement, Study
+
+
+def make_workbook(rows_per_sheet, sheets=3, groups=10, replicas=50, extras=2, seed=0):
+    rng = random.Random(seed)
+    workbook = {
+        'Study': pd.DataFrame({'Study title': ['Synthetic study'], 'Author': ['A Author']}),
+        'Groups': pd.DataFrame({'Group': range(1, groups + 1), 'Model': 'model', 'Study duration': '4 weeks',
+                                'Protein treatment': 'abc', 'Additional suplementation': 'def'}),
+        'Biological replicas': pd.DataFrame({
+            'Biological replica': range(1, replicas + 1), 'Cell name': 'MDDA/MB/231', 'Cell line origin': 'abc',
+            'Receptor expression': 'abc', 'Media composition': 'abc', 'Passage number': 3, 'Morphology': 'abc',
+            'Patient characteristics': 'abc', 'Group': [rng.randint(1, groups) for _ in range(replicas)]}),
+    }
+    for sheet in range(sheets):
+        test = pd.DataFrame({
+            'Biological replica': [rng.randint(1, replicas) for _ in range(rows_per_sheet)],
+            'Timepoint': [rng.randint(1, 48) for _ in range(rows_per_sheet)],
+            'Method': 'method', 'Measurement': [rng.choice(['abc', 'def', 'ghi']) for _ in range(rows_per_sheet)],
+            'Value': [rng.random() * 10000 for _ in range(rows_per_sheet)], 'Units': 'mm',
+            'Morphological information': None, 'Analysis workflow': 'workflow', 'Notes': None})
+        for extra in range(extras):
+            test[f'extra{extra}'] = [rng.choice([1, 2, 3, None]) for _ in range(rows_per_sheet)]
+        workbook[f'Test-assay {sheet}'] = test
+    return workbook
+
+
+def iterrows_load_all(workbook):
+    """The original ingest: a Python loop over the rows of every sheet, building ORM objects one at a time"""
+    study = Study(title=workbook['Study']['Study title'][0], authors=workbook['Study']['Author'][0])
+    groups = dict()
+    for _, row in workbook['Groups'].iterrows():
+        if pd.isna(row['Group']):
+            break
+        groups[int(row['Group'])] = Group(model=row['Model'], duration=row['Study duration'],
+                                          protein_treatment=row['Protein treatment'],
+                                          additional_suplementation=row['Additional suplementation'], study=study)
+    replicas = dict()
+    for _, row in workbook['Biological replicas'].iterrows():
+        if pd.isna(row['Biological replica']):
+            break
+        replicas[int(row['Biological replica'])] = Biological_replica(
+            cell_name=row['Cell name'], cell_origin=row['Cell line origin'],
+            receptor_expression=row['Receptor expression'], media_composition=row['Media composition'],
+            passage_number=row['Passage number'], morphology=row['Morphology'],
+            patient_characteristics=row['Patient characteristics'], group=groups[int(row['Group'])])
+    for name, sheet in workbook.items():
+        if name.startswith('Test-'):
+            for _, row in sheet.iterrows():
+                if pd.isna(row['Biological replica']):
+                    break
+                measurement = Measurement(
+                    method=row['Method'], time_point=row['Timepoint'], value=row['Value'], unit=row['Units'],
+                    measurement=row['Measurement'], morphological_information=row['Morphological information'],
+                    analysis_workflow=row['Analysis workflow'], notes=row['Notes'], test_type=name[5:],
+                    biological_replica=replicas[int(row['Biological replica'])])
+                for column in sheet.columns:
+                    if column not in {'Biological replica', 'Timepoint', 'Method', 'Measurement', 'Value', 'Units',
+                                      'Morphological information', 'Analysis workflow', 'Notes'}:
+                        if row[column] is not None and not pd.isna(row[column]):
+                            measurement[column] = row[column]
+    study.uploaded_file = b'workbook'
+    return study
+
+
+def orm_ingest(session, workbook):
+    session.add(iterrows_load_all(workbook))
+    session.commit()
+
+
+def columnar_ingest(session, workbook):
+    insert_study(session, parse_workbook(workbook), b'workbook', 'benchmark')
+    session.commit()
+
+
+@click.command()
+@click.option('--rows', default=20_000, show_default=True, help='rows in each of the 3 Test- worksheets')
+def main(rows):
+    workbook = make_workbook(rows)
+    for label, function in [('columnar + core insert', columnar_ingest), ('iterrows + orm', orm_ingest)]:
+        engine = create_engine('sqlite://', future=True)
+        Base.metadata.create_all(engine)
+        with sessionmaker(bind=engine)() as session:
+            start = time.perf_counter()
+            function(session, workbook)
+            click.echo(f'{label:<24} {time.perf_counter() - start:8.2f}s  ({3 * rows} measurements)')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compares the column-projected query path in cm3d.database with the original ORM entity path
+
+    python benchmarks/bench_query.py --measurements 1000000
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import pandas as pd
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import sessionmaker
+
+from cm3d.database import get_denormalised, get_filtered
+from cm3d.model import Biological_replica, Group, Measurement, Study
+from cm3d.synthetic import populate
+
+FILTER = "measurement.measurement = 'abc' and measurement.value < 4000"
+
+
+def orm_select_statement():
+    return select(Study, Group, Biological_replica, Measurement)\
+        .join(Study.groups, isouter=True)\
+        .join(Group.biological_replicas, isouter=True)\
+        .join(Biological_replica.measurements, isouter=True)
+
+
+def orm_rows_to_dicts(records, flatten=False):
+    for row in records:
+        row_dict = dict()
+        for scalar in row:
+            if scalar is not None:
+                original = {f'{scalar.__tablename__}.{c.name}': getattr(scalar, c.name) for c in scalar.__table__.columns}
+                if isinstance(scalar, Measurement):
+                    original['measurement.data'] = scalar.data
+                original.pop('study.uploaded_file', None)
+                if flatten:
+                    if 'measurement.data' in original:
+                        for k, v in original['measurement.data'].items():
+                            original[f'measurement.data_{k}'] = v
+                        del original['measurement.data']
+                row_dict = row_dict | original
+        yield row_dict
+
+
+def orm_denormalised(session):
+    return pd.DataFrame.from_records(orm_rows_to_dicts(session.execute(orm_select_statement()), flatten=True))
+
+
+def orm_filtered(session, sql_where):
+    return pd.DataFrame.from_records(orm_rows_to_dicts(session.execute(orm_select_statement().filter(text(sql_where)))))
+
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    records = function(*args)
+    click.echo(f'{label:<28} {time.perf_counter() - start:8.2f}s  {len(records):>9} rows')
+
+
+@click.command()
+@click.option('--measurements', default=200_000, show_default=True)
+@click.option('--extras', default=1, show_default=True)
+@click.option('--orm/--no-orm', default=True, help='Also time the original ORM entity path (slow)')
+def main(measurements, extras, orm):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f'sqlite:///{Path(directory) / "bench.db"}', future=True)
+        populate(engine, measurements=measurements, extras=extras)
+        Session = sessionmaker(bind=engine)
+        for label, function, args in [
+            ('columns: filtered', get_filtered, (FILTER,)),
+            ('orm: filtered', orm_filtered, (FILTER,)),
+            ('columns: denormalised', get_denormalised, ()),
+            ('orm: denormalised', orm_denormalised, ()),
+        ]:
+            if label.startswith('orm') and not orm:
+                continue
+            with Session() as session:
+                timed(label, function, session, *args)
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
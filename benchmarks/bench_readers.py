@@ -0,0 +1,38 @@
+"""Times each Excel reader backend in cm3d.ingest on the same large study spreadsheet, with the peak memory allocated
+while parsing
+
+    python benchmarks/bench_readers.py --rows 50000
+"""
+import io
+import time
+import tracemalloc
+
+import click
+import pandas as pd
+
+from bench_ingest import make_workbook
+from cm3d.ingest import READERS, parse_workbook, read_workbook
+
+
+@click.command()
+@click.option('--rows', default=50_000, show_default=True, help='rows in each of the 3 Test- worksheets')
+def main(rows):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer) as writer:
+        for name, sheet in make_workbook(rows).items():
+            sheet.to_excel(writer, sheet_name=name, index=False)
+    content = buffer.getvalue()
+    click.echo(f'{len(content) / 2 ** 20:.1f} MiB workbook, {3 * rows} measurements')
+    for reader in READERS:
+        tracemalloc.start()
+        start = time.perf_counter()
+        records = parse_workbook(read_workbook(io.BytesIO(content), reader))
+        seconds = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        click.echo(f'{reader:<10} {seconds:8.2f}s  peak {peak_memory / 2 ** 20:8.1f} MiB  '
+                   f'({len(records["measurements"])} measurements)')
+
+
+if __name__ == '__main__':
+    main()
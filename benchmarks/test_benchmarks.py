@@ -0,0 +1,116 @@
+"""The pytest-benchmark suite: ingest, filtering, the denormalised join, exports and page rendering, on a synthetic
+database (cm3d.synthetic) of CM3D_BENCH_MEASUREMENTS measurements (default 100000). Baselines are stored in
+benchmarks/baselines; compare against them, failing on a median more than 25% slower, with
+
+    pytest benchmarks --benchmark-storage=benchmarks/baselines --benchmark-compare --benchmark-compare-fail=median:25%
+
+and after a deliberate change in performance save a new baseline with
+
+    pytest benchmarks --benchmark-storage=benchmarks/baselines --benchmark-save=baseline
+"""
+import io
+import os
+
+import jinja2
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from bench_ingest import make_workbook
+from cm3d.database import (get_denormalised, get_filtered, get_filtered_page,
+                           get_study, get_study_list, stream_csv)
+from cm3d.ingest import insert_study, parse_workbook
+from cm3d.model import Study
+from cm3d.synthetic import populate
+
+MEASUREMENTS = int(os.environ.get('CM3D_BENCH_MEASUREMENTS', 100_000))
+
+FILTERS = {
+    'replica': 'biological_replica.id = 500 and measurement.value < 8000',
+    'treatment': "[group].protein_treatment in ('xyz', 'abc') and measurement.value between 500 and 6000",
+    'extras': 'measurement.data_extra0 >= 8',
+}
+
+
+@pytest.fixture(scope='module')
+def Session(tmp_path_factory):
+    engine = create_engine(f'sqlite:///{tmp_path_factory.mktemp("db") / "cm3d.db"}', future=True)
+    populate(engine, measurements=MEASUREMENTS)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture(scope='module')
+def templates():
+    environment = jinja2.Environment(loader=jinja2.PackageLoader('cm3d'))
+    environment.globals['url_for'] = lambda endpoint, **values: f'/{endpoint}'
+    return environment
+
+
+def test_ingest(benchmark, Session):
+    workbook = make_workbook(2000)
+
+    def ingest():
+        with Session() as session:
+            insert_study(session, parse_workbook(workbook), b'workbook', 'benchmark')
+            session.rollback()
+
+    benchmark(ingest)
+
+
+@pytest.mark.parametrize('name', FILTERS)
+def test_get_filtered(benchmark, Session, name):
+    with Session() as session:
+        records = benchmark(get_filtered, session, FILTERS[name])
+    assert len(records)
+
+
+def test_get_filtered_page(benchmark, Session):
+    with Session() as session:
+        total, page = benchmark(get_filtered_page, session, FILTERS['treatment'], offset=1000, limit=50,
+                                order_by='measurement.value')
+    assert len(page) == 50
+
+
+def test_get_denormalised(benchmark, Session):
+    with Session() as session:
+        records = benchmark.pedantic(get_denormalised, args=(session,), rounds=3)
+    assert len(records) >= MEASUREMENTS
+
+
+def test_export_csv(benchmark, Session):
+    def export():
+        with Session() as session:
+            return sum(len(chunk) for chunk in stream_csv(session))
+
+    assert benchmark.pedantic(export, rounds=3)
+
+
+def test_export_parquet(benchmark, Session):
+    pytest.importorskip('pyarrow')
+    from cm3d.export import write_columnar
+
+    def export():
+        with Session() as session:
+            return write_columnar(session, io.BytesIO(), 'parquet')
+
+    assert benchmark.pedantic(export, rounds=3)['rows'] >= MEASUREMENTS
+
+
+def test_render_studies(benchmark, Session, templates):
+    def render():
+        with Session() as session:
+            return templates.get_template('studies.html').render(studies=get_study_list(session))
+
+    assert 'Synthetic study' in benchmark(render)
+
+
+def test_render_study(benchmark, Session, templates):
+    with Session() as session:
+        study_id = session.execute(select(func.min(Study.id))).scalar()
+
+    def render():
+        with Session() as session:
+            return templates.get_template('study.html').render(study=get_study(session, study_id))
+
+    assert 'Value: ' in benchmark(render)
@@ -0,0 +1,112 @@
+"""Summary statistics of a numeric column (by default measurement.value) over the filtered records, grouped by any of
+the query columns, e.g. the mean value per measurement per protein treatment. count, sum, mean, min, max and std are
+computed by SQLite (std from each value's deviation from its group's mean), so only one row per group leaves the
+database; percentiles (p5, median, p95, ...) need the values themselves, so for those just the group and value columns
+are fetched and summarised with pandas."""
+import re
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Float, Integer, cast, func, select
+from sqlalchemy.orm import aliased
+
+from cm3d.database import (get_extras_keys, get_filter_statement,
+                           get_select_statement)
+from cm3d.filters import (TABLES, FilterError, Predicate, check_extras_keys,
+                          parse_column, reference_name)
+from cm3d.model import Measurement, MeasurementData
+
+SQL_STATISTICS = ['count', 'sum', 'mean', 'std', 'min', 'max']
+DEFAULT_STATISTICS = ['count', 'mean', 'std', 'min', 'max']
+DEFAULT_VALUE = 'measurement.value'
+
+_PERCENTILE = re.compile(r'p(\d{1,2}(?:\.\d+)?)$')
+
+
+def get_quantile(statistic: str) -> Optional[float]:
+    """The quantile for a percentile statistic (median, p0 - p99.9...), None for any other statistic"""
+    if statistic == 'median':
+        return 0.5
+    match = _PERCENTILE.match(statistic)
+    return float(match.group(1)) / 100 if match else None
+
+
+def check_statistics(statistics: List[str]):
+    unknown = [s for s in statistics if s not in SQL_STATISTICS and get_quantile(s) is None]
+    if unknown:
+        raise FilterError(f'Unknown statistic {", ".join(unknown)}, use {", ".join(SQL_STATISTICS)}, median or '
+                          f'percentiles like p5, p95')
+
+
+def aggregate(session, sql_where: Optional[str], group_by: List[str], statistics: List[str] = None,
+              value: str = DEFAULT_VALUE) -> pd.DataFrame:
+    """One row per combination of the group_by columns (table.column or measurement.data_<key>, as in filters) found
+    in the filtered records that have a value, with the statistics of the value column. An empty filter aggregates
+    all the records. Raises FilterError for unknown columns or statistics."""
+    statistics = statistics or DEFAULT_STATISTICS
+    check_statistics(statistics)
+    value_reference = parse_column(value)
+    if value_reference.column is None or \
+            not isinstance(TABLES[value_reference.table].__table__.c[value_reference.column].type, (Integer, Float)):
+        raise FilterError(f'{value} is not a numeric column')
+    references = [parse_column(name) for name in group_by]
+    check_extras_keys(('and', [Predicate(r, 'null') for r in references]), lambda: get_extras_keys(session))
+
+    # only rows with a value count, so the joins down to the value's table can all be inner joins
+    min_inner_joins = list(TABLES).index(value_reference.table)
+    if sql_where and sql_where.strip():
+        statement = get_filter_statement(session, sql_where, min_inner_joins)
+    else:
+        statement = get_select_statement(min_inner_joins)
+    value_column = TABLES[value_reference.table].__table__.c[value_reference.column]
+    statement = statement.where(value_column.is_not(None))
+
+    names = [reference_name(reference) for reference in references]
+    keys = list()
+    for reference, name in zip(references, names):
+        if reference.column is not None:
+            keys.append(TABLES[reference.table].__table__.c[reference.column].label(name))
+        else:
+            extra = aliased(MeasurementData.__table__)
+            statement = statement.outerjoin(extra, (extra.c.measurement_id == Measurement.id) &
+                                            (extra.c.key == reference.key))
+            keys.append(extra.c.datum.label(name))
+
+    # two passes in one query: a window gives each row its group's mean, then the grouped query sums the squared
+    # deviations from it, which (unlike the sum of squares minus the squared sum) keeps its precision for values with
+    # a large mean and a small spread
+    number = cast(value_column, Float)
+    rows = statement.with_only_columns(
+        *keys, value_column.label('value'), number.label('number'),
+        func.avg(number).over(partition_by=keys or None).label('group_mean')
+    ).subquery()
+    group_keys = [rows.c[name] for name in names]
+    deviation = rows.c.number - rows.c.group_mean
+    totals = select(
+        *group_keys, func.count(rows.c.value).label('count'), func.sum(rows.c.number).label('sum'),
+        func.sum(deviation * deviation).label('squared_deviations'), func.min(rows.c.value).label('min'),
+        func.max(rows.c.value).label('max')
+    ).group_by(*group_keys).order_by(*group_keys)
+    result = session.execute(totals)
+    summary = pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()))
+    # without group_by there's a row even when nothing matched
+    summary = summary[summary['count'] > 0].reset_index(drop=True)
+    summary[['sum', 'squared_deviations']] = summary[['sum', 'squared_deviations']].astype(float)
+    summary['mean'] = summary['sum'] / summary['count']
+    # the sample standard deviation, for groups of at least two values
+    variance = summary['squared_deviations'] / (summary['count'] - 1)
+    summary['std'] = np.sqrt(variance.clip(lower=0).where(summary['count'] > 1))
+
+    quantiles = {s: get_quantile(s) for s in statistics if get_quantile(s) is not None}
+    if quantiles:
+        result = session.execute(statement.with_only_columns(*keys, value_column.label('value')))
+        values = pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()))
+        for statistic, quantile in quantiles.items():
+            if names:
+                percentiles = values.groupby(names, dropna=False, sort=False)['value'].quantile(quantile)
+                summary = summary.merge(percentiles.rename(statistic).reset_index(), on=names, how='left')
+            else:
+                summary[statistic] = values['value'].quantile(quantile)
+    return summary[names + statistics]
+
@@ -0,0 +1,145 @@
+"""An in-process LRU cache of query results, so re-running the same filter (e.g. a saved one from filters.json), or
+paging and re-sorting its results, doesn't repeat the join. Results are keyed on the parsed filter, the options and
+the database generation (see model.Generation), so any added or deleted study invalidates them."""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+from cm3d.database import (DEFAULT_PAGE_SIZE, count_records, get_filter_statement,
+                           get_filtered, get_filtered_page)
+from cm3d.filters import parse_filter
+from cm3d.flat import (count_filtered_flat, get_filtered_flat,
+                       get_filtered_page_flat)
+from cm3d.model import get_generation
+
+DEFAULT_MAX_BYTES = int(os.environ.get('CM3D_RESULT_CACHE_MB', 256)) * 2 ** 20
+
+# results with more records than this are paged by the database instead of being fetched whole into the cache:
+# fetching this many takes a few tenths of a second, no more than the COUNT and page queries of a large result
+MAX_CACHED_RECORDS = 5000
+
+ID_COLUMNS = ['study.id', 'group.id', 'biological_replica.id', 'measurement.id']
+
+
+def filter_key(sql_where: str) -> str:
+    """The parsed filter (see cm3d.filters), written out: spellings of the same filter differing only in keyword case,
+    whitespace or quoting share a cache entry, while extras keys and values stay exactly as written. Raises
+    FilterError for an invalid filter."""
+    return repr(parse_filter(sql_where))
+
+
+class CachedResult:
+    """The records of one query, with the row orders already used to page them"""
+
+    def __init__(self, records: pd.DataFrame):
+        self.records = records
+        self.size = int(records.memory_usage(index=True, deep=True).sum())
+        self._orders: Dict[Tuple[Optional[str], bool], pd.Index] = dict()
+
+    def page(self, offset: int, limit: int, order_by: Optional[str] = None, descending=False) -> pd.DataFrame:
+        """The records in the same order as database.get_filtered_page, i.e. the ordering column (if any) then the ids
+        along the join, with NULLs sorting first as in SQLite"""
+        key = (order_by, descending)
+        if key not in self._orders:
+            ordered = self.records.sort_values(ID_COLUMNS, na_position='first', kind='stable')
+            if order_by is not None:
+                ordered = ordered.sort_values(order_by, ascending=not descending, kind='stable',
+                                              na_position='last' if descending else 'first')
+            self._orders[key] = ordered.index
+        return self.records.loc[self._orders[key][offset:offset + limit]].reset_index(drop=True)
+
+
+class ResultCache:
+    """Least recently used query results, up to max_bytes of DataFrame memory. Cached records are shared between
+    callers and must not be modified."""
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: Dict[tuple, CachedResult] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key) -> Optional[CachedResult]:
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, records: pd.DataFrame) -> CachedResult:
+        result = CachedResult(records)
+        if result.size > self.max_bytes:
+            return result
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key).size
+            self._entries[key] = result
+            self._bytes += result.size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+results = ResultCache()
+
+
+def get_filtered_records(session, sql_where, flatten=False) -> pd.DataFrame:
+    """The filtered records from the flat table when it is fresh, otherwise from the join"""
+    records = get_filtered_flat(session, sql_where, flatten=flatten)
+    return get_filtered(session, sql_where, flatten=flatten) if records is None else records
+
+
+def cache_key(session, sql_where: str, flatten: bool) -> tuple:
+    return get_generation(session.connection()), filter_key(sql_where), flatten
+
+
+def get_filtered_cached(session, sql_where, flatten=False, cache: ResultCache = results) -> pd.DataFrame:
+    """database.get_filtered, served from the cache when the same filter has already been run on the current data"""
+    key = cache_key(session, sql_where, flatten)
+    result = cache.get(key)
+    if result is None:
+        result = cache.put(key, get_filtered_records(session, sql_where, flatten=flatten))
+    return result.records
+
+
+def get_filtered_page_cached(session, sql_where, offset=0, limit=DEFAULT_PAGE_SIZE, order_by=None, descending=False,
+                             flatten=False, cache: ResultCache = results) -> Tuple[int, pd.DataFrame]:
+    """database.get_filtered_page, with the page cut from the cached result when there is one. Otherwise results
+    small enough to cache are fetched whole (so the following pages need no queries) and larger ones are paged by the
+    database. Both use the flat table when it is fresh."""
+    key = cache_key(session, sql_where, flatten)
+    result = cache.get(key)
+    if result is None:
+        total = count_filtered_flat(session, sql_where)
+        if total is None:
+            total = count_records(session, get_filter_statement(session, sql_where))
+        if total > MAX_CACHED_RECORDS:
+            page = get_filtered_page_flat(session, sql_where, offset=offset, limit=limit, order_by=order_by,
+                                          descending=descending, flatten=flatten, total=total)
+            if page is None:
+                page = get_filtered_page(session, sql_where, offset=offset, limit=limit, order_by=order_by,
+                                         descending=descending, flatten=flatten, total=total)
+            return page
+        result = cache.put(key, get_filtered_records(session, sql_where, flatten=flatten))
+    return len(result.records), result.page(offset, limit, order_by, descending)
@@ -1,22 +1,36 @@
+import glob
 import importlib.resources
 import json
 import os
 import sys
+import time
 from pathlib import Path
 
 import click
 import pandas as pd
 from flask_httpauth import HTTPDigestAuth
 from rotate_backups import RotateBackups
-from waitress import serve
 
 from cm3d import (BACKUPS_DIRNAME, DATABASE_FILENAME, DOWNLOADS_DIRNAME,
                    FILTERS_FILENAME, INPUT_TEMPLATE_FILENAME, UPLOADS_DIRNAME,
                    USERS_FILENAME)
+from cm3d import server
+from cm3d.aggregate import (DEFAULT_STATISTICS, DEFAULT_VALUE, SQL_STATISTICS,
+                            aggregate as aggregate_records)
 from cm3d.connection import ROSession, RWSession
-from cm3d.database import get_denormalised, get_filtered
-from cm3d.ingest import read_file
-from cm3d.model import Base, Study
+from cm3d.database import get_filtered, stream_csv
+from cm3d.export import FORMATS, write_columnar
+from cm3d.filters import FilterError
+from cm3d.flat import rebuild_flat as rebuild_flat_table
+from cm3d.ingest import (READERS, ingest_files, insert_study, parse_workbook,
+                         read_study_file)
+from cm3d.instrumentation import PROFILERS, SLOW_QUERY_MS
+from cm3d.instrumentation import instrument as instrument_app
+from cm3d.migration import migrate as migrate_database
+from cm3d.model import Base
+from cm3d.retention import (MAX_AGE_HOURS, MAX_MB, RECLAIMED_FILENAME, Sweeper,
+                            delete_orphaned_files, sweep)
+from cm3d.synthetic import populate
 from cm3d.utils import get_timestamp, mock_study_worksheets
 
 
@@ -68,30 +82,64 @@ def init():
 @click.argument('password')
 def add_user(username, password):
     """Adds credentials for user to access the website."""
-    users = json.load(open(USERS_FILENAME, 'r'))
+    with open(USERS_FILENAME, 'r') as user_file:
+        users = json.load(user_file)
     if username in users:
         click.echo(f"ERROR: User {username} already exists.")
         sys.exit(1)
     auth = HTTPDigestAuth(use_ha1_pw=True)
     encrypted_password = auth.generate_ha1(username, password)
     users[username] = encrypted_password
-    json.dump(users, open(USERS_FILENAME, 'w'))
+    # write a new file and swap it in, so the running web server never reads a half written one
+    with open(f'{USERS_FILENAME}.tmp', 'w') as user_file:
+        json.dump(users, user_file)
+    os.replace(f'{USERS_FILENAME}.tmp', USERS_FILENAME)
     click.echo(f"User {username} added to {USERS_FILENAME}")
 
 
 @cli.command()
 @click.option('--debug', is_flag=True)
-def web(debug):
+@click.option('--host', default='0.0.0.0', show_default=True)
+@click.option('--port', default=8080, show_default=True)
+@click.option('--workers', default=1, show_default=True, type=click.IntRange(1),
+              help='server processes sharing the port (pre-forked; not on Windows)')
+@click.option('--threads', default=server.THREADS, show_default=True, type=click.IntRange(1),
+              help='request threads per process')
+@click.option('--connection-limit', default=server.CONNECTION_LIMIT, show_default=True,
+              help='open connections per process before new ones wait in the backlog')
+@click.option('--channel-timeout', default=server.CHANNEL_TIMEOUT, show_default=True,
+              help='seconds before an inactive connection is closed')
+@click.option('--backlog', default=server.BACKLOG, show_default=True, help='connections waiting to be accepted')
+@click.option('--instrument', is_flag=True, help='add Server-Timing headers and log slow queries with their plans')
+@click.option('--slow-query-ms', default=SLOW_QUERY_MS, show_default=True, help='with --instrument')
+@click.option('--profile-ms', type=float, help='with --instrument, save profiles of requests taking this long')
+@click.option('--profiler', type=click.Choice(PROFILERS), default='cprofile', show_default=True)
+def web(debug, host, port, workers, threads, connection_limit, channel_timeout, backlog, instrument, slow_query_ms,
+        profile_ms, profiler):
     """Start the web application."""
     from .web import app
     app.debug = debug
+    if instrument:
+        instrument_app(app, [RWSession.kw['bind'], ROSession.kw['bind']], slow_query_ms=slow_query_ms,
+                       profile_ms=profile_ms, profiler=profiler)
+    # the read-only web sessions can't switch the database to WAL, so connect once for writing first
+    with RWSession() as session:
+        session.connection()
+    # with several workers the sweeper runs in the parent, so the workers' /metrics read its totals from a file
+    totals_file = app.config['WORKING_DIRECTORY'] / RECLAIMED_FILENAME if workers > 1 and not debug else None
+    app.sweeper = Sweeper([app.config['DOWNLOAD_FOLDER'], app.config['UPLOAD_FOLDER']], totals_file=totals_file)
     if debug:
-        app.run(debug=debug)
+        app.sweeper.start()
+        app.run(debug=debug, host=host, port=port)
     else:
         import logging
-        logger = logging.getLogger('waitress')
-        logger.setLevel(logging.INFO)
-        serve(app, host='0.0.0.0', port=8080)
+        logging.getLogger('waitress').setLevel(logging.INFO)
+        logging.getLogger('cm3d.server').setLevel(logging.INFO)
+        try:
+            server.serve(app, host=host, port=port, workers=workers, on_start=app.sweeper.start, threads=threads,
+                         connection_limit=connection_limit, channel_timeout=channel_timeout, backlog=backlog)
+        except RuntimeError as error:
+            raise click.ClickException(str(error))
 
 
 @cli.command()
@@ -105,12 +153,44 @@ def create_db(drop):
 
 
 @cli.command()
-def export_db():
-    """Exports the entire database in CSV format. The database tables are denormalised and flattened."""
+def migrate():
+    """Upgrade an existing database in place to the current schema (e.g. adds new indexes). Take a backup first."""
+    with RWSession() as session:
+        applied = migrate_database(session.get_bind())
+    for change in applied:
+        click.echo(change)
+    click.echo(f'Database is up to date ({len(applied)} changes applied).')
+
+
+@cli.command()
+def rebuild_flat():
+    """(Re)build the flat table: a materialised copy of the denormalised database, with extra measurement data as
+    columns, that queries use instead of the join while it is up to date. Studies added afterwards are appended to it;
+    rebuild after deleting studies."""
+    start = time.perf_counter()
+    with RWSession() as session:
+        rows = rebuild_flat_table(session.connection())
+        session.commit()
+    click.echo(f'Built the flat table with {rows} rows in {time.perf_counter() - start:.1f}s')
+
+
+@cli.command()
+@click.option('--format', 'file_format', type=click.Choice(['csv'] + list(FORMATS)), default='csv', show_default=True,
+              help='csv is printed; the columnar formats (which need pyarrow) are saved to a file')
+@click.option('--output', help='File to save a columnar export to  [default: db_export_<timestamp>.<format>]')
+def export_db(file_format, output):
+    """Exports the entire database in CSV, Parquet, Arrow or Feather format. The database tables are denormalised and
+    flattened."""
     with ROSession() as session:
-        records = get_denormalised(session)
-        csv_records = records.to_csv(None, index=False)
-        print(csv_records)
+        if file_format == 'csv':
+            for csv_chunk in stream_csv(session):
+                click.echo(csv_chunk, nl=False)
+            return
+        if output is None:
+            output = f'db_export_{get_timestamp()}.{FORMATS[file_format]}'
+        written = write_columnar(session, output, file_format)
+    click.echo(f"Saved {written['rows']} rows in {written['row_groups']} row groups to {output} "
+               f"({os.path.getsize(output) / 2 ** 20:.1f} MiB)")
 
 
 @cli.command()
@@ -118,11 +198,59 @@ def export_db():
 def query_db(sql_filter):
     """Query the database."""
     with ROSession() as session:
-        records = get_filtered(session, sql_filter)
+        try:
+            records = get_filtered(session, sql_filter)
+        except FilterError as e:
+            click.echo(f'Invalid filter: {e}', err=True)
+            sys.exit(1)
         csv_records = records.to_csv(None, index_label='number')
         print(csv_records)
 
 
+@cli.command()
+@click.option('--filter', 'sql_filter', default='', help='only aggregate the records matching this filter')
+@click.option('--group-by', multiple=True, help='a column to group by, e.g. [group].protein_treatment (repeatable)')
+@click.option('--stat', 'statistics', multiple=True,
+              help=f'{", ".join(SQL_STATISTICS)}, median or a percentile like p95 (repeatable) '
+                   f'[default: {", ".join(DEFAULT_STATISTICS)}]')
+@click.option('--value', default=DEFAULT_VALUE, show_default=True, help='the numeric column to summarise')
+def aggregate(sql_filter, group_by, statistics, value):
+    """Prints summary statistics of the (filtered) records as CSV."""
+    with ROSession() as session:
+        try:
+            summary = aggregate_records(session, sql_filter, list(group_by), list(statistics), value)
+        except FilterError as e:
+            click.echo(f'Invalid aggregation: {e}', err=True)
+            sys.exit(1)
+        click.echo(summary.to_csv(index=False), nl=False)
+
+
+@cli.command()
+@click.option('--max-age-hours', default=MAX_AGE_HOURS, show_default=True,
+              help='delete downloads and uploads not used for this long')
+@click.option('--max-mb', default=MAX_MB, show_default=True,
+              help='then delete the least recently used until each directory is within this size')
+@click.option('--vacuum', is_flag=True, help='give the space freed in the database back to the file system')
+def gc(max_age_hours, max_mb, vacuum):
+    """Deletes old downloads and uploads, and stored spreadsheets no study refers to."""
+    total = 0
+    for dirname in [DOWNLOADS_DIRNAME, UPLOADS_DIRNAME]:
+        reclaimed = sweep(dirname, max_age_hours, max_mb)
+        click.echo(f"{dirname}: deleted {reclaimed['files']} files, {reclaimed['bytes'] / 2 ** 20:.1f} MiB")
+        total += reclaimed['bytes']
+    with RWSession() as session:
+        reclaimed = delete_orphaned_files(session)
+        session.commit()
+    click.echo(f"database: deleted {reclaimed['files']} unused spreadsheets, {reclaimed['bytes'] / 2 ** 20:.1f} MiB")
+    total += reclaimed['bytes']
+    if vacuum:
+        size = os.path.getsize(DATABASE_FILENAME)
+        with RWSession() as session:
+            session.connection().exec_driver_sql('VACUUM')
+        click.echo(f'database: vacuumed, {(size - os.path.getsize(DATABASE_FILENAME)) / 2 ** 20:.1f} MiB smaller')
+    click.echo(f'Reclaimed {total / 2 ** 20:.1f} MiB in total')
+
+
 @cli.command()
 def backup_db():
     """Makes a timestamped copy of the database & rotates the backups.
@@ -155,33 +283,71 @@ def backup_db():
 @cli.command()
 @click.argument('filename')
 @click.option('--username', hidden=True)
-def add_study(filename, username):
+@click.option('--reader', type=click.Choice(['auto'] + list(READERS)), default='auto', show_default=True,
+              help='Excel parser; auto uses calamine when installed, otherwise openpyxl')
+def add_study(filename, username, reader):
     """Load a new study spreadsheet into the database. The spreadsheet must be an Excel file based on the NGC
     template. Example: cm3d-cli my_latest_study.xlsx
     """
     click.echo('You are loading %s' % filename)
-    new_study = read_file(filename)
     if username is None:
         username = 'anonymous-cli'
-    new_study.added_by = username
+    workbook, binary_data, stats = read_study_file(filename, reader)
+    records = parse_workbook(workbook)
+    click.echo(f"Parsed with {stats['reader']} in {stats['seconds']:.2f}s"
+               + ('' if stats['peak_memory_growth'] is None
+                  else f", peak memory growth {stats['peak_memory_growth'] / 2 ** 20:.1f} MiB"))
 
     # add the study and get the study id
     with RWSession() as session:
-        session.add(new_study)
+        study_id = insert_study(session, records, binary_data, username)
         session.commit()
-        study_id = new_study.id
 
-    # retrieve the same study and check parts were saved
-    with ROSession() as session:
-        result = session.query(Study).where(Study.id == study_id).one()
-        measurements = biological_replicas = groups = 0
-        for group in result.groups:
-            groups += 1
-            for biological_replica in group.biological_replicas:
-                biological_replicas += 1
-                measurements += len(biological_replica.measurements)
+    click.echo(f"Successfully added study (id={study_id}) with {len(records['groups'])} groups, "
+               f"{len(records['biological_replicas'])} biological_replicas, {len(records['measurements'])} measurements.")
+
+
+@cli.command()
+@click.argument('source')
+@click.option('--workers', type=int, help='Processes parsing spreadsheets  [default: one per CPU]')
+@click.option('--batch-size', default=20, show_default=True, help='Studies inserted per commit')
+@click.option('--reader', type=click.Choice(['auto'] + list(READERS)), default='auto', show_default=True,
+              help='Excel parser; auto uses calamine when installed, otherwise openpyxl')
+@click.option('--username', hidden=True)
+def add_studies(source, workers, batch_size, reader, username):
+    """Load every study spreadsheet in a directory, or matching a glob pattern, into the database. Spreadsheets are
+    parsed in parallel; files that fail are reported and skipped. Example: cm3d-cli add-studies archive/
+    or cm3d-cli add-studies 'archive/2022_*.xlsx'
+    """
+    if username is None:
+        username = 'anonymous-cli'
+    if os.path.isdir(source):
+        filenames = sorted(str(path) for path in Path(source).glob('*.xlsx'))
+    else:
+        filenames = sorted(glob.glob(source))
+    if not filenames:
+        click.echo(f'No spreadsheets found in {source}')
+        sys.exit(1)
+    click.echo(f'You are loading {len(filenames)} files')
 
-    click.echo(f'Successfully added study (id={study_id}) with {groups} groups, {biological_replicas} biological_replicas, {measurements} measurements.')
+    start = time.perf_counter()
+    failures, measurements = list(), 0
+    with RWSession() as session:
+        for filename, study_id, records, error in ingest_files(session, filenames, username, reader, workers,
+                                                                batch_size):
+            if error is not None:
+                failures.append(filename)
+                click.echo(f'FAILED {filename}: {error}', err=True)
+            else:
+                measurements += len(records['measurements'])
+                click.echo(f"Added {filename} (id={study_id}) with {len(records['measurements'])} measurements")
+    seconds = time.perf_counter() - start
+
+    added = len(filenames) - len(failures)
+    click.echo(f'Added {added} studies ({measurements} measurements) in {seconds:.1f}s: '
+               f'{added / seconds:.1f} files/s, {measurements / seconds:.0f} measurements/s. {len(failures)} failed.')
+    if failures:
+        sys.exit(1)
 
 
 @cli.command()
@@ -195,5 +361,24 @@ def mock_study():
     click.echo(filename)
 
 
+@cli.command()
+@click.option('--studies', default=10, show_default=True)
+@click.option('--measurements-per-study', default=100_000, show_default=True)
+@click.option('--extras', default=1, show_default=True, help='extra data items per measurement')
+@click.option('--groups-per-study', default=10, show_default=True)
+@click.option('--replicas-per-group', default=10, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+def mock_db(studies, measurements_per_study, extras, groups_per_study, replicas_per_group, seed):
+    """Adds synthetic studies straight to the database with bulk inserts, to try things out at production scale."""
+    start = time.perf_counter()
+    with RWSession() as session:
+        engine = session.get_bind()
+    last_measurement = populate(engine, studies=studies, groups_per_study=groups_per_study,
+                                replicas_per_group=replicas_per_group,
+                                measurements=studies * measurements_per_study, extras=extras, seed=seed)
+    click.echo(f'Added {studies} studies in {time.perf_counter() - start:.1f}s; the last measurement id is '
+               f'{last_measurement}. Run rebuild-flat if you use the flat table.')
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,44 @@
+"""Cached access to the JSON files in the working directory (users, filters). A file is only read and parsed again when
+its modification time or size changes, so edits such as cm3d-cli add-user take effect without a restart."""
+import json
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+
+class JsonFileCache:
+    """Parsed JSON files keyed on file name, each with the (mtime, size) it was read at. The parsed objects are shared
+    between callers and must not be modified."""
+
+    def __init__(self):
+        self._entries: Dict[str, Tuple[Tuple[int, int], Any]] = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename, default=None):
+        """The parsed contents of the file, or default if the file doesn't exist"""
+        filename = str(filename)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return default
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+        with open(filename) as json_file:
+            data = json.load(json_file)
+        with self._lock:
+            self.misses += 1
+            self._entries[filename] = (version, data)
+        return data
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'files': len(self._entries)}
+
+
+json_files = JsonFileCache()
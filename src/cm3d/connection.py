@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.orm import sessionmaker
 
 from cm3d import DATABASE_FILENAME
@@ -7,15 +9,93 @@ from cm3d import DATABASE_FILENAME
 _db_uri = f'sqlite:///file:{DATABASE_FILENAME}?uri=true'
 _db_ro_uri = f'{_db_uri}&mode=ro'
 
+# the tuning profile, set on every new connection. Each pragma can be overridden with a CM3D_SQLITE_<PRAGMA>
+# environment variable, e.g. CM3D_SQLITE_MMAP_SIZE=0 to turn off memory-mapped reads.
+PRAGMAS = {
+    # readers no longer block the writer, or the writer readers. Stored in the database file, so only set by writers
+    'journal_mode': 'wal',
+    # safe with WAL: a power cut may lose the last commits but can't corrupt the database
+    'synchronous': 'normal',
+    # negative is KiB: 64 MiB page cache per connection
+    'cache_size': -65536,
+    # read the database through a memory map (256 MiB) rather than read() calls
+    'mmap_size': 268435456,
+    'temp_store': 'memory',
+    # milliseconds to wait for another connection's lock before raising "database is locked"
+    'busy_timeout': 10000,
+}
+# pragmas that change the database file, which a read-only connection can't do
+WRITE_PRAGMAS = {'journal_mode'}
+
+
+def get_pragmas(read_only: bool = False) -> dict:
+    """The tuning profile with any environment overrides applied"""
+    pragmas = {name: os.environ.get(f'CM3D_SQLITE_{name.upper()}', value) for name, value in PRAGMAS.items()}
+    if read_only:
+        pragmas = {name: value for name, value in pragmas.items() if name not in WRITE_PRAGMAS}
+    return pragmas
+
+
+def tune(engine, read_only: bool = False):
+    """Applies the tuning profile to every connection the engine opens"""
+    pragmas = get_pragmas(read_only)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    return engine
+
+
+def guard_fork(engine):
+    """Never hands out a pooled connection opened by another process: after a fork the parent's SQLite connections
+    are invalidated and replaced, rather than shared (SQLite connections must not cross a fork)"""
+
+    @event.listens_for(engine, 'connect')
+    def record_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            # forget the connection without closing it: the process that opened it may still use it
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(f'Connection opened by process {connection_record.info["pid"]}, '
+                                         f'checked out by process {os.getpid()}')
+
+    return engine
+
+
+def forget_connections():
+    """Run in a forked child: empties the engines' pools, without closing the parent's connections"""
+    for session_factory in (RWSession, ROSession):
+        session_factory.kw['bind'].dispose(close=False)
+
+
+def check_connections():
+    """Raises if this process holds pooled connections, e.g. ones inherited across a fork"""
+    for session_factory in (RWSession, ROSession):
+        pool = session_factory.kw['bind'].pool
+        if pool.checkedin() or pool.checkedout():
+            raise RuntimeError(f'Process {os.getpid()} already holds database connections ({pool.status()})')
+
 
 RWSession = sessionmaker(
-    bind=create_engine(_db_uri, future=True, echo=False, connect_args={"check_same_thread": False}),
+    bind=guard_fork(tune(create_engine(_db_uri, future=True, echo=False,
+                                       connect_args={"check_same_thread": False}))),
     autocommit=False,
     autoflush=False
 )
 
 ROSession = sessionmaker(
-    bind=create_engine(_db_ro_uri, future=True, echo=False, connect_args={"check_same_thread": False}),
+    bind=guard_fork(tune(create_engine(_db_ro_uri, future=True, echo=False, connect_args={"check_same_thread": False}),
+                         read_only=True)),
     autocommit=False,
     autoflush=False
 )
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_connections)
@@ -1,38 +1,301 @@
+import csv
+import datetime
+import io
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
 import pandas as pd
-from sqlalchemy import select, text
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.orm import raiseload, selectinload
+
+from cm3d.filters import (FilterError, Predicate, check_extras_keys,
+                          compile_filter, compile_for_join, inner_joins,
+                          parse_column, parse_filter, reference_name)
+from cm3d.model import (Biological_replica, Group, Measurement,
+                        MeasurementData, Study, StudyFile, get_csv_headers)
+
+# number of joined rows fetched from the cursor (and written out) at a time when streaming
+DEFAULT_CHUNK_SIZE = 5000
+
+# bytes of an uploaded file read from the database at a time when streaming it
+BLOB_CHUNK_SIZE = 64 * 1024
+# substr() reads the blob from its start each time, so without incremental blob I/O the chunks are bigger
+SUBSTR_CHUNK_SIZE = 4 * 2 ** 20
+
+# number of records in one page of query results
+DEFAULT_PAGE_SIZE = 50
+
+# SQLite's default limit on bound parameters in older versions
+MAX_IN_PARAMETERS = 999
+
+JOINED_MODELS = (Study, Group, Biological_replica, Measurement)
 
-from cm3d.model import Biological_replica, Group, Measurement, Study
+EXTRAS_COLUMNS = ['measurement_id', 'key', 'datum']
 
 
-def get_select_statement():
-    return select(Study, Group, Biological_replica, Measurement)\
-        .join(Study.groups, isouter=True)\
-        .join(Group.biological_replicas, isouter=True)\
-        .join(Biological_replica.measurements, isouter=True)
+def get_columns():
+    """All non-binary columns of the joined tables, labelled table.column (e.g. study.id, group.model)"""
+    return [clazz.__table__.c[column].label(f'{clazz.__tablename__}.{column}')
+            for clazz in JOINED_MODELS
+            for column in get_csv_headers(clazz)]
+
+
+def get_select_statement(inner_joins=0):
+    """Selects labelled scalar columns over the study -> group -> biological_replica -> measurement outer join. No ORM
+    entities are built and the uploaded file is never read. The first inner_joins joins are inner joins instead, for
+    filters that only match rows with a group / biological replica / measurement."""
+    joins = [(Group.__table__, Group.study_id == Study.id),
+             (Biological_replica.__table__, Biological_replica.group_id == Group.id),
+             (Measurement.__table__, Measurement.biological_replica_id == Biological_replica.id)]
+    from_clause = Study.__table__
+    for i, (table, on) in enumerate(joins):
+        from_clause = from_clause.join(table, on, isouter=i >= inner_joins)
+    return select(*get_columns()).select_from(from_clause)
+
+
+def get_filter_statement(session, sql_where: str, min_inner_joins=0):
+    """The select statement for the filter (see cm3d.filters): the denormalised join, with only the joins the filter
+    allows (and at least min_inner_joins) made inner, and the filter as SQL expressions with bound values. Raises
+    FilterError for a filter that can't be parsed or uses unknown columns or extras keys."""
+    parsed = parse_filter(sql_where)
+    check_extras_keys(parsed, lambda: get_extras_keys(session))
+    statement = get_select_statement(max(inner_joins(parsed), min_inner_joins))
+    return statement.where(compile_filter(parsed, compile_for_join))
 
 
 def get_denormalised(session) -> pd.DataFrame:
-    all_rows = session.execute(get_select_statement())
-    return pd.DataFrame.from_records(rows_to_dicts(all_rows, flatten=True))
+    return get_records(session, get_select_statement(), flatten=True)
 
 
 def get_filtered(session, sql_where, flatten=False) -> pd.DataFrame:
     assert sql_where is not None
-    select_statement = get_select_statement().filter(text(sql_where))
-    return pd.DataFrame.from_records(rows_to_dicts(session.execute(select_statement), flatten=flatten))
-
-
-def rows_to_dicts(records, flatten=False):
-    for row in records:
-        row_dict = dict()
-        for scalar in row:
-            if scalar is not None:
-                original = scalar.to_dict()
-                original.pop('study.uploaded_file', None)
-                if flatten:
-                    if 'measurement.data' in original:
-                        for k, v in original['measurement.data'].items():
-                            original[f'measurement.data_{k}'] = v
-                        del original['measurement.data']
-                row_dict = row_dict | original
-        yield row_dict
+    return get_records(session, get_filter_statement(session, sql_where), flatten=flatten)
+
+
+def get_filtered_page(session, sql_where, offset=0, limit=DEFAULT_PAGE_SIZE, order_by=None, descending=False,
+                      flatten=False, total=None) -> Tuple[int, pd.DataFrame]:
+    """Gets one page of the filtered records, in a stable order, and the total number of matching records. The total
+    comes from a COUNT over the same join (unless given), so no matching rows are transferred beyond the page itself."""
+    assert sql_where is not None
+    select_statement = get_filter_statement(session, sql_where)
+    if total is None:
+        total = count_records(session, select_statement)
+    columns = {column.name: column for column in get_columns()}
+    ordering = [columns[order_by]] if order_by is not None else []
+    if descending:
+        ordering = [column.desc() for column in ordering]
+    # the primary keys along the join make the order (and so the pages) deterministic
+    ordering += [Study.id, Group.id, Biological_replica.id, Measurement.id]
+    page_statement = select_statement.order_by(*ordering).offset(offset).limit(limit)
+    return total, get_records(session, page_statement, flatten=flatten)
+
+
+def count_records(session, select_statement) -> int:
+    """Counts the rows the select statement returns, without selecting any of its columns"""
+    return session.execute(select_statement.with_only_columns(func.count()).order_by(None)).scalar()
+
+
+def get_records(session, select_statement, flatten=False) -> pd.DataFrame:
+    """Runs the select statement and builds the DataFrame straight from the row tuples, adding the extra measurement
+    data either as a dict in measurement.data or, if flatten, as measurement.data_* columns"""
+    result = session.execute(select_statement)
+    records = pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()))
+    return add_extras(session, records, flatten=flatten)
+
+
+def add_extras(session, records: pd.DataFrame, flatten=False, keys: Optional[List[str]] = None) -> pd.DataFrame:
+    """Fetches the extras for all measurements in records in bulk and pivots them into the frame. If keys is given,
+    the flattened columns are exactly those keys (used when streaming, where the columns are fixed upfront)."""
+    extras = get_extras(session, records['measurement.id'])
+    if not flatten:
+        data = extras_to_dicts(extras)
+        records['measurement.data'] = [data.get(i, {}) for i in records['measurement.id']]
+        return records
+    wide = pivot_extras(extras)
+    if keys is not None:
+        wide = wide.reindex(columns=keys)
+    wide.columns = [f'measurement.data_{key}' for key in wide.columns]
+    return records.merge(wide, how='left', left_on='measurement.id', right_index=True)
+
+
+def get_extras(session, measurement_ids: Iterable) -> pd.DataFrame:
+    """Fetches the extra measurement data for the given measurements in long (measurement_id, key, datum) format,
+    using one query per MAX_IN_PARAMETERS measurements rather than one per measurement"""
+    ids = pd.unique(pd.Series(measurement_ids, dtype='float64').dropna()).astype('int64').tolist()
+    rows = list()
+    for start in range(0, len(ids), MAX_IN_PARAMETERS):
+        rows.extend(session.execute(
+            select(MeasurementData.measurement_id, MeasurementData.key, MeasurementData.datum)
+            .where(MeasurementData.measurement_id.in_(ids[start:start + MAX_IN_PARAMETERS]))
+        ).fetchall())
+    return pd.DataFrame.from_records(rows, columns=EXTRAS_COLUMNS)
+
+
+def pivot_extras(extras: pd.DataFrame) -> pd.DataFrame:
+    """Pivots long format extras into one row per measurement id and one column per key, sorted by key"""
+    wide = extras.pivot(index='measurement_id', columns='key', values='datum')
+    return wide.reindex(columns=sorted(wide.columns))
+
+
+def extras_to_dicts(extras: pd.DataFrame) -> Dict[int, Dict[str, str]]:
+    data = dict()
+    for measurement_id, key, datum in extras.itertuples(index=False, name=None):
+        data.setdefault(measurement_id, dict())[key] = datum
+    return data
+
+
+def get_core_headers() -> List[str]:
+    """The names of all non-binary columns of the joined tables, in join order"""
+    return [column.name for column in get_columns()]
+
+
+def get_extras_keys(session) -> List[str]:
+    """All distinct extra measurement data keys, i.e. the flattened measurement.data_* columns"""
+    return list(session.execute(select(MeasurementData.key).distinct().order_by(MeasurementData.key)).scalars())
+
+
+def get_study_list(session):
+    """One row per study for the studies page, with its number of groups counted by SQLite: a single query however
+    many studies there are"""
+    group_counts = select(Group.study_id, func.count().label('count')).group_by(Group.study_id).subquery()
+    return session.execute(
+        select(Study.id, Study.title, Study.authors, Study.added_by, Study.date_input,
+               func.coalesce(group_counts.c.count, 0).label('groups'))
+        .outerjoin(group_counts, group_counts.c.study_id == Study.id)
+        .order_by(Study.id)
+    ).all()
+
+
+def get_study(session, study_id: int) -> Optional[Study]:
+    """The study with all its groups, biological replicas, measurements and their extra data loaded up front, one
+    query per level. Anything else is never lazy loaded (it raises instead), so rendering the study can't query."""
+    return session.execute(
+        select(Study).where(Study.id == study_id).options(
+            selectinload(Study.groups).selectinload(Group.biological_replicas)
+            .selectinload(Biological_replica.measurements).selectinload(Measurement.data),
+            raiseload('*')
+        )
+    ).scalar()
+
+
+FILE_ROWID = literal_column(f'{StudyFile.__tablename__}.rowid')
+
+
+def get_study_file(session, study_id: int):
+    """The rowid, sha256 and size of the study's uploaded file, with the date the study was added; nothing is read from
+    the file itself. None if there is no such study."""
+    return session.execute(
+        select(FILE_ROWID.label('rowid'), StudyFile.sha256,
+               func.coalesce(StudyFile.size, func.length(StudyFile.content)).label('size'), Study.date_input)
+        .join(Study, Study.file_sha256 == StudyFile.sha256).where(Study.id == study_id)
+    ).one_or_none()
+
+
+def iter_blob(session, rowid: int, chunk_size=BLOB_CHUNK_SIZE):
+    """Yields an uploaded file straight from the study_file table a chunk at a time, with SQLite's incremental blob
+    I/O where Python has it (3.11+), otherwise with substr()"""
+    connection = session.connection().connection.driver_connection
+    if hasattr(connection, 'blobopen'):
+        with connection.blobopen(StudyFile.__tablename__, 'content', rowid, readonly=True) as blob:
+            while chunk := blob.read(chunk_size):
+                yield chunk
+    else:
+        yield from iter_blob_substr(session, rowid)
+
+
+def iter_blob_substr(session, rowid: int, chunk_size=SUBSTR_CHUNK_SIZE):
+    offset = 0
+    while True:
+        chunk = session.execute(
+            select(func.substr(StudyFile.content, offset + 1, chunk_size)).where(FILE_ROWID == rowid)
+        ).scalar()
+        if not chunk:
+            return
+        yield chunk
+        offset += len(chunk)
+
+
+def iter_chunks(session, select_statement, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Executes the statement with yield_per, yielding lists of at most chunk_size row tuples"""
+    result = session.execute(select_statement.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield partition
+
+
+def stream_csv(session, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the flattened database as CSV text, one chunk of rows at a time. The extra measurement data columns
+    are found with a single scan of the keys before any rows are read."""
+    headers = get_core_headers()
+    extras_keys = get_extras_keys(session)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(headers + [f'measurement.data_{key}' for key in extras_keys])
+    for rows in iter_chunks(session, get_select_statement(), chunk_size=chunk_size):
+        # object dtype keeps integer ids as integers alongside the empty cells of the outer join
+        records = add_extras(session, pd.DataFrame(rows, columns=headers, dtype=object), flatten=True, keys=extras_keys)
+        writer.writerows(records.astype(object).where(records.notna(), None).itertuples(index=False, name=None))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # header only, if the database is empty
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream_json_lines(session, sql_where='', columns: Optional[List[str]] = None, limit: Optional[int] = None,
+                      extras=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Streams the filtered records as newline-delimited JSON, one object per record keyed by column name, built a
+    chunk of rows at a time as they come off the cursor (yield_per), so neither memory nor the time to the first
+    record depends on the number of records. columns are written as in a filter (table.column or
+    measurement.data_<key>), all core columns by default; with extras, each record also gets all its extra data as an
+    object in measurement.data. The filter and columns are checked (raising FilterError) before this returns."""
+    references = list()
+    for name in columns or get_core_headers():
+        try:
+            references.append(parse_column(name))
+        except FilterError:
+            # the parser's messages are worded for filters
+            raise FilterError(f"Invalid column '{name}'") from None
+    check_extras_keys(('and', [Predicate(r, 'null') for r in references]), lambda: get_extras_keys(session))
+    if limit is not None and limit < 0:
+        raise FilterError(f'Invalid limit {limit}')
+    statement = get_filter_statement(session, sql_where) if sql_where and sql_where.strip() else get_select_statement()
+    by_name = {column.name: column for column in get_columns()}
+    core = list(dict.fromkeys(reference_name(r) for r in references if r.column is not None))
+    # (name, index of the selected column, or None and the extras key)
+    fields = [(reference_name(r), core.index(reference_name(r)) if r.column is not None else None, r.key)
+              for r in references]
+    if extras or any(r.column is None for r in references):
+        # the extras are looked up by measurement id, selected for that even if not asked for
+        if 'measurement.id' not in core:
+            core.append('measurement.id')
+        id_index = core.index('measurement.id')
+    else:
+        id_index = None
+    statement = statement.with_only_columns(*[by_name[name] for name in core])
+    if limit is not None:
+        statement = statement.limit(limit)
+    return iter_json_lines(session, statement, fields, id_index, extras, chunk_size)
+
+
+def iter_json_lines(session, statement, fields, id_index, extras, chunk_size):
+    for rows in iter_chunks(session, statement, chunk_size=chunk_size):
+        data = dict() if id_index is None else extras_to_dicts(get_extras(session, [row[id_index] for row in rows]))
+        lines = list()
+        for row in rows:
+            row_data = data.get(row[id_index], {}) if id_index is not None else {}
+            record = {name: row[index] if index is not None else row_data.get(key) for name, index, key in fields}
+            if extras:
+                record['measurement.data'] = row_data
+            lines.append(encode_json(record))
+        yield '\n'.join(lines) + '\n'
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+# one encoder for every record, rather than json.dumps setting one up each time
+encode_json = json.JSONEncoder(default=json_default).encode
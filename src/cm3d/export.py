@@ -0,0 +1,94 @@
+"""Exports the denormalised, flattened database in columnar formats (Parquet, Arrow IPC, Feather) for analytics. Needs
+the optional pyarrow package. Rows are read and written one row group at a time, so memory use doesn't grow with the
+size of the database."""
+from typing import Dict, Iterator, Set
+
+import pandas as pd
+from sqlalchemy import Date, Float, Integer, func, select
+
+from cm3d.database import (JOINED_MODELS, add_extras, get_core_headers,
+                           get_extras_keys, get_select_statement, iter_chunks)
+from cm3d.model import get_csv_headers
+
+# rows in each Parquet row group / Arrow record batch
+ROW_GROUP_SIZE = 100_000
+
+# format -> file extension
+FORMATS = {'parquet': 'parquet', 'arrow': 'arrow', 'feather': 'feather'}
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError('Columnar export needs pyarrow: pip install pyarrow') from None
+    return pyarrow
+
+
+def get_schema(session):
+    """The Arrow schema of the export: the column types from the model, and strings for the extra measurement data.
+    SQLite doesn't enforce column types, so a numeric column holding any text is exported as strings instead."""
+    pa = require_pyarrow()
+    fields = list()
+    for clazz in JOINED_MODELS:
+        columns = [clazz.__table__.c[name] for name in get_csv_headers(clazz)]
+        with_text = get_columns_with_text(session, [c for c in columns if isinstance(c.type, (Integer, Float))])
+        for column in columns:
+            if isinstance(column.type, Date):
+                arrow_type = pa.date32()
+            elif isinstance(column.type, (Integer, Float)) and column.name not in with_text:
+                arrow_type = pa.int64() if isinstance(column.type, Integer) else pa.float64()
+            else:
+                arrow_type = pa.string()
+            fields.append(pa.field(f'{clazz.__tablename__}.{column.name}', arrow_type))
+    for key in get_extras_keys(session):
+        fields.append(pa.field(f'measurement.data_{key}', pa.string()))
+    return pa.schema(fields)
+
+
+def get_columns_with_text(session, columns) -> Set[str]:
+    """The names of the (numeric, same table) columns holding any value that isn't a number, checked in one scan of
+    the table. Ids are always integers (primary keys are rowids, and foreign keys refer to them), so aren't checked."""
+    checked = [column for column in columns if not column.primary_key and not column.foreign_keys]
+    if not checked:
+        return set()
+    counts = session.execute(select(*[
+        func.coalesce(func.sum(func.typeof(column).not_in(['integer', 'real', 'null'])), 0) for column in checked
+    ])).one()
+    return {column.name for column, count in zip(checked, counts) if count}
+
+
+def iter_record_batches(session, schema, chunk_size=ROW_GROUP_SIZE) -> Iterator:
+    """Yields the flattened join as Arrow record batches of at most chunk_size rows"""
+    pa = require_pyarrow()
+    headers = get_core_headers()
+    extras_keys = [name[len('measurement.data_'):] for name in schema.names[len(headers):]]
+    for rows in iter_chunks(session, get_select_statement(), chunk_size=chunk_size):
+        records = add_extras(session, pd.DataFrame(rows, columns=headers, dtype=object), flatten=True, keys=extras_keys)
+        for field in schema:
+            if pa.types.is_string(field.type):
+                records[field.name] = [None if pd.isna(v) else str(v) for v in records[field.name]]
+        yield pa.RecordBatch.from_pandas(records, schema=schema, preserve_index=False)
+
+
+def write_columnar(session, sink, file_format: str, chunk_size=ROW_GROUP_SIZE) -> Dict[str, int]:
+    """Writes the flattened database to sink (a file name or binary file object) in the given format, one row group
+    (Parquet) or record batch (Arrow/Feather) per chunk. Returns the number of rows and row groups written."""
+    pa = require_pyarrow()
+    schema = get_schema(session)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    elif file_format in ('arrow', 'feather'):
+        # feather (v2) is the Arrow IPC file format with compressed buffers
+        options = pa.ipc.IpcWriteOptions(compression='zstd' if file_format == 'feather' else None)
+        writer = pa.ipc.new_file(sink, schema, options=options)
+    else:
+        raise ValueError(f'Unknown format {file_format}, choose from {", ".join(FORMATS)}')
+    rows, row_groups = 0, 0
+    with writer:
+        for batch in iter_record_batches(session, schema, chunk_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+            row_groups += 1
+    return {'rows': rows, 'row_groups': row_groups}
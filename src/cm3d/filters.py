@@ -0,0 +1,309 @@
+"""The query filter language: the WHERE clauses of filters.json, e.g.
+
+    [group].protein_treatment in ('xyz', 'abc') and measurement.value between 500 and 6000
+
+parsed and checked rather than pasted into the SQL. A filter is a combination (and, or, not, parentheses) of
+comparisons of a table.column, or an extra measurement data item (measurement.data_<key>), with literal values:
+=, !=, <>, <, <=, >, >=, [not] in (...), [not] between ... and ..., [not] like '...', is [not] null. Table names may be
+quoted as [group], "group" or `group`. Values are always bound parameters, and unknown columns or extras keys are
+reported before anything is run."""
+import datetime
+import operator
+import re
+from typing import Callable, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+from sqlalchemy import Date, Float, and_, cast, or_, select
+
+from cm3d.model import (Biological_replica, Group, Measurement,
+                        MeasurementData, Study, get_csv_headers)
+
+# the join order, from the root of the join
+TABLES = {'study': Study, 'group': Group, 'biological_replica': Biological_replica, 'measurement': Measurement}
+EXTRAS_PREFIX = 'data_'
+
+KEYWORDS = {'and', 'or', 'not', 'in', 'between', 'like', 'is', 'null'}
+COMPARISONS = {'=': '=', '==': '=', '!=': '!=', '<>': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+NEGATED_COMPARISONS = {'=': '!=', '!=': '=', '<': '>=', '<=': '>', '>': '<=', '>=': '<'}
+OPERATORS = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+             '>=': operator.ge}
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*')
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<name>\[[^\]]+\]|"(?:[^"]|"")+"|`[^`]+`|[A-Za-z_]\w*)
+  | (?P<symbol><=|>=|<>|!=|==|[=<>(),.-])
+)""", re.VERBOSE)
+
+
+class FilterError(ValueError):
+    """The filter can't be parsed, or refers to unknown columns or extras keys"""
+
+
+class Reference(NamedTuple):
+    """A column of one of the joined tables, or (with column None) the extras item with the given key"""
+    table: str
+    column: Optional[str]
+    key: Optional[str] = None
+
+
+class Predicate(NamedTuple):
+    """A comparison of a reference with literal values. op is one of the COMPARISONS values, 'in', 'between', 'like'
+    or 'null', and negated turns it into its opposite (not in, not between, not like, is not null)."""
+    reference: Reference
+    op: str
+    values: Tuple = ()
+    negated: bool = False
+
+
+# a parsed filter is a Predicate, or ('and' | 'or', [filters])
+Filter = Union[Predicate, Tuple[str, List]]
+
+
+def tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens, position = list(), 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise FilterError(f'Unexpected character at position {position + 1}: {text[position:position + 10]!r}')
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'name' and value.lower() in KEYWORDS:
+            kind, value = 'keyword', value.lower()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """A recursive descent parser for the filter language, with not pushed down to the predicates as it goes"""
+
+    def __init__(self, text: str):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self, kind=None, value=None) -> bool:
+        if self.position >= len(self.tokens):
+            return False
+        token_kind, token_value = self.tokens[self.position]
+        return (kind is None or token_kind == kind) and (value is None or token_value == value)
+
+    def take(self, kind=None, value=None) -> str:
+        if not self.peek(kind, value):
+            found = self.tokens[self.position][1] if self.position < len(self.tokens) else 'the end of the filter'
+            raise FilterError(f'Expected {value or kind} but found {found}')
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def parse(self) -> Filter:
+        if not self.tokens:
+            raise FilterError('The filter is empty')
+        parsed = self.parse_or(False)
+        if self.position < len(self.tokens):
+            raise FilterError(f'Unexpected {self.tokens[self.position][1]}')
+        return parsed
+
+    def parse_or(self, negated: bool) -> Filter:
+        # not (a or b) is (not a) and (not b)
+        terms = [self.parse_and(negated)]
+        while self.peek('keyword', 'or'):
+            self.take()
+            terms.append(self.parse_and(negated))
+        return terms[0] if len(terms) == 1 else ('and' if negated else 'or', terms)
+
+    def parse_and(self, negated: bool) -> Filter:
+        terms = [self.parse_not(negated)]
+        while self.peek('keyword', 'and'):
+            self.take()
+            terms.append(self.parse_not(negated))
+        return terms[0] if len(terms) == 1 else ('or' if negated else 'and', terms)
+
+    def parse_not(self, negated: bool) -> Filter:
+        if self.peek('keyword', 'not'):
+            self.take()
+            return self.parse_not(not negated)
+        if self.peek('symbol', '('):
+            self.take()
+            parsed = self.parse_or(negated)
+            self.take('symbol', ')')
+            return parsed
+        return self.parse_predicate(negated)
+
+    def parse_predicate(self, negated: bool) -> Predicate:
+        reference = self.parse_reference()
+        if self.peek('keyword', 'is'):
+            self.take()
+            if self.peek('keyword', 'not'):
+                self.take()
+                negated = not negated
+            self.take('keyword', 'null')
+            return Predicate(reference, 'null', negated=negated)
+        if self.peek('keyword', 'not'):
+            self.take()
+            negated = not negated
+            if not any(self.peek('keyword', op) for op in ('in', 'between', 'like')):
+                raise FilterError('Expected in, between or like after not')
+        if self.peek('keyword', 'in'):
+            self.take()
+            self.take('symbol', '(')
+            values = [self.parse_value()]
+            while self.peek('symbol', ','):
+                self.take()
+                values.append(self.parse_value())
+            self.take('symbol', ')')
+            return Predicate(reference, 'in', tuple(values), negated)
+        if self.peek('keyword', 'between'):
+            self.take()
+            low = self.parse_value()
+            self.take('keyword', 'and')
+            return Predicate(reference, 'between', (low, self.parse_value()), negated)
+        if self.peek('keyword', 'like'):
+            self.take()
+            return Predicate(reference, 'like', (self.parse_string(),), negated)
+        symbol = self.take('symbol')
+        if symbol not in COMPARISONS:
+            raise FilterError(f'Expected a comparison after {reference_name(reference)} but found {symbol}')
+        op = COMPARISONS[symbol]
+        return Predicate(reference, NEGATED_COMPARISONS[op] if negated else op, (self.parse_value(),))
+
+    def parse_reference(self) -> Reference:
+        name = unquote(self.take('name'))
+        if '.' in name:
+            # a quoted "table.column", as the query results name their columns
+            table, column = name.split('.', 1)
+        else:
+            self.take('symbol', '.')
+            table, column = name, unquote(self.take('name'))
+        table = table.lower()
+        if table not in TABLES:
+            raise FilterError(f'Unknown table {table}, use one of {", ".join(TABLES)}')
+        # column names ignore case, as in SQL; extras keys don't, as Viability and viability are different keys
+        columns = {name.lower(): name for name in get_csv_headers(TABLES[table])}
+        if table == 'measurement' and column[:len(EXTRAS_PREFIX)].lower() == EXTRAS_PREFIX and \
+                column.lower() not in {name.lower() for name in TABLES[table].__table__.c.keys()}:
+            return Reference(table, None, column[len(EXTRAS_PREFIX):])
+        if column.lower() not in columns:
+            raise FilterError(f'Unknown column {table}.{column}')
+        return Reference(table, columns[column.lower()])
+
+    def parse_value(self):
+        if self.peek('string'):
+            return self.parse_string()
+        sign = -1 if self.peek('symbol', '-') else 1
+        if sign == -1:
+            self.take()
+        number = self.take('number')
+        return sign * (float(number) if any(c in number for c in '.eE') else int(number))
+
+    def parse_string(self) -> str:
+        return self.take('string')[1:-1].replace("''", "'")
+
+
+def unquote(name: str) -> str:
+    if name[0] in '["`':
+        return name[1:-1].replace('""', '"') if name[0] == '"' else name[1:-1]
+    return name
+
+
+def reference_name(reference: Reference) -> str:
+    return f'{reference.table}.{reference.column or EXTRAS_PREFIX + reference.key}'
+
+
+def parse_filter(text: str) -> Filter:
+    return Parser(text).parse()
+
+
+def parse_column(text: str) -> Reference:
+    """A single table.column or measurement.data_<key> reference, written as in a filter"""
+    parser = Parser(text)
+    reference = parser.parse_reference()
+    if parser.position < len(parser.tokens):
+        raise FilterError(f'Unexpected {parser.tokens[parser.position][1]} after {reference_name(reference)}')
+    return reference
+
+
+def predicates(parsed: Filter):
+    if isinstance(parsed, Predicate):
+        yield parsed
+    else:
+        for term in parsed[1]:
+            yield from predicates(term)
+
+
+def null_rejected(parsed: Filter) -> Set[str]:
+    """The tables whose columns can't all be NULL in a row the filter matches, i.e. where an outer join can be an
+    inner join"""
+    if isinstance(parsed, Predicate):
+        return set() if parsed.op == 'null' and not parsed.negated else {parsed.reference.table}
+    tables = [null_rejected(term) for term in parsed[1]]
+    return set.union(*tables) if parsed[0] == 'and' else set.intersection(*tables)
+
+
+def check_extras_keys(parsed: Filter, known_keys: Callable[[], Iterable[str]]):
+    """Raises FilterError if the filter uses extras keys that aren't in known_keys(), which is only called if the
+    filter uses any extras"""
+    keys = {p.reference.key for p in predicates(parsed) if p.reference.column is None}
+    if keys:
+        unknown = keys - set(known_keys())
+        if unknown:
+            raise FilterError(f'Unknown measurement data {", ".join(sorted(unknown))}')
+
+
+def inner_joins(parsed: Filter) -> int:
+    """How many of the joins, from the root of the join, can be inner joins: those down to the deepest table the
+    filter requires a row in"""
+    return max((list(TABLES).index(table) for table in null_rejected(parsed)), default=0)
+
+
+def compare(expression, predicate: Predicate, column_type=None):
+    """The SQL expression for the predicate applied to the column expression"""
+    values = predicate.values
+    if isinstance(column_type, Date):
+        values = tuple(to_date(value) for value in values)
+    if predicate.op == 'null':
+        return expression.is_not(None) if predicate.negated else expression.is_(None)
+    if predicate.op == 'in':
+        return expression.not_in(values) if predicate.negated else expression.in_(values)
+    if predicate.op == 'between':
+        clause = expression.between(*values)
+        return ~clause if predicate.negated else clause
+    if predicate.op == 'like':
+        return expression.not_like(values[0]) if predicate.negated else expression.like(values[0])
+    return OPERATORS[predicate.op](expression, values[0])
+
+
+def to_date(value):
+    try:
+        return datetime.date.fromisoformat(str(value))
+    except ValueError:
+        raise FilterError(f'{value} is not a date, use YYYY-MM-DD') from None
+
+
+def compile_filter(parsed: Filter, compile_predicate: Callable):
+    """Builds the SQLAlchemy expression for the parsed filter, using compile_predicate for each predicate"""
+    if isinstance(parsed, Predicate):
+        return compile_predicate(parsed)
+    terms = [compile_filter(term, compile_predicate) for term in parsed[1]]
+    return and_(*terms) if parsed[0] == 'and' else or_(*terms)
+
+
+def compile_for_join(predicate: Predicate):
+    """Predicates on the joined tables' columns; extras predicates become subqueries on measurement_data, so the
+    extras are never joined in"""
+    reference = predicate.reference
+    if reference.column is not None:
+        column = TABLES[reference.table].__table__.c[reference.column]
+        return compare(column, predicate, column.type)
+    with_key = select(MeasurementData.measurement_id).where(MeasurementData.key == reference.key)
+    if predicate.op == 'null':
+        if predicate.negated:
+            return Measurement.id.in_(with_key)
+        return or_(Measurement.id.is_(None), Measurement.id.not_in(with_key))
+    return Measurement.id.in_(with_key.where(compare(extras_datum(predicate), predicate)))
+
+
+def extras_datum(predicate: Predicate, datum=MeasurementData.datum):
+    """The extras are stored as text: compare them as numbers with numbers"""
+    if any(isinstance(value, (int, float)) for value in predicate.values):
+        return cast(datum, Float)
+    return datum
@@ -0,0 +1,217 @@
+"""An optional materialised copy of the denormalised database: the flat table holds one row per row of the study ->
+group -> biological_replica -> measurement outer join, with the parent attributes and the extra measurement data pivoted
+into columns (named like the query columns, e.g. "study.title", "measurement.data_xyz"). SQLite's column names ignore
+case, so a key differing from another only in case gets a numbered column ("measurement.data_XYZ~2"), recorded in the
+flat_extras table. It is built with cm3d-cli rebuild-flat and then kept up to date as studies are added. Filters (see
+cm3d.filters) run against it, without the join or the pivot, while it is fresh, i.e. built or updated at the current
+database generation."""
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import (Column, Index, MetaData, Table, UnicodeText, case,
+                        func, insert, inspect, select, text)
+
+from cm3d.database import (DEFAULT_PAGE_SIZE, get_columns, get_core_headers,
+                           get_extras_keys, get_select_statement)
+from cm3d.filters import (check_extras_keys, compare, compile_filter,
+                          extras_datum, parse_filter)
+from cm3d.model import (Biological_replica, Group, Measurement,
+                        MeasurementData, Study, get_generation)
+
+FLAT_TABLENAME = 'flat'
+FLAT_STATE_TABLENAME = 'flat_state'
+FLAT_EXTRAS_TABLENAME = 'flat_extras'
+EXTRAS_PREFIX = 'measurement.data_'
+
+# the same filter columns indexed in the normalised tables
+INDEXED_COLUMNS = [('study.id',), ('group.protein_treatment',), ('biological_replica.cell_name',),
+                   ('measurement.test_type',), ('measurement.measurement', 'measurement.value')]
+
+
+def get_flat_table(extras_columns: Dict[str, str]) -> Table:
+    """The flat table's definition: the query columns, with their types, then one text column per extras key (given
+    as key -> column name)"""
+    columns = [Column(column.name, column.type) for column in get_columns()]
+    columns += [Column(name, UnicodeText) for name in extras_columns.values()]
+    table = Table(FLAT_TABLENAME, MetaData(), *columns)
+    for names in INDEXED_COLUMNS:
+        Index(f'ix_flat_{"_".join(name.replace(".", "_") for name in names)}', *[table.c[name] for name in names])
+    return table
+
+
+def get_flat_select(extras_columns: Dict[str, str], study_id: Optional[int] = None):
+    """The denormalised join (of one study, or all) with the extras pivoted into one column per key in SQLite: a single
+    outer join to the extras grouped by measurement, with a MAX(CASE ...) per key. (A join per key would run into
+    SQLite's limit of 64 tables in a join.)"""
+    statement = get_select_statement()
+    if study_id is not None:
+        statement = statement.where(Study.id == study_id)
+    if not extras_columns:
+        return statement
+    data = MeasurementData.__table__
+    pivot = select(data.c.measurement_id, *[func.max(case((data.c.key == key, data.c.datum))).label(name)
+                                            for key, name in extras_columns.items()])
+    if study_id is not None:
+        pivot = pivot.where(data.c.measurement_id.in_(
+            select(Measurement.id).join(Biological_replica).join(Group).where(Group.study_id == study_id)))
+    pivot = pivot.group_by(data.c.measurement_id).subquery()
+    return statement.outerjoin(pivot, pivot.c.measurement_id == Measurement.id)\
+        .add_columns(*[pivot.c[name] for name in extras_columns.values()])
+
+
+def name_extras_columns(keys, extras_columns: Dict[str, str]) -> Dict[str, str]:
+    """Adds column names for the new keys to extras_columns, unique ignoring case (as SQLite compares them)"""
+    taken = {name.lower() for name in extras_columns.values()}
+    for key in keys:
+        if key in extras_columns:
+            continue
+        name, number = f'{EXTRAS_PREFIX}{key}', 1
+        while name.lower() in taken:
+            number += 1
+            name = f'{EXTRAS_PREFIX}{key}~{number}'
+        taken.add(name.lower())
+        extras_columns[key] = name
+    return extras_columns
+
+
+def get_flat_extras(connection) -> Dict[str, str]:
+    """The flat table's extras columns as key -> column name. Flat tables built before flat_extras existed have a
+    column named for each key."""
+    if inspect(connection).has_table(FLAT_EXTRAS_TABLENAME):
+        return dict(connection.execute(text(f'SELECT key, name FROM {FLAT_EXTRAS_TABLENAME} ORDER BY key')).all())
+    names = [column['name'] for column in inspect(connection).get_columns(FLAT_TABLENAME)]
+    return {name[len(EXTRAS_PREFIX):]: name for name in names if name.startswith(EXTRAS_PREFIX)}
+
+
+def add_flat_extras(connection, extras_columns: Dict[str, str]):
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS {FLAT_EXTRAS_TABLENAME} '
+                            f'(key TEXT PRIMARY KEY, name TEXT NOT NULL)'))
+    if extras_columns:
+        connection.execute(text(f'INSERT OR REPLACE INTO {FLAT_EXTRAS_TABLENAME} (key, name) VALUES (:key, :name)'),
+                           [{'key': key, 'name': name} for key, name in extras_columns.items()])
+
+
+def rebuild_flat(connection) -> int:
+    """(Re)creates the flat table from scratch and marks it fresh. Returns the number of rows."""
+    extras_columns = name_extras_columns(get_extras_keys(connection), dict())
+    connection.execute(text(f'DROP TABLE IF EXISTS "{FLAT_TABLENAME}"'))
+    connection.execute(text(f'DROP TABLE IF EXISTS {FLAT_EXTRAS_TABLENAME}'))
+    table = get_flat_table(extras_columns)
+    table.create(connection)
+    add_flat_extras(connection, extras_columns)
+    connection.execute(insert(table).from_select([c.name for c in table.columns], get_flat_select(extras_columns)))
+    set_flat_generation(connection, get_generation(connection))
+    return connection.execute(select(func.count()).select_from(table)).scalar()
+
+
+def append_study(connection, study_id: int, generation_before: int):
+    """Adds the rows of a newly inserted study to the flat table, if the table was fresh before the study was added
+    (otherwise it stays stale until rebuilt). New extras keys become new columns."""
+    if get_flat_generation(connection) != generation_before:
+        return
+    extras_columns = get_flat_extras(connection)
+    extras_keys = list(connection.execute(
+        select(MeasurementData.key).distinct().order_by(MeasurementData.key)
+        .join(Measurement).join(Biological_replica).join(Group).where(Group.study_id == study_id)
+    ).scalars())
+    new_columns = {key: name for key, name in name_extras_columns(extras_keys, dict(extras_columns)).items()
+                   if key not in extras_columns}
+    quote = connection.dialect.identifier_preparer.quote
+    for name in new_columns.values():
+        connection.execute(text(f'ALTER TABLE "{FLAT_TABLENAME}" ADD COLUMN {quote(name)} TEXT'))
+    add_flat_extras(connection, new_columns)
+    study_columns = {key: name for key, name in {**extras_columns, **new_columns}.items() if key in extras_keys}
+    table = get_flat_table(study_columns)
+    statement = get_flat_select(study_columns, study_id)
+    connection.execute(insert(table).from_select([c.name for c in table.columns], statement))
+    set_flat_generation(connection, get_generation(connection))
+
+
+def get_flat_generation(connection) -> Optional[int]:
+    """The database generation the flat table was last brought up to date with, None if there is no flat table"""
+    if not inspect(connection).has_table(FLAT_STATE_TABLENAME):
+        return None
+    return connection.execute(text(f'SELECT generation FROM {FLAT_STATE_TABLENAME}')).scalar()
+
+
+def set_flat_generation(connection, generation: int):
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS {FLAT_STATE_TABLENAME} (generation INTEGER NOT NULL)'))
+    connection.execute(text(f'DELETE FROM {FLAT_STATE_TABLENAME}'))
+    connection.execute(text(f'INSERT INTO {FLAT_STATE_TABLENAME} (generation) VALUES (:generation)'),
+                       {'generation': generation})
+
+
+def is_flat_fresh(connection) -> bool:
+    return get_flat_generation(connection) == get_generation(connection)
+
+
+def get_flat_where(session, sql_where):
+    """The flat table, the filter compiled against its columns and the extras columns (key -> column name), or None
+    if the flat table isn't fresh"""
+    connection = session.connection()
+    if not is_flat_fresh(connection):
+        return None
+    parsed = parse_filter(sql_where)
+    check_extras_keys(parsed, lambda: get_extras_keys(session))
+    extras_columns = get_flat_extras(connection)
+    table = get_flat_table(extras_columns)
+
+    def compile_predicate(predicate):
+        reference = predicate.reference
+        if reference.column is not None:
+            column = table.c[f'{reference.table}.{reference.column}']
+            return compare(column, predicate, column.type)
+        column = table.c[extras_columns[reference.key]]
+        return compare(extras_datum(predicate, column), predicate)
+
+    return table, compile_filter(parsed, compile_predicate), extras_columns
+
+
+def get_flat_records(session, statement, flatten: bool, extras_columns: Dict[str, str]) -> pd.DataFrame:
+    """The flat rows in the same form as database.get_records: extras as measurement.data dicts, or if flatten as
+    measurement.data_* columns sorted by key, leaving out keys none of the rows have"""
+    result = session.execute(statement)
+    records = pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()))
+    records = records.rename(columns={name: f'{EXTRAS_PREFIX}{key}' for key, name in extras_columns.items()})
+    extras_columns = sorted(c for c in records.columns if c.startswith(EXTRAS_PREFIX))
+    core = records.drop(columns=extras_columns)
+    if flatten:
+        return pd.concat([core, records[[c for c in extras_columns if records[c].notna().any()]]], axis=1)
+    core['measurement.data'] = [
+        {column[len(EXTRAS_PREFIX):]: datum for column, datum in zip(extras_columns, row) if pd.notna(datum)}
+        for row in records[extras_columns].itertuples(index=False, name=None)]
+    return core
+
+
+def get_filtered_flat(session, sql_where, flatten=False) -> Optional[pd.DataFrame]:
+    """database.get_filtered run against the flat table, or None if the flat table isn't fresh"""
+    flat_where = get_flat_where(session, sql_where)
+    if flat_where is None:
+        return None
+    table, where, extras_columns = flat_where
+    return get_flat_records(session, select(table).where(where), flatten, extras_columns)
+
+
+def count_filtered_flat(session, sql_where) -> Optional[int]:
+    flat_where = get_flat_where(session, sql_where)
+    if flat_where is None:
+        return None
+    table, where, _ = flat_where
+    return session.execute(select(func.count()).select_from(table).where(where)).scalar()
+
+
+def get_filtered_page_flat(session, sql_where, offset=0, limit=DEFAULT_PAGE_SIZE, order_by=None, descending=False,
+                           flatten=False, total=None) -> Optional[Tuple[int, pd.DataFrame]]:
+    """database.get_filtered_page run against the flat table, or None if the flat table isn't fresh"""
+    flat_where = get_flat_where(session, sql_where)
+    if flat_where is None:
+        return None
+    table, where, extras_columns = flat_where
+    if total is None:
+        total = session.execute(select(func.count()).select_from(table).where(where)).scalar()
+    ordering = [table.c[order_by]] if order_by in get_core_headers() else []
+    if descending:
+        ordering = [column.desc() for column in ordering]
+    ordering += [table.c[name] for name in ('study.id', 'group.id', 'biological_replica.id', 'measurement.id')]
+    statement = select(table).where(where).order_by(*ordering).offset(offset).limit(limit)
+    return total, get_flat_records(session, statement, flatten, extras_columns)
@@ -1,103 +1,349 @@
 """Functions related to reading the Excel file for an experimental study and creating a Study, and related, objects to
 save to the database"""
+import concurrent.futures
 import datetime
+import io
+import logging
+import os
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import openpyxl
 import pandas as pd
+from sqlalchemy import insert
 
-from cm3d.model import Biological_replica, Group, Measurement, Study
+from cm3d.flat import append_study
+from cm3d.model import (Biological_replica, Group, Measurement,
+                        MeasurementData, Study, bump_generation,
+                        get_generation, store_file)
+
+# worksheet column -> model attribute, for each worksheet. Columns missing from a worksheet are left empty.
+STUDY_COLUMNS = {'Study title': 'title', 'Author': 'authors'}
+GROUP_COLUMNS = {'Model': 'model',
+                 'Study duration': 'duration',
+                 'Protein treatment': 'protein_treatment',
+                 'Additional suplementation': 'additional_suplementation'}
+BIOLOGICAL_REPLICA_COLUMNS = {'Cell name': 'cell_name',
+                              'Cell line origin': 'cell_origin',
+                              'Receptor expression': 'receptor_expression',
+                              'Media composition': 'media_composition',
+                              'Passage number': 'passage_number',
+                              'Morphology': 'morphology',
+                              'Patient characteristics': 'patient_characteristics'}
+MEASUREMENT_COLUMNS = {'Method': 'method',
+                       'Timepoint': 'time_point',
+                       'Value': 'value',
+                       'Units': 'unit',
+                       'Measurement': 'measurement',
+                       'Morphological information': 'morphological_information',
+                       'Analysis workflow': 'analysis_workflow',
+                       'Notes': 'notes'}
+# Test- worksheet columns that are not extra measurement data
+MEASUREMENT_CORE_COLUMNS = set(MEASUREMENT_COLUMNS) | {'Biological replica'}
+# the column that must be filled in for a row to be read, for each worksheet (Test- worksheets: Biological replica)
+FIRST_COLUMNS = {'Study': 'Study title', 'Groups': 'Group', 'Biological replicas': 'Biological replica'}
+
+logger = logging.getLogger(__name__)
 
 
 def load_all(workbook):
     """Given the experimental study Excel workbook, creates the Study, Groups, Biological replica and Measurement objects"""
-    study = create_study(workbook['Study'])
-    groups = create_groups(workbook['Groups'], study)
-    biological_replicas = add_biological_replicas(workbook['Biological replicas'], groups)
-    add_measurements(workbook, biological_replicas)
+    records = parse_workbook(workbook)
+    study = Study(**records['study'])
+    groups = {row.pop('group'): Group(study=study, **row) for row in records['groups']}
+    biological_replicas = {row.pop('biological_replica'): Biological_replica(group=groups[row.pop('group')], **row)
+                           for row in records['biological_replicas']}
+    measurements = [Measurement(biological_replica=biological_replicas[row.pop('biological_replica')], **row)
+                    for row in records['measurements']]
+    for row in records['measurement_data']:
+        measurements[row['measurement']][row['key']] = row['datum']
     return study
 
 
-def create_study(sheet):
-    """Reads single row in the Study worksheet and creates the Study object"""
-    # only single row
-    study = Study(title=sheet['Study title'][0],
-                  authors=sheet['Author'][0])
-    study.date_input = datetime.date.today()
-    return study
+def parse_workbook(workbook) -> Dict:
+    """Converts the worksheets of the study workbook, whole sheets at a time, into the rows to insert for each table.
+    Groups and biological replicas are identified by their number in the worksheet; the extra measurement data refers
+    to measurements by their position in the measurements list."""
+    study = sheet_rows(workbook['Study'], 'Study title', STUDY_COLUMNS)
+    if not len(study):
+        raise ValueError('Study worksheet has no study title')
+    groups = sheet_rows(workbook['Groups'], 'Group', GROUP_COLUMNS, keys={'Group': 'group'})
+    biological_replicas = sheet_rows(workbook['Biological replicas'], 'Biological replica', BIOLOGICAL_REPLICA_COLUMNS,
+                                     keys={'Biological replica': 'biological_replica', 'Group': 'group'})
+    check_references(biological_replicas, 'group', groups, 'Biological replica', 'Group')
 
+    measurements, measurement_data = list(), list()
+    for name, sheet in workbook.items():
+        # sheets beginning with "Test-" contain measurements
+        if not name.startswith('Test-'):
+            continue
+        rows = sheet_rows(sheet, 'Biological replica', MEASUREMENT_COLUMNS,
+                          keys={'Biological replica': 'biological_replica'})
+        check_references(rows, 'biological_replica', biological_replicas, name, 'Biological replica')
+        rows['test_type'] = name[5:]
+        # any other columns are extra measurement data: melt them into (measurement, key, datum) in one go
+        extras = sheet.iloc[:len(rows)][[c for c in sheet.columns if c not in MEASUREMENT_CORE_COLUMNS]]
+        extras.index = range(len(measurements), len(measurements) + len(rows))
+        extras = extras.melt(ignore_index=False, var_name='key', value_name='datum').dropna(subset=['datum'])
+        extras['measurement'] = extras.index
+        measurements.extend(to_records(rows))
+        measurement_data.extend(to_records(extras.sort_values('measurement', kind='stable')))
+
+    study_row = to_records(study.iloc[:1])[0]
+    study_row['date_input'] = datetime.date.today()
+    return {'study': study_row,
+            'groups': to_records(groups),
+            'biological_replicas': to_records(biological_replicas),
+            'measurements': measurements,
+            'measurement_data': measurement_data}
+
+
+def sheet_rows(sheet: pd.DataFrame, first_column: str, columns: Dict[str, str], keys=None) -> pd.DataFrame:
+    """The rows of the worksheet before the first row with an empty first_column, with the worksheet columns renamed to
+    model attributes. Key columns (group and biological replica numbers) are converted to integers."""
+    keys = keys or dict()
+    blank = sheet[first_column].isna().to_numpy()
+    rows = sheet.iloc[:blank.argmax() if blank.any() else len(sheet)]
+    rows = rows.reindex(columns=list(keys) + list(columns)).rename(columns=keys | columns)
+    for key in keys.values():
+        rows[key] = rows[key].astype('int64')
+    return rows
+
+
+def check_references(rows: pd.DataFrame, column: str, parents: pd.DataFrame, sheet_name: str, parent_name: str):
+    missing = set(rows[column]) - set(parents[column])
+    if missing:
+        raise ValueError(f'{sheet_name} worksheet refers to {parent_name} {sorted(missing)} which is not defined')
+
+
+def to_records(rows: pd.DataFrame) -> List[Dict]:
+    """Converts the frame to a list of dicts of plain Python values, with empty cells as None"""
+    return rows.astype(object).where(rows.notna(), None).to_dict('records')
+
+
+def insert_study(session, records: Dict, uploaded_file: bytes, added_by: str) -> int:
+    """Writes the parsed study workbook (see parse_workbook) to the database with bulk Core inserts, one executemany
+    per table, and returns the id of the new study. Also appends the study to the flat table, if there is a fresh one.
+    The caller commits."""
+    connection = session.connection()
+    generation = get_generation(connection)
+    study_id = connection.execute(
+        insert(Study).returning(Study.id),
+        [records['study'] | {'added_by': added_by, 'file_sha256': store_file(connection, uploaded_file)}]
+    ).scalar_one()
+    group_ids = insert_returning_ids(connection, Group, records['groups'], 'group', study_id=study_id)
+    biological_replica_ids = insert_returning_ids(
+        connection, Biological_replica,
+        [row | {'group_id': group_ids[row['group']]} for row in records['biological_replicas']],
+        'biological_replica')
+    measurement_ids = insert_returning_ids(
+        connection, Measurement,
+        [row | {'biological_replica_id': biological_replica_ids[row['biological_replica']]}
+         for row in records['measurements']],
+        None)
+    if records['measurement_data']:
+        connection.execute(insert(MeasurementData), [
+            {'measurement_id': measurement_ids[row['measurement']], 'key': str(row['key']), 'datum': row['datum']}
+            for row in records['measurement_data']])
+    bump_generation(connection)
+    append_study(connection, study_id, generation)
+    return study_id
 
-def create_groups(sheet, study):
-    """Iterates over rows in the Groups worksheet and creates Group objects"""
-    groups = dict()
-    for _, row in sheet.iterrows():
-        # exit at first empty row
-        if pd.isna(row['Group']):
-            break
 
-        sheet_group_id = int(row['Group'])
-        groups[sheet_group_id] = Group(model=row['Model'],
-                                       duration=row['Study duration'],
-                                       protein_treatment=row['Protein treatment'],
-                                       additional_suplementation=row['Additional suplementation'],
-                                       study=study)
-    return groups
-
-
-def add_biological_replicas(sheet, group_lookup):
-    """Iterates over all rows in the Biological replicas worksheet, creates Biological replica objects and associates them with Group"""
-    biological_replicas_lookup = dict()
-    for _, row in sheet.iterrows():
-        # exit loop at the first empty row
-        if pd.isna(row['Biological replica']):
+def insert_returning_ids(connection, model, rows: List[Dict], key, **values) -> Dict:
+    """Inserts the rows with executemany and maps each row's key (or, if key is None, its position) to the new id"""
+    if not rows:
+        return dict()
+    columns = set(model.__table__.c.keys())
+    result = connection.execute(
+        insert(model).returning(model.id, sort_by_parameter_order=True),
+        [{k: v for k, v in (row | values).items() if k in columns} for row in rows]
+    )
+    ids = result.scalars().all()
+    if key is None:
+        return dict(enumerate(ids))
+    return {row[key]: new_id for row, new_id in zip(rows, ids)}
+
+
+def is_study_sheet(name: str) -> bool:
+    return name in FIRST_COLUMNS or name.startswith('Test-')
+
+
+def first_column(name: str) -> str:
+    return FIRST_COLUMNS.get(name, 'Biological replica')
+
+
+def sheet_frame(name: str, rows: Iterable[Sequence]) -> pd.DataFrame:
+    """Builds the worksheet frame from its rows (the first being the header), stopping at the first row with an empty
+    first column, like sheet_rows does"""
+    rows = iter(rows)
+    header = [f'Unnamed: {i}' if column is None else column for i, column in enumerate(next(rows, []))]
+    if first_column(name) not in header:
+        return pd.DataFrame(columns=header)
+    key = header.index(first_column(name))
+    data = list()
+    for row in rows:
+        if len(row) <= key or row[key] is None:
             break
-        # create an biological_replica object for this row
-        new_biological_replica = Biological_replica(cell_name=row['Cell name'],
-                            cell_origin=row['Cell line origin'],
-                            receptor_expression=row['Receptor expression'],
-			    media_composition=row['Media composition'],
-			    passage_number = row['Passage number'],
-                            morphology=row['Morphology'],
-		            patient_characteristics=row['Patient characteristics'],
-                            group=group_lookup[int(row['Group'])])
-        # TODO: handle error if biological_replica is in unspecified/missing group
-        biological_replicas_lookup[int(row['Biological replica'])] = new_biological_replica
-    return biological_replicas_lookup
-
-
-def add_measurements(all_sheets, biological_replicas_lookup):
-    """Looks for all sheets beginning with 'Test-' and parses the Test worksheets, creating Measurement objects and
-    associating them with specified Biological replica"""
-    # loop over each dataframe in the dictionary
-    for name, sheet in all_sheets.items():
-        # if dataframe name starts with "Test-"
-        if name.startswith('Test-'):
-            # this contains measurements - create them and link with biological_replica
-            for _, row in sheet.iterrows():
-                # exit loop at the first empty row
-                if pd.isna(row['Biological replica']):
-                    break
-                measurement = Measurement(
-                    method=row['Method'],
-                    time_point=row['Timepoint'],
-                    value=row['Value'],
-                    unit=row['Units'],
-                    measurement=row['Measurement'],
-                    morphological_information=row['Morphological information'],
-                    analysis_workflow=row['Analysis workflow'],
-		    notes=row['Notes'],
-		    test_type=name[5:],
-                    biological_replica=biological_replicas_lookup[int(row['Biological replica'])])
-                # add any other columns which are not core measurement attributes
-                for column in sheet.columns:
-                    if column not in {'Biological replica', 'Timepoint', 'Method', 'Measurement', 'Value', 'Units', 'Morphological information', 'Analysis workflow', 'Notes'}:
-                        if row[column] is not None and not pd.isna(row[column]):
-                            measurement[column] = row[column]
-
-
-def read_file(filename: str) -> Study:
-    """Reads the Excel file at location given by argument and creates a Study object from contents"""
-    excel_sheet = pd.read_excel(filename, sheet_name=None, index_col=None)
-    study = load_all(excel_sheet)
+        data.append(row)
+    return pd.DataFrame.from_records(data, columns=header)
+
+
+def read_openpyxl(buffer) -> Dict[str, pd.DataFrame]:
+    """Streams the study worksheets with openpyxl in read-only mode"""
+    workbook = openpyxl.load_workbook(buffer, read_only=True, data_only=True)
+    try:
+        return {name: sheet_frame(name, workbook[name].iter_rows(values_only=True))
+                for name in workbook.sheetnames if is_study_sheet(name)}
+    finally:
+        workbook.close()
+
+
+def read_calamine(buffer) -> Dict[str, pd.DataFrame]:
+    """Reads the study worksheets with the (optional) Rust calamine parser"""
+    from python_calamine import CalamineWorkbook
+
+    def cell(value):
+        # calamine gives empty cells as '' and every number as a float
+        if value == '':
+            return None
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    if hasattr(buffer, 'read'):
+        workbook = CalamineWorkbook.from_filelike(buffer)
+    else:
+        workbook = CalamineWorkbook.from_path(str(buffer))
+    return {name: sheet_frame(name, ([cell(value) for value in row]
+                                     for row in workbook.get_sheet_by_name(name).iter_rows()))
+            for name in workbook.sheet_names if is_study_sheet(name)}
+
+
+def read_pandas(buffer) -> Dict[str, pd.DataFrame]:
+    """Parses every worksheet in full with pandas (the original reader)"""
+    return pd.read_excel(buffer, sheet_name=None, index_col=None)
+
+
+READERS = {'calamine': read_calamine, 'openpyxl': read_openpyxl, 'pandas': read_pandas}
+
+
+def get_reader(reader: str = 'auto') -> str:
+    """Resolves 'auto' to calamine if it is installed, otherwise openpyxl"""
+    if reader != 'auto':
+        if reader not in READERS:
+            raise ValueError(f'Unknown reader {reader}, choose from {", ".join(READERS)}')
+        return reader
+    try:
+        import python_calamine  # noqa: F401
+        return 'calamine'
+    except ImportError:
+        return 'openpyxl'
+
+
+def read_workbook(source, reader: str = 'auto') -> Dict[str, pd.DataFrame]:
+    """Reads the study worksheets from an Excel file name or file-like object"""
+    return READERS[get_reader(reader)](source)
+
+
+def read_study_file(filename: str, reader: str = 'auto') -> Tuple[Dict[str, pd.DataFrame], bytes, Dict]:
+    """Reads the Excel file from disk once and parses the worksheets from that in-memory copy. Returns the worksheets,
+    the file contents (to store with the study) and the parse statistics: reader, seconds and peak_memory_growth
+    (bytes the parse raised the process' peak resident set size by: 0 if it stayed within an earlier peak, e.g. of a
+    previous upload in the same worker, and None where the platform doesn't report it)."""
     with open(filename, 'rb') as excel_file:
-        binary_data = excel_file.read()
-    study.uploaded_file = binary_data
+        content = excel_file.read()
+    reader = get_reader(reader)
+    peak_before = get_peak_memory()
+    start = time.perf_counter()
+    workbook = read_workbook(io.BytesIO(content), reader)
+    seconds = time.perf_counter() - start
+    growth = None if peak_before is None else get_peak_memory() - peak_before
+    stats = {'reader': reader, 'seconds': seconds, 'peak_memory_growth': growth}
+    logger.info('Parsed %s with %s in %.2fs, peak memory growth %s', filename, reader, seconds,
+                'n/a' if growth is None else f'{growth / 2 ** 20:.1f} MiB')
+    return workbook, content, stats
+
+
+def get_peak_memory() -> Optional[int]:
+    """Peak resident set size of this process so far in bytes. tracemalloc would isolate the parse but slows it
+    several times over, so uploads report how much parsing raised this (free) high-water mark instead."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def read_file(filename: str, reader: str = 'auto') -> Study:
+    """Reads the Excel file at location given by argument and creates a Study object from contents"""
+    workbook, content, _ = read_study_file(filename, reader)
+    study = load_all(workbook)
+    study.uploaded_file = content
     return study
+
+
+def ingest_file(session, filename: str, added_by: str, reader: str = 'auto') -> Tuple[int, Dict]:
+    """Reads the Excel file at location given by argument and adds the study to the database. Returns the id of the
+    new study and the parse statistics."""
+    workbook, content, stats = read_study_file(filename, reader)
+    return insert_study(session, parse_workbook(workbook), content, added_by), stats
+
+
+def parse_study_file(filename: str, reader: str = 'auto') -> Tuple[Dict, bytes, Dict]:
+    """Reads and parses the Excel file, returning the rows to insert (see parse_workbook), the file contents and the
+    parse statistics. A module level function so it can run in a worker process."""
+    workbook, content, stats = read_study_file(filename, reader)
+    return parse_workbook(workbook), content, stats
+
+
+def begin_batch(session):
+    """Starts the batch's transaction, if not already in one. pysqlite doesn't begin a transaction before a SAVEPOINT,
+    which then begins one itself, so releasing it would commit each study on its own."""
+    connection = session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN')
+
+
+def ingest_files(session, filenames: List[str], added_by: str, reader: str = 'auto', workers: Optional[int] = None,
+                 batch_size: int = 20) -> Iterator[Tuple[str, Optional[int], Optional[Dict], Optional[Exception]]]:
+    """Parses the Excel files in a process pool and inserts them from this (the only writing) process, committing every
+    batch_size studies. Yields (filename, study_id, records, None) for each study added and (filename, None, None,
+    error) for each file that could not be parsed or inserted, in the order they finish, without stopping the batch.
+    Only a few files per worker are parsed ahead of the writer, to bound memory."""
+    workers = workers or os.cpu_count() or 1
+    pending_files = iter(filenames)
+    added = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = dict()
+
+        def submit_next():
+            for filename in pending_files:
+                in_flight[executor.submit(parse_study_file, filename, reader)] = filename
+                return
+
+        for _ in range(2 * workers):
+            submit_next()
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                filename = in_flight.pop(future)
+                submit_next()
+                try:
+                    records, content, _ = future.result()
+                    begin_batch(session)
+                    # a savepoint, so a failed insert only undoes this study and not the rest of the batch
+                    with session.begin_nested():
+                        study_id = insert_study(session, records, content, added_by)
+                except Exception as error:
+                    logger.warning('Could not add %s: %s', filename, error)
+                    yield filename, None, None, error
+                    continue
+                added += 1
+                if added % batch_size == 0:
+                    session.commit()
+                yield filename, study_id, records, None
+    session.commit()
@@ -0,0 +1,167 @@
+"""Opt-in request instrumentation for the web app (cm3d-cli web --instrument). Each response gets a Server-Timing
+header splitting the request's time into SQL (with the number of statements), template rendering and the rest (the
+app's own Python: DataFrames, JSON, ...). Statements slower than a threshold are logged with their EXPLAIN QUERY PLAN,
+and requests slower than another threshold can be profiled, with cProfile or (if installed) pyinstrument, into a
+directory of profiles. Only one request is profiled at a time (Python 3.12+ allows one active profiler per process), so
+concurrent requests go unprofiled. SQL time is measured by SQLite's execute, i.e. up to the first row."""
+import cProfile
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+
+from cm3d.utils import get_timestamp
+
+SLOW_QUERY_MS = 200
+PROFILERS = ['cprofile', 'pyinstrument']
+
+logger = logging.getLogger(__name__)
+
+# running totals across all requests
+totals: Dict[str, float] = {'requests': 0, 'statements': 0, 'slow_statements': 0, 'sql_seconds': 0.0,
+                            'profiles': 0}
+_totals_lock = threading.Lock()
+# held while a request is being profiled
+_profile_lock = threading.Lock()
+
+
+def add_totals(**values):
+    with _totals_lock:
+        for key, value in values.items():
+            totals[key] += value
+
+
+def explain(cursor, statement, parameters) -> str:
+    """SQLite's query plan for the statement, one step per line, using a new cursor on the same DBAPI connection"""
+    try:
+        plan = cursor.connection.cursor().execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+    except Exception as error:
+        return f'(no plan: {error})'
+    return '\n'.join(f'  {row[-1]}' for row in plan)
+
+
+def instrument_engine(engine, slow_query_ms=SLOW_QUERY_MS):
+    """Times and counts every statement the engine runs, adding them to the current request's timings and logging
+    the slow ones with their query plan"""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        slow = elapsed * 1000 >= slow_query_ms
+        add_totals(statements=1, slow_statements=int(slow), sql_seconds=elapsed)
+        if has_request_context() and 'timings' in g:
+            g.timings['sql'] += elapsed
+            g.timings['statements'] += 1
+        if slow:
+            plan = explain(cursor, statement, parameters) if statement.lstrip()[:6].upper() == 'SELECT' else ''
+            logger.warning('Slow query (%.0fms%s): %s %s\n%s', elapsed * 1000,
+                           f' in {request.path}' if has_request_context() else '', statement, parameters, plan)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def instrument(app, engines: Iterable, slow_query_ms=SLOW_QUERY_MS, profile_ms: Optional[float] = None,
+               profile_dir: Path = Path('profiles'), profiler='cprofile'):
+    """Adds the Server-Timing header to every response of the app, timing the SQL of the given engines. With
+    profile_ms, every request is profiled and the profiles of those taking at least profile_ms are saved in
+    profile_dir."""
+    for engine in engines:
+        instrument_engine(engine, slow_query_ms)
+    if profile_ms is not None:
+        if profiler == 'pyinstrument':
+            try:
+                import pyinstrument  # noqa: F401
+            except ImportError:
+                raise RuntimeError('Profiling with pyinstrument needs it installed: pip install pyinstrument') \
+                    from None
+        Path(profile_dir).mkdir(exist_ok=True)
+
+    def start_request():
+        g.timings = {'start': time.perf_counter(), 'sql': 0.0, 'statements': 0, 'render': 0.0}
+        if profile_ms is not None and _profile_lock.acquire(blocking=False):
+            try:
+                g.profiler = start_profiler(profiler)
+            except BaseException:
+                _profile_lock.release()
+                raise
+
+    def finish_request(response):
+        if 'timings' not in g:
+            return response
+        timings = g.timings
+        total = time.perf_counter() - timings['start']
+        add_totals(requests=1)
+        response.headers['Server-Timing'] = ', '.join([
+            f'sql;dur={timings["sql"] * 1000:.1f};desc="{timings["statements"]} statements"',
+            f'render;dur={timings["render"] * 1000:.1f}',
+            f'app;dur={max(total - timings["sql"] - timings["render"], 0) * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}'
+        ])
+        if 'profiler' in g:
+            try:
+                filename = stop_profiler(g.pop('profiler'), total * 1000 >= profile_ms, Path(profile_dir))
+            finally:
+                _profile_lock.release()
+            if filename is not None:
+                add_totals(profiles=1)
+                logger.warning('Profiled %s %s (%.0fms): %s', request.method, request.path, total * 1000, filename)
+        return response
+
+    def abandon_profile(exception):
+        # a request that raised skips after_request
+        if 'profiler' in g:
+            try:
+                stop_profiler(g.pop('profiler'), False, Path(profile_dir))
+            finally:
+                _profile_lock.release()
+
+    def start_render(sender, template, context, **extra):
+        if 'timings' in g:
+            g.render_start = time.perf_counter()
+
+    def finish_render(sender, template, context, **extra):
+        if 'render_start' in g:
+            g.timings['render'] += time.perf_counter() - g.pop('render_start')
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(abandon_profile)
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(finish_render, app, weak=False)
+
+
+def start_profiler(profiler: str):
+    if profiler == 'pyinstrument':
+        import pyinstrument
+        profile = pyinstrument.Profiler()
+        profile.start()
+        return profile
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stop_profiler(profile, keep: bool, profile_dir: Path) -> Optional[Path]:
+    """Stops the profiler and, if keep, saves the profile: pstats for cProfile (snakeviz, python -m pstats), HTML for
+    pyinstrument. Returns the file name."""
+    endpoint = (request.endpoint or 'unknown').replace('/', '_')
+    if isinstance(profile, cProfile.Profile):
+        profile.disable()
+        if not keep:
+            return None
+        filename = profile_dir / f'{get_timestamp()}_{endpoint}_{threading.get_ident()}.prof'
+        profile.dump_stats(filename)
+        return filename
+    profile.stop()
+    if not keep:
+        return None
+    filename = profile_dir / f'{get_timestamp()}_{endpoint}_{threading.get_ident()}.html'
+    filename.write_text(profile.output_html())
+    return filename
@@ -0,0 +1,134 @@
+"""Background ingestion of uploaded study spreadsheets, so the web request that uploads a file returns immediately.
+Spreadsheets are parsed in a worker process, away from the web server's threads (and the GIL), then inserted by a
+single writer thread, one study at a time. With several web server processes (cm3d-cli web --workers), job statuses
+are also written to a directory, so any process can answer a status request."""
+import concurrent.futures
+import concurrent.futures.process
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+from cm3d import metrics
+from cm3d.connection import RWSession
+from cm3d.ingest import insert_study, parse_study_file
+
+# job states, in order
+PARSING = 'parsing'
+INSERTING = 'inserting'
+DONE = 'done'
+FAILED = 'failed'
+# finished jobs are forgotten, oldest first, beyond this many
+MAX_JOBS = 200
+
+logger = logging.getLogger(__name__)
+
+_jobs: Dict[str, Dict] = OrderedDict()
+_lock = threading.Lock()
+_parser: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_writer: Optional[concurrent.futures.ThreadPoolExecutor] = None
+# set by share_statuses
+_status_dir: Optional[Path] = None
+
+
+def share_statuses(directory: Optional[Path]):
+    """Writes job statuses to <job id>.job.json files in the directory, and looks up jobs other processes started
+    there. The files are deleted by the retention sweeper with the uploads (see cm3d.retention)."""
+    global _status_dir
+    _status_dir = None if directory is None else Path(directory)
+
+
+def get_executors(parse_workers: int = 1):
+    """The parsing process pool and the writer thread, created on first use. Worker processes are spawned rather than
+    forked, as the web server has threads running."""
+    global _parser, _writer
+    with _lock:
+        if _parser is None:
+            _parser = concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers,
+                                                             mp_context=multiprocessing.get_context('spawn'))
+        if _writer is None:
+            _writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='cm3d-writer')
+    return _parser, _writer
+
+
+def replace_parser(broken: concurrent.futures.ProcessPoolExecutor):
+    """Drops the broken parsing pool, so get_executors creates a new one (unless another thread already has)"""
+    global _parser
+    with _lock:
+        if _parser is broken:
+            _parser = None
+    broken.shutdown(wait=False)
+
+
+def submit_upload(filename: str, added_by: str, session_factory=RWSession) -> str:
+    """Queues the Excel file to be parsed and added to the database. Returns the job id to look up with get_job."""
+    parser, writer = get_executors()
+    job_id = uuid.uuid4().hex
+    set_job(job_id, filename=str(filename), added_by=added_by, state=PARSING, study_id=None, stats=None, error=None)
+    try:
+        future = parser.submit(parse_study_file, str(filename))
+    except concurrent.futures.process.BrokenProcessPool:
+        # a worker died (e.g. killed running out of memory), which leaves the pool unusable: start a new one
+        logger.warning('Parser pool broken, starting a new one')
+        replace_parser(parser)
+        parser, writer = get_executors()
+        future = parser.submit(parse_study_file, str(filename))
+    # hand the parsed rows to the writer thread, rather than inserting in the callback's (parser management) thread
+    future.add_done_callback(lambda parsed: writer.submit(insert_parsed, job_id, parsed, str(filename), added_by,
+                                                          session_factory))
+    return job_id
+
+
+def insert_parsed(job_id: str, parsed: concurrent.futures.Future, filename: str, added_by: str, session_factory):
+    """Runs in the writer thread: adds the study parsed by the job, or records why it failed"""
+    try:
+        records, content, stats = parsed.result()
+        metrics.UPLOAD_PARSE_SECONDS.observe(stats['seconds'])
+        set_job(job_id, state=INSERTING, stats=stats)
+        with metrics.UPLOAD_INSERT_SECONDS.time(), session_factory() as session:
+            study_id = insert_study(session, records, content, added_by)
+            session.commit()
+    except Exception as error:
+        logger.warning('Upload %s failed: %s', job_id, error)
+        set_job(job_id, state=FAILED, error=str(error))
+        metrics.UPLOADS.inc(FAILED)
+        return
+    set_job(job_id, state=DONE, study_id=study_id)
+    metrics.UPLOADS.inc(DONE)
+    # the spreadsheet is in the database now; failed uploads are left for the retention sweeper (see cm3d.retention)
+    Path(filename).unlink(missing_ok=True)
+
+
+def set_job(job_id: str, **values):
+    with _lock:
+        _jobs.setdefault(job_id, dict(id=job_id)).update(values)
+        job = dict(_jobs[job_id])
+        finished = (i for i, j in list(_jobs.items()) if j.get('state') in (DONE, FAILED))
+        for oldest in finished:
+            if len(_jobs) <= MAX_JOBS:
+                break
+            del _jobs[oldest]
+        # under the lock, so an older status can't overwrite a newer one on disk
+        if _status_dir is not None:
+            path = _status_dir / f'{job_id}.job.json'
+            path.with_suffix('.tmp').write_text(json.dumps(job, default=str))
+            os.replace(path.with_suffix('.tmp'), path)
+
+
+def get_job(job_id: str) -> Optional[Dict]:
+    """A copy of the job's current status, None for an unknown job"""
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    if _status_dir is not None and job_id.isalnum():
+        try:
+            return json.loads((_status_dir / f'{job_id}.job.json').read_text())
+        except FileNotFoundError:
+            pass
+    return None
@@ -0,0 +1,187 @@
+"""An in-process registry of operational metrics, served by the web app on /metrics in the Prometheus text format.
+Counters and histograms are plain numbers updated under a lock, so recording costs a dictionary lookup and an addition;
+gauges are read from callbacks only when scraped."""
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# seconds, from a fast page to a slow export
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (0, 10, 100, 1000, 10_000, 100_000, 1_000_000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = dict()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f'{self.name}{format_labels(self.labels, key)} {format_number(value)}'
+                                for key, value in values]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last one +Inf), sum]
+        self._values: Dict[Tuple, List] = dict()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def time(self, *label_values):
+        """A context manager observing the seconds its block takes"""
+        return Timer(self, label_values)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = self.header()
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else format_number(bound))
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_number(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, label_values: Tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Gauge(Metric):
+    """A value read from a callback when the metrics are collected. The callback returns a number, or a dict of
+    label value tuples to numbers. With kind='counter' it exposes a total kept elsewhere, e.g. cache hits."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function: Callable, labels=(), kind='gauge'):
+        super().__init__(name, documentation, labels)
+        self.function = function
+        self.kind = kind
+
+    def collect(self) -> List[str]:
+        try:
+            value = self.function()
+        except Exception:
+            # e.g. the waitress server isn't running: leave the gauge out rather than fail the scrape
+            return []
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        return self.header() + [f'{self.name}{format_labels(self.labels, key)} {format_number(number)}'
+                                for key, number in values]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = dict()
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, function, labels=(), kind='gauge') -> Gauge:
+        return self.register(Gauge(name, documentation, function, labels, kind))
+
+    def exposition(self) -> str:
+        """All the metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(line + '\n' for metric in metrics for line in metric.collect())
+
+
+registry = Registry()
+
+REQUESTS = registry.counter('cm3d_http_requests_total', 'HTTP requests by route, method and status',
+                            ['route', 'method', 'status'])
+REQUEST_SECONDS = registry.histogram('cm3d_http_request_duration_seconds',
+                                     'Time to the response (before any streamed body) by route', ['route'])
+UPLOAD_PARSE_SECONDS = registry.histogram('cm3d_upload_parse_seconds', 'Time parsing uploaded spreadsheets')
+UPLOAD_INSERT_SECONDS = registry.histogram('cm3d_upload_insert_seconds', 'Time adding parsed uploads to the database')
+UPLOADS = registry.counter('cm3d_uploads_total', 'Finished uploads by outcome', ['state'])
+QUERY_ROWS = registry.histogram('cm3d_query_rows', 'Records matched per query, by kind', ['kind'], ROWS_BUCKETS)
+EXPORT_BYTES = registry.counter('cm3d_export_bytes_total', 'Bytes of downloads and exports sent, by kind', ['kind'])
+CONNECTION_WAIT_SECONDS = registry.histogram('cm3d_db_connection_wait_seconds',
+                                             'Time to get a database connection from the pool, by engine',
+                                             ['engine'], (0.0001, 0.001, 0.01, 0.1, 1, 10))
+
+
+def time_connections(engine, name: str):
+    """Observes how long the engine's connect() waits for a pooled (or new) connection"""
+    connect = engine.connect
+
+    def timed_connect(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return connect(*args, **kwargs)
+        finally:
+            CONNECTION_WAIT_SECONDS.observe(time.perf_counter() - start, name)
+
+    engine.connect = timed_connect
+    return engine
@@ -0,0 +1,54 @@
+"""Brings an existing database up to the current schema in place. Besides adding tables, columns and indexes, this
+moves the uploaded spreadsheets out of the study table into study_file, so back the database up first (backup-db)"""
+from typing import List
+
+from sqlalchemy import inspect, text
+
+from cm3d.model import Base, StudyFile, store_file
+
+
+def migrate(engine) -> List[str]:
+    """Creates any missing tables, columns and indexes, moves uploaded files out of the study table, then refreshes
+    the query planner statistics. Safe to run repeatedly. Returns a description of each change applied."""
+    applied = list()
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                # creates the table's indexes too
+                table.create(connection)
+                applied.append(f'created table {table.name}')
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=connection.dialect)
+                    connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column.name} {column_type}'))
+                    applied.append(f'added column {table.name}.{column.name}')
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                if index.name not in existing_indexes:
+                    index.create(connection)
+                    applied.append(f'created index {index.name}')
+        if 'uploaded_file' in {column['name'] for column in inspector.get_columns('study')}:
+            applied.append(f'moved {move_uploaded_files(connection)} uploaded files to {StudyFile.__tablename__}')
+            connection.execute(text('ALTER TABLE study DROP COLUMN uploaded_file'))
+            applied.append('dropped column study.uploaded_file')
+        connection.execute(text('ANALYZE'))
+    if any(change.startswith('dropped') for change in applied):
+        # give the space freed by the dropped blobs back to the file system
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('VACUUM'))
+    return applied
+
+
+def move_uploaded_files(connection) -> int:
+    """Copies each study's uploaded_file blob into the content-addressed study_file table, one blob at a time"""
+    study_ids = connection.execute(text('SELECT id FROM study WHERE uploaded_file IS NOT NULL')).scalars().all()
+    for study_id in study_ids:
+        content = connection.execute(text('SELECT uploaded_file FROM study WHERE id = :id'), {'id': study_id}).scalar()
+        sha256 = store_file(connection, content)
+        connection.execute(text('UPDATE study SET file_sha256 = :sha256, uploaded_file = NULL WHERE id = :id'),
+                           {'sha256': sha256, 'id': study_id})
+    return len(study_ids)
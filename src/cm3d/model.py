@@ -1,5 +1,9 @@
-from sqlalchemy import (Column, Date, Float, ForeignKey, Integer, LargeBinary,
-                        String, Unicode, UnicodeText)
+import hashlib
+
+from sqlalchemy import (Column, Date, Float, ForeignKey, Index, Integer,
+                        LargeBinary, String, Unicode, UnicodeText, event,
+                        select)
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import declarative_base, relationship, validates
 from sqlalchemy.orm.collections import attribute_mapped_collection
@@ -37,23 +41,39 @@ class ProxiedDictMixin:
         del self._proxied[key]
 
 
+def is_public(column: Column) -> bool:
+    """Not binary, nor a storage detail marked info={'internal': True}"""
+    return not isinstance(column.type, LargeBinary) and not column.info.get('internal')
+
+
 def get_csv_headers(clazz: Base):
-    """gets the name of all non-binary columns"""
+    """gets the name of all public (non-binary, non-internal) columns"""
     for column in clazz.__table__.c.keys():
-        if not isinstance(clazz.__table__.c[column].type, LargeBinary):
+        if is_public(clazz.__table__.c[column]):
             yield column
 
 
 def get_csv_row(instance: Base):
-    """get the value of all non-binary columns for this instance"""
+    """get the value of all public (non-binary, non-internal) columns for this instance"""
     for column in instance.__table__.c.keys():
-        if not isinstance(instance.__table__.c[column].type, LargeBinary):
+        if is_public(instance.__table__.c[column]):
             yield getattr(instance, column)
 
 
 class ModelMixin:
     def to_dict(self):
-        return {f'{self.__tablename__}.{c.name}': getattr(self, c.name) for c in self.__table__.columns}
+        """column values keyed by table.column; binary columns are left out so deferred blobs are never loaded"""
+        return {f'{self.__tablename__}.{c}': getattr(self, c) for c in get_csv_headers(self.__class__)}
+
+
+class StudyFile(Base):
+    """The uploaded study spreadsheets, kept out of the study table. Content-addressed by SHA-256, so identical
+    uploads are stored once."""
+    __tablename__ = 'study_file'
+
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer)
+    content = Column(LargeBinary)
 
 
 class Study(Base, ModelMixin):
@@ -64,9 +84,26 @@ class Study(Base, ModelMixin):
     authors = Column(String, nullable=False)
     date_input = Column(Date)
     added_by = Column(String)
-    uploaded_file = Column(LargeBinary)
+    # where the uploaded file is stored, left out of queries and exports like the file itself
+    file_sha256 = Column(String(64), ForeignKey(f'{StudyFile.__tablename__}.sha256'), index=True,
+                         info={'internal': True})
 
     groups = relationship("Group", back_populates="study", cascade="all, delete-orphan")
+    file = relationship("StudyFile")
+
+    @property
+    def uploaded_file(self):
+        """the bytes of the uploaded spreadsheet (loads the blob)"""
+        pending = getattr(self, '_pending_file', None)
+        if pending is not None:
+            return pending
+        return self.file.content if self.file is not None else None
+
+    @uploaded_file.setter
+    def uploaded_file(self, content: bytes):
+        # the blob itself is written (if not already stored) when the study is flushed, see store_uploaded_file
+        self.file_sha256 = hashlib.sha256(content).hexdigest()
+        self._pending_file = content
 
     def __repr__(self):
         return f"Study(id={self.id}, title={self.title}, authors={self.authors}, added_by={self.added_by}, groups=[\n  " + '\n  '.join(str(g) for g in self.groups) + "\n)"
@@ -79,14 +116,56 @@ class Study(Base, ModelMixin):
         return value
 
 
+def store_file(connection, content: bytes) -> str:
+    """Saves the uploaded file in study_file, unless the same content is already stored, and returns its hash"""
+    sha256 = hashlib.sha256(content).hexdigest()
+    connection.execute(
+        insert(StudyFile).values(sha256=sha256, size=len(content), content=content).on_conflict_do_nothing()
+    )
+    return sha256
+
+
+@event.listens_for(Study, 'before_insert')
+@event.listens_for(Study, 'before_update')
+def store_uploaded_file(mapper, connection, study):
+    content = study.__dict__.pop('_pending_file', None)
+    if content is not None:
+        store_file(connection, content)
+
+
+class Generation(Base):
+    """A single counter, bumped whenever a study is added or deleted. Cached query results are keyed on it, so they
+    go stale as soon as the data changes, whichever process changed it."""
+    __tablename__ = 'generation'
+    id = Column(Integer, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+
+def bump_generation(connection):
+    connection.execute(
+        insert(Generation).values(id=1, value=1)
+        .on_conflict_do_update(index_elements=[Generation.id], set_={'value': Generation.value + 1})
+    )
+
+
+def get_generation(connection) -> int:
+    return connection.execute(select(Generation.value).where(Generation.id == 1)).scalar() or 0
+
+
+@event.listens_for(Study, 'after_insert')
+@event.listens_for(Study, 'after_delete')
+def study_changed(mapper, connection, study):
+    bump_generation(connection)
+
+
 class Group(Base, ModelMixin):
     __tablename__ = 'group'
 
     id = Column(Integer, primary_key=True)
-    study_id = Column(Integer, ForeignKey(f'{Study.__tablename__}.id'), nullable=False)
+    study_id = Column(Integer, ForeignKey(f'{Study.__tablename__}.id'), nullable=False, index=True)
     model = Column(String)
     duration = Column(String)
-    protein_treatment = Column(String)
+    protein_treatment = Column(String, index=True)
     additional_suplementation = Column(String)
 
     # Add relationship between study and experiment
@@ -103,8 +182,8 @@ class Biological_replica(Base, ModelMixin):
     __tablename__ = 'biological_replica'
 
     id = Column(Integer, primary_key=True)
-    group_id = Column(Integer, ForeignKey(f'{Group.__tablename__}.id'), nullable=False)
-    cell_name = Column(String)
+    group_id = Column(Integer, ForeignKey(f'{Group.__tablename__}.id'), nullable=False, index=True)
+    cell_name = Column(String, index=True)
     cell_origin = Column(String)
     receptor_expression = Column(String)
     media_composition = Column(String)
@@ -126,15 +205,18 @@ class Biological_replica(Base, ModelMixin):
 
 class Measurement(ProxiedDictMixin, Base):
     __tablename__ = 'measurement'
+    # filters select a measurement and then a range of values: a single index on the value alone is a poor choice
+    __table_args__ = (Index('ix_measurement_measurement_value', 'measurement', 'value'),)
 
     id = Column(Integer, primary_key=True)
-    biological_replica_id = Column(Integer, ForeignKey(f'{Biological_replica.__tablename__}.id'), nullable=False)
+    biological_replica_id = Column(Integer, ForeignKey(f'{Biological_replica.__tablename__}.id'), nullable=False,
+                                   index=True)
     method = Column(String)
     time_point = Column(String)
     measurement = Column(String)
     value = Column(Float)
     unit = Column(String)
-    test_type = Column(String)
+    test_type = Column(String, index=True)
     morphological_information=Column(String)
     analysis_workflow=Column(String)
     notes=Column(String)
@@ -161,6 +243,7 @@ class Measurement(ProxiedDictMixin, Base):
 class MeasurementData(Base):
     __tablename__ = "measurement_data"
 
+    # the composite primary key index (measurement_id, key) also serves lookups by measurement_id
     measurement_id = Column(ForeignKey(f"{Measurement.__tablename__}.id"), primary_key=True)
     key = Column(Unicode(64), primary_key=True)
     datum = Column(UnicodeText)
@@ -0,0 +1,119 @@
+"""Retention of the files the web app leaves in the working directory: query and database downloads in downloads/, and
+uploaded spreadsheets in uploads/ (whose bytes are kept in the database). Files not used for longer than a maximum age
+are deleted, then the least recently used ones until the directory is within its quota. The web server sweeps both
+directories in a background thread; cm3d-cli gc does the same on demand, and also deletes stored spreadsheets no study
+refers to any more."""
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import delete, func, select
+
+from cm3d.model import Study, StudyFile
+
+MAX_AGE_HOURS = float(os.environ.get('CM3D_RETENTION_HOURS', 24))
+MAX_MB = float(os.environ.get('CM3D_RETENTION_MB', 1024))
+SWEEP_MINUTES = float(os.environ.get('CM3D_SWEEP_MINUTES', 10))
+# files used more recently than this are never deleted, as they may still be being written or sent
+GRACE_SECONDS = 300
+# the sweeper's running totals, in the working directory, for web server processes it didn't start in
+RECLAIMED_FILENAME = 'reclaimed.json'
+
+logger = logging.getLogger(__name__)
+
+
+def sweep(directory, max_age_hours=MAX_AGE_HOURS, max_mb=MAX_MB, now: Optional[float] = None) -> Dict[str, int]:
+    """Deletes the files in the directory last used (read or written) more than max_age_hours ago, then the least
+    recently used files until the rest add up to at most max_mb. Returns the number of files and bytes reclaimed."""
+    now = time.time() if now is None else now
+    entries = list()
+    with os.scandir(directory) as scanned:
+        for entry in scanned:
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+    # least recently used first
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    max_bytes = max_mb * 2 ** 20
+    reclaimed = {'files': 0, 'bytes': 0}
+    for last_used, size, path in entries:
+        if now - last_used < GRACE_SECONDS or (now - last_used <= max_age_hours * 3600 and total <= max_bytes):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        else:
+            reclaimed['files'] += 1
+            reclaimed['bytes'] += size
+        total -= size
+    return reclaimed
+
+
+def delete_orphaned_files(session) -> Dict[str, int]:
+    """Deletes the stored spreadsheets no study refers to. Returns the number of files and bytes reclaimed (SQLite
+    reuses the space; VACUUM gives it back to the file system)."""
+    orphaned = ~StudyFile.sha256.in_(select(Study.file_sha256).where(Study.file_sha256.is_not(None)))
+    files, size = session.execute(
+        select(func.count(), func.coalesce(func.sum(func.length(StudyFile.content)), 0)).where(orphaned)
+    ).one()
+    session.execute(delete(StudyFile).where(orphaned))
+    return {'files': files, 'bytes': size}
+
+
+class Sweeper(threading.Thread):
+    """Sweeps the directories every interval minutes until stopped, keeping a running total of what was reclaimed.
+    With a totals_file, the total is also written there after each sweep, for other processes to read with totals()."""
+
+    def __init__(self, directories: Iterable[Path], interval=SWEEP_MINUTES, totals_file: Optional[Path] = None,
+                 **limits):
+        super().__init__(name='cm3d-sweeper', daemon=True)
+        self.directories = list(directories)
+        self.interval = interval
+        self.totals_file = totals_file
+        self.limits = limits
+        self.reclaimed = {'files': 0, 'bytes': 0}
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            for directory in self.directories:
+                try:
+                    reclaimed = sweep(directory, **self.limits)
+                except OSError as error:
+                    logger.warning('Sweeping %s failed: %s', directory, error)
+                    continue
+                if reclaimed['files']:
+                    logger.info('Deleted %d files (%d bytes) from %s', reclaimed['files'], reclaimed['bytes'],
+                                directory)
+                for key, value in reclaimed.items():
+                    self.reclaimed[key] += value
+            if self.totals_file is not None:
+                self.write_totals()
+            if self._stopped.wait(self.interval * 60):
+                return
+
+    def stop(self):
+        self._stopped.set()
+
+    def write_totals(self):
+        try:
+            self.totals_file.with_suffix('.tmp').write_text(json.dumps(self.reclaimed))
+            os.replace(self.totals_file.with_suffix('.tmp'), self.totals_file)
+        except OSError as error:
+            logger.warning('Writing %s failed: %s', self.totals_file, error)
+
+    def totals(self) -> Dict[str, int]:
+        """What has been reclaimed so far, read from the totals_file (if any) so forked processes see the total of
+        the sweeper running in their parent"""
+        if self.totals_file is None:
+            return dict(self.reclaimed)
+        try:
+            return json.loads(self.totals_file.read_text())
+        except (OSError, ValueError):
+            return {'files': 0, 'bytes': 0}
@@ -0,0 +1,104 @@
+"""Serves the web app with waitress: threads in one process, or (with several workers) pre-forked processes each
+running their own waitress threads on a listening socket opened once by the parent, so CPU-bound work (pandas, JSON,
+templates) runs on several cores. The parent only supervises: it restarts workers that die and stops them all on
+SIGINT/SIGTERM. Each worker has its own caches and /metrics; the workers' SQLite pools start empty (see
+cm3d.connection.forget_connections) and are checked before serving."""
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Callable, Optional
+
+from waitress import create_server
+
+from cm3d import jobs
+from cm3d.connection import check_connections
+
+# waitress's defaults, but more threads: a slow download or export holds a thread for as long as it is being sent
+THREADS = 8
+CONNECTION_LIMIT = 100
+CHANNEL_TIMEOUT = 120
+BACKLOG = 1024
+# workers exiting sooner than this after starting aren't restarted
+RESTART_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def serve(app, host='0.0.0.0', port=8080, workers=1, on_start: Optional[Callable] = None, threads=THREADS,
+          connection_limit=CONNECTION_LIMIT, channel_timeout=CHANNEL_TIMEOUT, backlog=BACKLOG):
+    """Runs the app until interrupted. on_start is called once the server is listening, in the serving process with
+    one worker and in the supervising parent with several (for background threads, which a fork would not copy)."""
+    options = dict(threads=threads, connection_limit=connection_limit, channel_timeout=channel_timeout,
+                   backlog=backlog)
+    if workers == 1:
+        # kept on the app, for the waitress gauges on /metrics
+        app.server = create_server(app, host=host, port=port, **options)
+        if on_start is not None:
+            on_start()
+        app.server.run()
+        return
+    if not hasattr(os, 'fork'):
+        raise RuntimeError('Several workers need os.fork, which this platform does not have')
+    listener = socket.create_server((host, port), backlog=backlog)
+    # status requests for an upload may reach a different worker from the one ingesting it
+    jobs.share_statuses(app.config['UPLOAD_FOLDER'])
+    logger.info('Serving on http://%s:%d with %d workers of %d threads', host, port, workers, threads)
+    # pid -> when it started
+    children = dict()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        for _ in range(workers):
+            children[fork_worker(app, listener, options)] = time.monotonic()
+        if on_start is not None:
+            on_start()
+        while children:
+            pid, status = os.wait()
+            status = os.waitstatus_to_exitcode(status)
+            started = children.pop(pid, None)
+            if stopping or started is None:
+                continue
+            if time.monotonic() - started < RESTART_SECONDS:
+                # failing on startup: restarting would only fail again
+                logger.error('Worker %d exited on startup (status %d), stopping', pid, status)
+                stop(None, None)
+                continue
+            logger.warning('Worker %d exited (status %d), starting another', pid, status)
+            children[fork_worker(app, listener, options)] = time.monotonic()
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        listener.close()
+
+
+def fork_worker(app, listener: socket.socket, options: dict) -> int:
+    """Forks a process serving the app on the listening socket. Returns its pid."""
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # waitress closes its connections on SystemExit
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        check_connections()
+        app.server = create_server(app, sockets=[listener], **options)
+        app.server.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except BaseException:
+        logger.exception('Worker %d failed', os.getpid())
+        status = 1
+    finally:
+        # never return into the parent's code
+        os._exit(status)
@@ -0,0 +1,64 @@
+"""Writes a synthetic database of the requested size directly with Core bulk inserts, for benchmarking and for trying
+the application out at production scale (cm3d-cli mock-db)"""
+import datetime
+import hashlib
+import random
+
+from sqlalchemy import func, insert, select
+
+from cm3d.model import (Base, Biological_replica, Group, Measurement,
+                        MeasurementData, Study, StudyFile, bump_generation)
+
+MEASUREMENTS = ['abc', 'def', 'ghi', 'jkl', 'xyz', 'qwe', 'hjk']
+TEST_TYPES = ['Proliferation assay', 'Imono flurecence', 'Protein essay']
+TREATMENTS = ['abc', 'def', 'ghi', 'jkl', 'xyz']
+CELL_NAMES = ['MDDA/MB/231', 'HT-29', 'MCF-7', 'U-87 MG']
+UNITS = ['dimensionless', 'mm', 'g', 'nm']
+
+
+def populate(engine, studies=10, groups_per_study=10, replicas_per_group=10, measurements=1_000_000, extras=1,
+             seed=0) -> int:
+    """Creates the schema if needed and adds studies -> groups -> replicas, spreading the measurements evenly over the
+    replicas. Each measurement gets `extras` extra data items. Ids follow on from any rows already in the database.
+    Returns the id of the last measurement added."""
+    rng = random.Random(seed)
+    Base.metadata.create_all(engine)
+    replicas = studies * groups_per_study * replicas_per_group
+    measurements_per_replica = max(1, measurements // replicas)
+    with engine.begin() as connection:
+        first_study, first_group, first_replica, measurement_id = [
+            connection.execute(select(func.coalesce(func.max(clazz.id), 0))).scalar()
+            for clazz in (Study, Group, Biological_replica, Measurement)]
+        files = [bytes(rng.getrandbits(8) for _ in range(2048)) for _ in range(studies)]
+        connection.execute(insert(StudyFile).prefix_with('OR IGNORE'), [
+            {'sha256': hashlib.sha256(content).hexdigest(), 'size': len(content), 'content': content}
+            for content in files])
+        connection.execute(insert(Study), [
+            {'id': first_study + s, 'title': f'Synthetic study {first_study + s}', 'authors': 'A Author',
+             'added_by': 'benchmark', 'date_input': datetime.date(2020, 1, 1) + datetime.timedelta(days=s),
+             'file_sha256': hashlib.sha256(files[s - 1]).hexdigest()}
+            for s in range(1, studies + 1)])
+        connection.execute(insert(Group), [
+            {'id': first_group + g, 'study_id': first_study + (g - 1) // groups_per_study + 1,
+             'model': f'model {g % 7}', 'protein_treatment': rng.choice(TREATMENTS), 'duration': '4 weeks'}
+            for g in range(1, studies * groups_per_study + 1)])
+        connection.execute(insert(Biological_replica), [
+            {'id': first_replica + r, 'group_id': first_group + (r - 1) // replicas_per_group + 1,
+             'cell_name': rng.choice(CELL_NAMES), 'cell_origin': 'abc', 'passage_number': rng.randint(1, 10)}
+            for r in range(1, replicas + 1)])
+        for replica in range(first_replica + 1, first_replica + replicas + 1):
+            rows, data = [], []
+            for _ in range(measurements_per_replica):
+                measurement_id += 1
+                rows.append({'id': measurement_id, 'biological_replica_id': replica, 'method': 'method',
+                             'time_point': str(rng.randint(1, 48)), 'measurement': rng.choice(MEASUREMENTS),
+                             'value': rng.random() * 10000, 'unit': rng.choice(UNITS),
+                             'test_type': rng.choice(TEST_TYPES)})
+                for key in range(extras):
+                    data.append({'measurement_id': measurement_id, 'key': f'extra{key}', 'datum': str(rng.randint(1, 9))})
+            connection.execute(insert(Measurement), rows)
+            if data:
+                connection.execute(insert(MeasurementData), data)
+        # as with any added study, cached query results and the flat table are now out of date
+        bump_generation(connection)
+    return measurement_id
@@ -73,7 +73,7 @@ def mock_study_worksheets():
 
     collected_sheets = {'Study': study, 'Groups': groups, 'Biological replicas': biological_replicas}
 
-    for sheet in random.biological_replica(['Proliferation assay', 'Imono flurecence', 'Protein essay'], random.randint(1, 3)):
+    for sheet in random.sample(['Proliferation assay', 'Imono flurecence', 'Protein essay'], random.randint(1, 3)):
         measurements = list()
         for m in range(1, random.randint(1, 10)):
             measurement = {
@@ -85,7 +85,7 @@ def mock_study_worksheets():
                            'Units': random.choice(['unit', 'g', 'mm', 'cm', 'nm'])
                        }
             number_of_extras = random.randint(0, 2)
-            for extra in random.biological_replica(['xyz', 'ghi', 'qwe', 'jhk'], k=number_of_extras):
+            for extra in random.sample(['xyz', 'ghi', 'qwe', 'jhk'], k=number_of_extras):
                 measurement[extra] = random.choice(list(range(1, 10)) + [None])
             measurements.append(measurement)
         measurements = pd.DataFrame.from_records(measurements)
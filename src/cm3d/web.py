@@ -1,25 +1,39 @@
-import json
+import datetime
+import numbers
 import os
 import secrets
+import time
 from pathlib import Path
-from typing import List
 
 import pandas as pd
-from flask import (Flask, current_app, flash, redirect, render_template,
-                   request, send_file)
+from flask import (Flask, Response, abort, current_app, flash, jsonify,
+                   redirect, render_template, request, send_file,
+                   stream_with_context)
 from flask_httpauth import HTTPDigestAuth
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import scoped_session
 from werkzeug.utils import secure_filename
 
 from cm3d import (DOWNLOADS_DIRNAME, FILTERS_FILENAME,
-                   INPUT_TEMPLATE_FILENAME, UPLOADS_DIRNAME, USERS_FILENAME)
+                   INPUT_TEMPLATE_FILENAME, UPLOADS_DIRNAME, USERS_FILENAME,
+                   jobs, metrics)
+from cm3d.aggregate import DEFAULT_VALUE, aggregate
+from cm3d.cache import (get_filtered_cached, get_filtered_page_cached,
+                        results)
+from cm3d.config import json_files
 from cm3d.connection import ROSession, RWSession
-from cm3d.database import get_denormalised, get_filtered
-from cm3d.ingest import read_file
-from cm3d.model import Study
+from cm3d.database import (DEFAULT_PAGE_SIZE, get_core_headers,
+                           get_filter_statement, get_study, get_study_file,
+                           get_study_list, iter_blob, stream_csv,
+                           stream_json_lines)
+from cm3d.export import FORMATS, write_columnar
+from cm3d.filters import FilterError
 from cm3d.utils import check_cm3d_setup, get_timestamp
 
 ALLOWED_EXTENSIONS = {'xlsx'}
+# largest page of query results served at once
+MAX_PAGE_SIZE = 1000
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
 
 def index():
@@ -27,67 +41,154 @@ def index():
 
 
 def show_studies():
-    studies: List[Study] = app.session.query(Study).all()
-    return render_template('studies.html', studies=studies)
+    return render_template('studies.html', studies=get_study_list(app.session))
 
 
 def show_study(study_id):
-    study: Study = app.session.get(Study, study_id)
+    study = get_study(app.session, study_id)
+    if study is None:
+        abort(404)
     return render_template('study.html', study=study)
 
 
 def study_download(study_id):
-    study: Study = app.session.get(Study, study_id)
-    study_filename = current_app.config['DOWNLOAD_FOLDER'] / f'study_{study_id}_{get_timestamp()}.xlsx'
-    with open(study_filename, 'wb') as download_excel_file:
-        download_excel_file.write(study.uploaded_file)
-    return send_file(
-        study_filename,
-        as_attachment=True
+    # streamed straight from the study_file table, a chunk at a time - nothing is written to the downloads folder. The
+    # file's sha256 is its ETag, so a repeat download gets a 304 without reading the file.
+    study_file = get_study_file(app.session, study_id)
+    if study_file is None:
+        abort(404)
+    response = Response(
+        stream_with_context(iter_blob(app.session, study_file.rowid)),
+        mimetype=XLSX_MIMETYPE,
+        headers={'Content-Disposition': f'attachment; filename=study_{study_id}_{get_timestamp()}.xlsx',
+                 'Content-Length': str(study_file.size)}
     )
+    response.set_etag(study_file.sha256)
+    if study_file.date_input is not None:
+        response.last_modified = datetime.datetime.combine(study_file.date_input, datetime.time(),
+                                                           tzinfo=datetime.timezone.utc)
+    response = response.make_conditional(request)
+    if response.status_code == 200:
+        metrics.EXPORT_BYTES.inc('study_file', amount=study_file.size)
+    return response
 
 
 def query():
-    filters_filename = current_app.config['WORKING_DIRECTORY'] / FILTERS_FILENAME
-    if filters_filename.is_file():
-        filters = json.load(open(filters_filename))
-    else:
-        filters = {}
+    filters = json_files.load(current_app.config['WORKING_DIRECTORY'] / FILTERS_FILENAME, default={})
 
     sql = request.form.get('sql')
     action = request.form.get('action')
 
     # if we have sql statement
     if sql is not None:
-        # get the records (flatten if it's for downloading)
-        flatten = True if action == 'Download' else False
-        records: pd.DataFrame = get_filtered(app.session, sql, flatten=flatten)
-
-        # no matching records
-        if not len(records):
-            return render_template('query.html', records=None, sql=sql, show_extras='', filters=filters)
-
+        try:
+            # checks the filter before anything is run
+            get_filter_statement(app.session, sql)
+        except FilterError as e:
+            return render_template('query.html', columns=None, sql=sql, show_extras='', filters=filters, error=e)
         if action == 'Download':
-            # save the records & return file
+            # get the flattened records, save them & return file
+            records: pd.DataFrame = get_filtered_cached(app.session, sql, flatten=True)
+            metrics.QUERY_ROWS.observe(len(records), 'download')
+            if not len(records):
+                return render_template('query.html', columns=None, sql=sql, show_extras='', filters=filters)
             data_dump_filename = current_app.config['DOWNLOAD_FOLDER'] / f'query_{get_timestamp()}.csv'
             records.to_csv(data_dump_filename)
+            metrics.EXPORT_BYTES.inc('query_csv', amount=os.path.getsize(data_dump_filename))
             return send_file(data_dump_filename, as_attachment=True)
 
-        # otherwise, we're showing records on webpage
-        records['study.id'] = records['study.id'].apply(lambda x: f'<a href="/study/{x}">{x}</a>')
-        # remove extra measurement data if requested
-        if not request.form.get('extras'):
-            records.drop('measurement.data', axis=1, inplace=True)
-            show_extras = ''
-        else:
-            show_extras = 'checked'
+        # otherwise, we're showing records on webpage: the page only has the table headers, DataTables fetches the
+        # records a page at a time from /query/data
+        show_extras = 'checked' if request.form.get('extras') else ''
+        columns = get_core_headers() + (['measurement.data'] if show_extras else [])
+        return render_template('query.html', columns=columns, sql=sql, show_extras=show_extras, filters=filters)
+    return render_template('query.html', columns=None, sql='', show_extras='', filters=filters)
+
+
+def query_data():
+    """Serves one page of query results as JSON for DataTables' server-side processing mode"""
+    columns = get_core_headers()
+    order_column = request.form.get('order[0][column]', type=int)
+    order_by = columns[order_column] if order_column is not None and 0 <= order_column < len(columns) else None
+    length = request.form.get('length', DEFAULT_PAGE_SIZE, type=int)
+    try:
+        total, records = get_filtered_page_cached(
+            app.session,
+            request.form.get('sql', ''),
+            offset=max(request.form.get('start', 0, type=int), 0),
+            limit=length if 0 < length <= MAX_PAGE_SIZE else DEFAULT_PAGE_SIZE,
+            order_by=order_by,
+            descending=request.form.get('order[0][dir]') == 'desc'
+        )
+    except FilterError as e:
+        return jsonify(draw=request.form.get('draw', type=int), error=f'Invalid filter: {e}')
+    except SQLAlchemyError as e:
+        return jsonify(draw=request.form.get('draw', type=int), error=f'Query failed: {getattr(e, "orig", e)}')
+    metrics.QUERY_ROWS.observe(total, 'page')
+    if not request.form.get('extras'):
+        records = records.drop('measurement.data', axis=1)
+    return jsonify(
+        draw=request.form.get('draw', type=int),
+        recordsTotal=total,
+        recordsFiltered=total,
+        data=[[json_value(value) for value in row] for row in records.itertuples(index=False, name=None)]
+    )
 
-        return render_template('query.html', records=records, sql=sql, show_extras=show_extras, filters=filters)
-    return render_template('query.html', records=None, sql='', show_extras='', filters=filters)
+
+def aggregate_data():
+    """Statistics of the filtered records grouped by the group_by columns, as JSON or (with format=csv) CSV. The
+    parameters can be repeated or comma separated, e.g. ?group_by=[group].protein_treatment,measurement.measurement"""
+    def get_list(name):
+        return [item.strip() for value in request.values.getlist(name) for item in value.split(',') if item.strip()]
+
+    try:
+        summary = aggregate(app.session, request.values.get('sql', ''), get_list('group_by'),
+                            statistics=get_list('stat'), value=request.values.get('value', DEFAULT_VALUE))
+    except FilterError as e:
+        return jsonify(error=f'Invalid aggregation: {e}'), 400
+    metrics.QUERY_ROWS.observe(len(summary), 'aggregate')
+    if request.values.get('format') == 'csv':
+        return Response(summary.to_csv(index=False), mimetype='text/csv')
+    return jsonify(
+        columns=list(summary.columns),
+        data=[[json_value(value) for value in row] for row in summary.itertuples(index=False, name=None)]
+    )
+
+
+def api_query():
+    """Streams the records matching a filter as newline-delimited JSON, for scripts. Takes a JSON object:
+    {"filter": "...", "columns": ["study.title", "measurement.value", ...], "limit": 1000, "extras": false}, all
+    optional; columns default to all core columns, and extras adds each record's extra data as measurement.data."""
+    options = request.get_json(silent=True)
+    if not isinstance(options, dict):
+        return jsonify(error='Expected a JSON object'), 400
+    columns, limit = options.get('columns'), options.get('limit')
+    if columns is not None and not (isinstance(columns, list) and all(isinstance(c, str) for c in columns)):
+        return jsonify(error='columns must be a list of column names'), 400
+    if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int)):
+        return jsonify(error='limit must be an integer'), 400
+    try:
+        lines = stream_json_lines(app.session, options.get('filter') or '', columns=columns, limit=limit,
+                                  extras=bool(options.get('extras')))
+    except FilterError as e:
+        return jsonify(error=f'Invalid query: {e}'), 400
+    return Response(stream_with_context(count_bytes(lines, 'api_query')), mimetype='application/x-ndjson')
+
+
+def json_value(value):
+    """Converts a DataFrame cell to something the JSON encoder writes as the page shows it"""
+    if isinstance(value, dict):
+        return str(value) if value else None
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, numbers.Number):
+        return value.item() if hasattr(value, 'item') else value
+    return value
 
 
 def upload():
-    uploaded = None
     error = None
     if request.method == 'POST':
         # check if the post request has the file part
@@ -105,20 +206,22 @@ def upload():
             filename = f'{timestamp}_{secure_filename(file.filename)}'
             # upload
             file.save(app.config['UPLOAD_FOLDER'] / filename)
-            # ingest
-            study = read_file(app.config['UPLOAD_FOLDER'] / filename)
-            study.added_by = auth.current_user()
-            with RWSession() as session:
-                session.add(study)
-                session.commit()
-                study_id = study.id
-            uploaded = {
-                "filename": filename,
-                "study_id": study_id
-            }
+            # ingest in the background - the status page follows the job
+            job_id = jobs.submit_upload(app.config['UPLOAD_FOLDER'] / filename, auth.current_user())
+            return redirect(f'/upload/{job_id}')
         else:
             error = f"The file {file.filename} is the wrong type of file, please use the Excel file NGC template (.xlsx)"
-    return render_template('upload.html', uploaded=uploaded, error=error)
+    return render_template('upload.html', error=error)
+
+
+def upload_status(job_id):
+    job = jobs.get_job(job_id)
+    if job is None or job['added_by'] != auth.current_user():
+        abort(404)
+    job['filename'] = Path(job['filename']).name
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job)
+    return render_template('upload_status.html', job=job, finished=job['state'] in (jobs.DONE, jobs.FAILED))
 
 
 def download_template():
@@ -129,16 +232,60 @@ def download_template():
 
 
 def dump_database():
-    data_dump_filename = current_app.config['DOWNLOAD_FOLDER'] / f'db_dump_{get_timestamp()}.csv'
-    records = get_denormalised(app.session)
-    records.to_csv(data_dump_filename)
-    return send_file(data_dump_filename, as_attachment=True)
+    file_format = request.args.get('format', 'csv')
+    if file_format in FORMATS:
+        # columnar files end with a footer, so they are written out in row groups and then sent, rather than streamed
+        data_dump_filename = current_app.config['DOWNLOAD_FOLDER'] / f'db_dump_{get_timestamp()}.{FORMATS[file_format]}'
+        try:
+            write_columnar(app.session, data_dump_filename, file_format)
+        except RuntimeError as e:
+            abort(501, str(e))
+        metrics.EXPORT_BYTES.inc(f'db_{file_format}', amount=os.path.getsize(data_dump_filename))
+        return send_file(data_dump_filename, as_attachment=True)
+    # stream the csv in chunks as rows come off the cursor, rather than building the whole dump in memory
+    return Response(
+        stream_with_context(count_bytes(stream_csv(app.session), 'db_csv')),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=db_dump_{get_timestamp()}.csv'}
+    )
+
+
+def count_bytes(chunks, kind):
+    """Passes the streamed chunks through, counting the bytes sent"""
+    for chunk in chunks:
+        metrics.EXPORT_BYTES.inc(kind, amount=len(chunk.encode() if isinstance(chunk, str) else chunk))
+        yield chunk
 
 
 def allowed_file(filename):
     return filename.split('.')[-1] in ALLOWED_EXTENSIONS
 
 
+def cache_counts(name):
+    return {('config',): json_files.stats()[name], ('results',): results.stats()[name]}
+
+
+def cache_stats():
+    return jsonify({'config': json_files.stats(), 'results': results.stats()})
+
+
+def serve_metrics():
+    return Response(metrics.registry.exposition(), mimetype=metrics.CONTENT_TYPE)
+
+
+def start_timer():
+    request.start_time = time.perf_counter()
+
+
+def record_request(response):
+    # routes by their rule, e.g. /study/<int:study_id>, so there is one series per route rather than per URL
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.REQUESTS.inc(route, request.method, response.status_code)
+    if hasattr(request, 'start_time'):
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - request.start_time, route)
+    return response
+
+
 def logout():
     if 'done' in request.args:
         return render_template('logout.html')
@@ -164,15 +311,39 @@ app.add_url_rule("/studies", view_func=auth.login_required(show_studies))
 app.add_url_rule("/study/<int:study_id>", view_func=auth.login_required(show_study))
 app.add_url_rule("/study/<int:study_id>/download", view_func=auth.login_required(study_download))
 app.add_url_rule("/upload", view_func=auth.login_required(upload), methods=['POST', 'GET'])
+app.add_url_rule("/upload/<job_id>", view_func=auth.login_required(upload_status))
 app.add_url_rule("/download-template", view_func=auth.login_required(download_template))
 app.add_url_rule("/download-db", view_func=auth.login_required(dump_database))
 app.add_url_rule("/query", view_func=auth.login_required(query), methods=['GET', 'POST'])
+app.add_url_rule("/query/data", view_func=auth.login_required(query_data), methods=['POST'])
+app.add_url_rule("/aggregate", view_func=auth.login_required(aggregate_data), methods=['GET', 'POST'])
+app.add_url_rule("/api/query", view_func=auth.login_required(api_query), methods=['POST'])
+app.add_url_rule("/cache-stats", view_func=auth.login_required(cache_stats))
+# Prometheus can't do digest authentication, so /metrics is open: it holds counts and timings, not data
+app.add_url_rule("/metrics", view_func=serve_metrics)
 app.add_url_rule("/logout", view_func=logout)
+app.before_request(start_timer)
+app.after_request(record_request)
+
+metrics.time_connections(RWSession.kw['bind'], 'rw')
+metrics.time_connections(ROSession.kw['bind'], 'ro')
+metrics.registry.gauge('cm3d_cache_hits_total', 'Cache hits by cache', lambda: cache_counts('hits'), ['cache'],
+                       kind='counter')
+metrics.registry.gauge('cm3d_cache_misses_total', 'Cache misses by cache', lambda: cache_counts('misses'), ['cache'],
+                       kind='counter')
+metrics.registry.gauge('cm3d_result_cache_bytes', 'Memory held by cached query results',
+                       lambda: results.stats()['bytes'])
+metrics.registry.gauge('cm3d_waitress_queue_depth', 'Requests waiting for a waitress thread',
+                       lambda: len(app.server.task_dispatcher.queue))
+metrics.registry.gauge('cm3d_waitress_threads', 'Waitress worker threads',
+                       lambda: len(app.server.task_dispatcher.threads))
+metrics.registry.gauge('cm3d_reclaimed_bytes_total', 'Bytes the retention sweeper has deleted',
+                       lambda: app.sweeper.totals()['bytes'], kind='counter')
 
 
 @auth.get_password
 def get_pw(username):
-    users = json.load(open(current_app.config['WORKING_DIRECTORY'] / USERS_FILENAME, 'r'))
+    users = json_files.load(current_app.config['WORKING_DIRECTORY'] / USERS_FILENAME)
     if username in users:
         return users.get(username)
     return None
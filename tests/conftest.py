@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from cm3d.model import Base, Biological_replica, Group, Measurement, Study
+
+
+def new_study(title, measurements=3):
+    study = Study(title=title, authors="S Laranjeira", uploaded_file=b'not really an xlsx file')
+    group = Group(study=study, model="Singel cell", protein_treatment='abc')
+    biological_replica = Biological_replica(group=group, cell_name="MDDA/MB/231")
+    for m in range(measurements):
+        measurement = Measurement(biological_replica=biological_replica, test_type='Proliferation assay',
+                                  measurement='Cell number', value=1000 + m, unit='dimensionless')
+        measurement['xyz'] = str(m)
+    # a group without any biological replicas still appears in the (outer) join
+    Group(study=study, model="Compartmental model")
+    return study
+
+
+@contextmanager
+def counted_queries(engine):
+    """Counts the SQL statements sent to the engine"""
+    statements = list()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.fixture
+def make_study():
+    """Builds a study with one replica of `measurements` measurements and an empty group"""
+    return new_study
+
+
+@pytest.fixture
+def count_queries():
+    """Context manager yielding the list of SQL statements sent to an engine"""
+    return counted_queries
+
+
+@pytest.fixture(scope='module')
+def engine():
+    """An in-memory database per test module, holding a first (3 measurements) and second (4) study"""
+    engine = create_engine('sqlite://', future=True, echo=False)
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine).begin() as session:
+        session.add(new_study("First study", measurements=3))
+        session.add(new_study("Second study", measurements=4))
+    yield engine
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture(scope='module')
+def Session(engine):
+    return sessionmaker(bind=engine)
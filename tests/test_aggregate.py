@@ -0,0 +1,55 @@
+import statistics
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cm3d.aggregate import aggregate
+from cm3d.database import get_filtered
+from cm3d.filters import FilterError
+from cm3d.model import Base
+
+
+def test_aggregate(engine, Session, count_queries):
+    with Session() as session:
+        # CHECK the statistics match pandas' over the downloaded records, one query without percentiles
+        with count_queries(engine) as statements:
+            summary = aggregate(session, "measurement.value > 1000", ['study.title', 'measurement.measurement'])
+        assert len(statements) == 1
+        records = get_filtered(session, "measurement.value > 1000")
+        expected = records.groupby(['study.title', 'measurement.measurement'])['measurement.value']\
+            .agg(['count', 'mean', 'std', 'min', 'max']).reset_index()
+        assert list(summary.columns) == list(expected.columns)
+        assert summary.round(9).values.tolist() == expected.round(9).values.tolist()
+
+        # CHECK percentiles, grouping by extras, and no group_by at all
+        summary = aggregate(session, '', ['measurement.data_xyz'], ['count', 'median', 'p75'])
+        assert summary.values.tolist() == [['0', 2, 1000.0, 1000.0], ['1', 2, 1001.0, 1001.0],
+                                           ['2', 2, 1002.0, 1002.0], ['3', 1, 1003.0, 1003.0]]
+        assert aggregate(session, "study.title = 'Second study'", [], ['sum', 'p50']).values.tolist() == \
+               [[4006.0, 1001.5]]
+        assert aggregate(session, "study.id < 0", [], ['count']).empty
+
+        for group_by, statistics, value in [(['study.nonsense'], None, 'measurement.value'),
+                                            (['measurement.data_nonsense'], None, 'measurement.value'),
+                                            ([], ['mode'], 'measurement.value'),
+                                            ([], None, 'measurement.unit')]:
+            with pytest.raises(FilterError):
+                aggregate(session, '', group_by, statistics, value)
+
+
+def test_std_large_mean(make_study):
+    large = create_engine('sqlite://', future=True)
+    Base.metadata.create_all(large)
+    with sessionmaker(bind=large).begin() as session:
+        study = make_study("Large values", measurements=4)
+        for m, measurement in enumerate(study.groups[0].biological_replicas[0].measurements):
+            measurement.value = 1e9 + m
+        session.add(study)
+    with sessionmaker(bind=large)() as session:
+        summary = aggregate(session, '', [], ['mean', 'std'])
+
+    # CHECK a small spread around a large mean keeps its precision (the sum of squares minus the squared sum doesn't)
+    assert summary['mean'][0] == pytest.approx(1e9 + 1.5)
+    assert summary['std'][0] == pytest.approx(statistics.stdev([0, 1, 2, 3]), rel=1e-6)
+    large.dispose()
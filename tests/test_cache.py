@@ -0,0 +1,103 @@
+from cm3d.cache import (ResultCache, get_filtered_cached,
+                        filter_key, get_filtered_page_cached)
+from cm3d.database import get_filtered_page
+from cm3d.model import Study
+
+
+def test_filter_key():
+    # CHECK spelling differences outside quotes don't matter, the quoted values do
+    assert filter_key("study.title = 'First study'  AND measurement.value>=1") == \
+           filter_key("STUDY.TITLE='First study' and\n measurement.value >= 1")
+    assert filter_key("study.title = 'First study'") != filter_key("study.title = 'first study'")
+    # CHECK extras keys are case-sensitive, so they don't share an entry either
+    assert filter_key("measurement.data_Viability > 1") != filter_key("measurement.data_viability > 1")
+
+
+def test_extras_keys_differing_in_case(Session, make_study):
+    with Session.begin() as session:
+        study = make_study("Case study", measurements=2)
+        session.add(study)
+        session.flush()
+        first, second = study.groups[0].biological_replicas[0].measurements
+        first['Viability'], second['viability'] = '2', '2'
+        ids = first.id, second.id
+    cache = ResultCache()
+    with Session() as session:
+        upper = get_filtered_cached(session, "measurement.data_Viability > 1", cache=cache)
+        lower = get_filtered_cached(session, "measurement.data_viability > 1", cache=cache)
+
+    # CHECK each filter got its own records, not the other's cached ones
+    assert list(upper['measurement.id']) == [ids[0]]
+    assert list(lower['measurement.id']) == [ids[1]]
+
+    with Session.begin() as session:
+        session.delete(session.query(Study).filter(Study.title == "Case study").one())
+
+
+def test_pages_from_cache(engine, Session, count_queries):
+    cache = ResultCache()
+    sql_where = "measurement.unit = 'dimensionless'"
+    for order_by, descending in [(None, False), ('measurement.value', True), ('study.title', False)]:
+        with Session() as session:
+            expected = [get_filtered_page(session, sql_where, offset=offset, limit=3, order_by=order_by,
+                                          descending=descending) for offset in (0, 3, 6)]
+            # CHECK cached pages match the pages the database returns
+            for offset, (total, page) in zip((0, 3, 6), expected):
+                cached_total, cached_page = get_filtered_page_cached(session, sql_where, offset=offset, limit=3,
+                                                                     order_by=order_by, descending=descending,
+                                                                     cache=cache)
+                assert cached_total == total
+                assert list(cached_page['measurement.id']) == list(page['measurement.id'])
+
+    # CHECK after the first page only the generation is read for each page
+    with Session() as session, count_queries(engine) as statements:
+        get_filtered_page_cached(session, sql_where, offset=3, limit=3, cache=cache)
+    assert len(statements) == 1
+    assert cache.stats()['misses'] == 1 and cache.stats()['entries'] == 1
+
+
+def test_invalidated_by_new_study(Session, make_study):
+    cache = ResultCache()
+    sql_where = "study.title like '%study'"
+    with Session() as session:
+        before = get_filtered_cached(session, sql_where, cache=cache)
+        assert get_filtered_cached(session, sql_where, cache=cache) is before
+
+    with Session.begin() as session:
+        session.add(make_study("Third study", measurements=1))
+
+    # CHECK adding a study makes the cached result stale
+    with Session() as session:
+        after = get_filtered_cached(session, sql_where, cache=cache)
+    assert len(after) == len(before) + 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    with Session.begin() as session:
+        session.delete(session.query(Study).filter(Study.title == "Third study").one())
+
+
+def test_memory_budget(Session):
+    with Session() as session:
+        size = ResultCache().put('probe', get_filtered_cached(session, "study.id = 1", cache=ResultCache())).size
+        cache = ResultCache(max_bytes=size * 3 // 2)
+        get_filtered_cached(session, "study.id = 1", cache=cache)
+        get_filtered_cached(session, "study.id = 2", cache=cache)
+
+    # CHECK the least recently used result was evicted to stay within the budget
+    assert cache.stats()['entries'] == 1 and cache.evictions == 1
+    assert cache.stats()['bytes'] <= cache.max_bytes
+
+
+def test_large_results_paged_by_database(monkeypatch, engine, Session, count_queries):
+    monkeypatch.setattr('cm3d.cache.MAX_CACHED_RECORDS', 3)
+    cache = ResultCache()
+    sql_where = "measurement.unit = 'dimensionless'"
+    with Session() as session:
+        total, page = get_filtered_page(session, sql_where, offset=2, limit=2)
+        with count_queries(engine) as statements:
+            cached_total, cached_page = get_filtered_page_cached(session, sql_where, offset=2, limit=2, cache=cache)
+
+    # CHECK a result over the threshold isn't fetched whole: the page comes from a LIMIT query and nothing is cached
+    assert (cached_total, list(cached_page['measurement.id'])) == (total, list(page['measurement.id']))
+    assert any('LIMIT' in statement for statement in statements)
+    assert cache.stats()['entries'] == 0
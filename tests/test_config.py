@@ -0,0 +1,25 @@
+import json
+import os
+
+from cm3d.config import JsonFileCache
+
+
+def test_json_file_cache(tmp_path):
+    cache = JsonFileCache()
+    filename = tmp_path / 'users.json'
+    filename.write_text(json.dumps({'a': 'ha1'}))
+
+    # CHECK the file is parsed once and then served from the cache
+    assert cache.load(filename) == {'a': 'ha1'}
+    assert cache.load(filename) == {'a': 'ha1'}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # CHECK a change to the file is picked up, even within the same mtime tick, from its new size
+    stat = os.stat(filename)
+    filename.write_text(json.dumps({'a': 'ha1', 'b': 'ha2'}))
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.load(filename) == {'a': 'ha1', 'b': 'ha2'}
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'files': 1}
+
+    # CHECK a missing file gives the default
+    assert cache.load(tmp_path / 'filters.json', default={}) == {}
@@ -0,0 +1,159 @@
+import csv
+import io
+import json
+
+import jinja2
+import pytest
+from sqlalchemy import func, select
+
+from cm3d.database import (get_core_headers, get_denormalised, get_filtered,
+                           get_filtered_page, get_study, get_study_file,
+                           get_study_list, iter_blob, iter_blob_substr,
+                           stream_csv, stream_json_lines)
+from cm3d.filters import FilterError
+from cm3d.model import Study, StudyFile
+
+
+def test_stream_csv(Session):
+    with Session() as session:
+        chunks = list(stream_csv(session, chunk_size=2))
+
+    # CHECK rows are written out in several chunks
+    assert len(chunks) > 1
+
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+
+    # CHECK one row per measurement plus one per empty group
+    assert len(rows) == 3 + 4 + 2
+
+    # CHECK core columns are present, the blob and where it's stored are not, and extras are flattened
+    assert list(rows[0].keys()) == get_core_headers() + ['measurement.data_xyz']
+    assert 'study.uploaded_file' not in rows[0] and 'study.file_sha256' not in rows[0]
+    assert sorted(r['measurement.data_xyz'] for r in rows if r['study.title'] == 'First study') == ['', '0', '1', '2']
+
+
+def test_stream_json_lines(Session):
+    with Session() as session:
+        chunks = list(stream_json_lines(session, "study.title = 'Second study'",
+                                        columns=['measurement.value', 'measurement.data_xyz'], chunk_size=2))
+        limited = ''.join(stream_json_lines(session, limit=2, extras=True))
+        # CHECK bad columns and filters fail before anything is streamed
+        with pytest.raises(FilterError, match="Invalid column 'study.uploaded_file'"):
+            stream_json_lines(session, columns=['study.uploaded_file'])
+        with pytest.raises(FilterError, match="Invalid column 'nope'"):
+            stream_json_lines(session, columns=['nope'])
+        with pytest.raises(FilterError):
+            stream_json_lines(session, 'measurement.data_nope = 1')
+
+    # CHECK one JSON object per line, streamed in chunks, with just the columns asked for in their order
+    assert len(chunks) > 1
+    records = [json.loads(line) for line in ''.join(chunks).splitlines()]
+    assert [list(record) for record in records] == [['measurement.value', 'measurement.data_xyz']] * 5
+    assert [record['measurement.data_xyz'] for record in records] == ['0', '1', '2', '3', None]
+
+    # CHECK all core columns by default, extras as an object, and the limit
+    records = [json.loads(line) for line in limited.splitlines()]
+    assert len(records) == 2
+    assert list(records[0]) == get_core_headers() + ['measurement.data']
+    assert records[0]['measurement.data'] == {'xyz': '0'}
+
+
+def test_get_filtered(Session):
+    with Session() as session:
+        records = get_filtered(session, "study.title = 'Second study' and measurement.value >= 1002")
+
+    # CHECK only matching measurements are returned, with their extras as a dict
+    assert len(records) == 2
+    assert list(records['measurement.data']) == [{'xyz': '2'}, {'xyz': '3'}]
+
+    # CHECK only scalar columns were selected
+    assert 'study.uploaded_file' not in records.columns
+
+
+def test_get_denormalised(Session):
+    with Session() as session:
+        records = get_denormalised(session)
+
+    # CHECK every row of the join is returned with extras flattened into columns
+    assert len(records) == 3 + 4 + 2
+    assert list(records.columns) == get_core_headers() + ['measurement.data_xyz']
+
+
+def test_extras_query_count(engine, Session, count_queries):
+    # the number of queries must not grow with the number of measurements (no per-measurement lazy loads)
+    for flatten in [False, True]:
+        with Session() as session, count_queries(engine) as statements:
+            records = get_filtered(session, "study.title = 'First study'", flatten=flatten)
+        assert len(records) == 3 + 1
+        assert len(statements) == 2
+
+        with Session() as session, count_queries(engine) as statements:
+            records = get_filtered(session, "study.title like '%study'", flatten=flatten)
+        assert len(records) == 3 + 4 + 2
+        assert len(statements) == 2
+
+
+def render(template, **context):
+    """Renders one of the web app's templates, counting on it to touch everything the page shows"""
+    environment = jinja2.Environment(loader=jinja2.PackageLoader('cm3d'))
+    environment.globals['url_for'] = lambda endpoint, **values: f'/{endpoint}'
+    return environment.get_template(template).render(**context)
+
+
+def test_study_pages_query_count(engine, Session, count_queries):
+    # the pages must take the same number of queries however many studies / measurements there are
+    with Session() as session, count_queries(engine) as statements:
+        page = render('studies.html', studies=get_study_list(session))
+    assert len(statements) == 1
+    assert 'First study</a>' in page
+
+    for title, measurements in [('First study', 3), ('Second study', 4)]:
+        study_id = select(Study.id).where(Study.title == title)
+        with Session() as session, count_queries(engine) as statements:
+            page = render('study.html', study=get_study(session, session.execute(study_id).scalar()))
+        # the study id, then the study and one query per level: groups, replicas, measurements, extra data
+        assert len(statements) == 1 + 5
+        assert page.count('Value: ') == measurements
+        assert f'xyz={measurements - 1}' in page
+
+    with Session() as session:
+        assert get_study(session, -1) is None
+
+
+def test_iter_blob(Session):
+    with Session() as session:
+        study_file = get_study_file(session, session.execute(select(func.min(Study.id))).scalar())
+        content = session.execute(select(StudyFile.content).where(StudyFile.sha256 == study_file.sha256)).scalar()
+        assert study_file.size == len(content)
+        # CHECK both ways of reading the file give it back whole, in chunks
+        for chunks in [list(iter_blob(session, study_file.rowid, chunk_size=5)),
+                       list(iter_blob_substr(session, study_file.rowid, chunk_size=5))]:
+            assert len(chunks) == -(-len(content) // 5)
+            assert b''.join(chunks) == content
+        assert get_study_file(session, -1) is None
+
+
+def test_uploaded_file_stored_once(Session):
+    with Session() as session:
+        # CHECK both studies share the one stored copy of their identical spreadsheet
+        assert session.execute(select(func.count()).select_from(StudyFile)).scalar() == 1
+        assert [study.uploaded_file for study in session.query(Study)] == [b'not really an xlsx file'] * 2
+
+
+def test_get_filtered_page(engine, Session, count_queries):
+    sql_where = "measurement.unit = 'dimensionless'"
+    with Session() as session, count_queries(engine) as statements:
+        total, first_page = get_filtered_page(session, sql_where, offset=0, limit=4)
+        _, second_page = get_filtered_page(session, sql_where, offset=4, limit=4)
+
+    # CHECK total counts every match but only a page of records is returned
+    assert total == 7
+    assert len(first_page) == 4 and len(second_page) == 3
+    assert set(first_page['measurement.id']).isdisjoint(second_page['measurement.id'])
+
+    # CHECK one count, one page and one extras query per page
+    assert len(statements) == 6
+
+    with Session() as session:
+        _, page = get_filtered_page(session, sql_where, limit=2, order_by='measurement.value', descending=True)
+    assert list(page['measurement.value']) == [1003, 1002]
@@ -0,0 +1,59 @@
+import pytest
+from sqlalchemy import text
+
+from cm3d.database import get_core_headers
+
+pa = pytest.importorskip('pyarrow')
+
+from cm3d.export import get_schema, write_columnar  # noqa: E402
+
+
+def test_write_parquet(tmp_path, Session):
+    import pyarrow.parquet as pq
+    filename = tmp_path / 'export.parquet'
+    with Session() as session:
+        written = write_columnar(session, filename, 'parquet', chunk_size=4)
+
+    # CHECK every row of the join is written, in row groups of chunk_size rows
+    assert written == {'rows': 3 + 4 + 2, 'row_groups': 3}
+    assert pq.ParquetFile(filename).metadata.num_row_groups == 3
+
+    # CHECK numbers stay numbers and the extras are flattened into their own columns
+    table = pq.read_table(filename)
+    assert table.column_names == get_core_headers() + ['measurement.data_xyz']
+    assert table.schema.field('measurement.value').type == pa.float64()
+    assert table.schema.field('study.id').type == pa.int64()
+    assert table.schema.field('study.date_input').type == pa.date32()
+    records = table.to_pandas()
+    assert sorted(records['measurement.value'].dropna()) == [1000, 1000, 1001, 1001, 1002, 1002, 1003]
+
+
+@pytest.mark.parametrize('file_format', ['arrow', 'feather'])
+def test_write_arrow(tmp_path, file_format, Session):
+    import pyarrow.feather as feather
+    filename = tmp_path / f'export.{file_format}'
+    with Session() as session:
+        write_columnar(session, filename, file_format)
+
+    # CHECK the Arrow IPC file (compressed for feather) reads back with pandas
+    records = feather.read_feather(filename)
+    assert len(records) == 3 + 4 + 2
+    assert records['measurement.data_xyz'].dropna().tolist() == ['0', '1', '2', '0', '1', '2', '3']
+
+
+def test_get_schema(engine, Session, count_queries):
+    with Session.begin() as session:
+        session.execute(text("UPDATE biological_replica SET passage_number = 'about 5' WHERE id = 1"))
+    try:
+        with Session() as session, count_queries(engine) as statements:
+            schema = get_schema(session)
+        # CHECK a numeric column holding text is exported as strings, the others keep their types
+        assert schema.field('biological_replica.passage_number').type == pa.string()
+        assert schema.field('measurement.value').type == pa.float64()
+        assert schema.field('measurement.biological_replica_id').type == pa.int64()
+        # CHECK one scan per table with numeric columns besides ids (biological_replica and measurement), plus the
+        # extras keys, rather than one per numeric column
+        assert len(statements) == 2 + 1
+    finally:
+        with Session.begin() as session:
+            session.execute(text("UPDATE biological_replica SET passage_number = NULL WHERE id = 1"))
@@ -0,0 +1,84 @@
+import json
+from pathlib import Path
+
+import pytest
+from sqlalchemy import text
+
+from cm3d.database import get_filter_statement, get_filtered
+from cm3d.filters import (FilterError, Predicate, Reference, inner_joins,
+                          parse_filter)
+
+filters_json = Path(__file__).parent.parent / 'src/cm3d/resources/filters.json'
+
+
+def test_parse_filter():
+    # CHECK the saved filters all parse
+    for sql_where in json.loads(filters_json.read_text()).values():
+        parse_filter(sql_where)
+
+    value = Reference('measurement', 'value')
+    assert parse_filter("measurement.value between 500 and 6000") == Predicate(value, 'between', (500, 6000))
+    assert parse_filter('"measurement.data_x y" = \'a\'') == \
+           Predicate(Reference('measurement', None, 'x y'), '=', ('a',))
+    # CHECK not is pushed down to the predicates
+    assert parse_filter("not (measurement.value < 3 or [group].model is null)") == \
+           ('and', [Predicate(value, '>=', (3,)), Predicate(Reference('group', 'model'), 'null', negated=True)])
+    assert parse_filter("not measurement.value not in (1, -2.5)") == Predicate(value, 'in', (1, -2.5))
+    # CHECK table and column names ignore case, as in SQL, but extras keys don't
+    assert parse_filter("Measurement.Value > 1") == Predicate(value, '>', (1,))
+    assert parse_filter("STUDY.TITLE = 'x'") == Predicate(Reference('study', 'title'), '=', ('x',))
+    assert parse_filter("measurement.DATA_Viability = 'x'") == \
+           Predicate(Reference('measurement', None, 'Viability'), '=', ('x',))
+
+
+@pytest.mark.parametrize('sql_where', [
+    "study.id = 1; drop table study",
+    "study.id in (select study_id from \"group\")",
+    "sqlite_master.name = 'study'",
+    "study.nonsense = 1",
+    "value > 3",
+    "study.title = 'unterminated",
+    "study.id = 1 or",
+    "",
+])
+def test_invalid_filters(sql_where):
+    # CHECK anything but the filter language is refused before it gets near the database
+    with pytest.raises(FilterError):
+        parse_filter(sql_where)
+
+
+def test_filter_statement(Session):
+    with Session() as session:
+        # CHECK unknown extras keys are reported too
+        with pytest.raises(FilterError):
+            get_filter_statement(session, "measurement.data_nonsense = 1")
+        with pytest.raises(FilterError):
+            get_filter_statement(session, "study.date = 'yesterday'")
+
+        # CHECK joins down to the deepest table the filter needs a row in are inner joins
+        assert inner_joins(parse_filter("study.id = 1")) == 0
+        assert inner_joins(parse_filter("study.id = 1 and measurement.value > 3")) == 3
+        assert inner_joins(parse_filter("biological_replica.id = 1 or measurement.id is null")) == 0
+        sql = str(get_filter_statement(session, "[group].protein_treatment = 'abc' and measurement.value > 3"))
+        assert sql.count('LEFT OUTER JOIN') == 0 and sql.count('JOIN') == 3
+
+
+def test_same_records_as_sql(Session):
+    with Session() as session:
+        # CHECK the compiled filters match what SQLite makes of the same WHERE clause
+        for sql_where in ["study.title = 'Second study' and measurement.value >= 1002",
+                          "not (study.title like 'First%' or measurement.value between 1000 and 1001)",
+                          "[group].model = 'Compartmental model' or biological_replica.cell_name is not null",
+                          "measurement.id is null"]:
+            records = get_filtered(session, sql_where)
+            expected = session.execute(text(f'SELECT measurement.id, "group".id FROM study '
+                                            f'LEFT JOIN "group" ON "group".study_id = study.id '
+                                            f'LEFT JOIN biological_replica ON biological_replica.group_id = "group".id '
+                                            f'LEFT JOIN measurement ON measurement.biological_replica_id = '
+                                            f'biological_replica.id WHERE {sql_where}')).all()
+            assert len(records) == len(expected)
+
+        # CHECK extras compare as numbers with numbers
+        records = get_filtered(session, "measurement.data_xyz >= 2")
+        assert sorted(records['measurement.value']) == [1002, 1002, 1003]
+        assert len(get_filtered(session, "measurement.data_xyz is null")) == 2
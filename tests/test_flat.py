@@ -0,0 +1,114 @@
+from pathlib import Path
+
+import pandas as pd
+
+from cm3d.database import get_filtered, get_filtered_page
+from cm3d.flat import (get_filtered_flat, get_filtered_page_flat,
+                       is_flat_fresh, rebuild_flat)
+from cm3d.ingest import insert_study, parse_workbook, read_workbook
+
+test_input = Path(__file__).parent / 'resources/CM3d_input_template.xlsx'
+
+
+def same_records(left: pd.DataFrame, right: pd.DataFrame):
+    order = ['study.id', 'group.id', 'biological_replica.id', 'measurement.id']
+    left, right = [r.sort_values(order, na_position='first').reset_index(drop=True).astype(object) for r in (left, right)]
+    assert list(left.columns) == list(right.columns)
+    assert left.where(left.notna(), None).values.tolist() == right.where(right.notna(), None).values.tolist()
+
+
+def test_flat_matches_join(Session):
+    with Session() as session:
+        assert get_filtered_flat(session, "study.id > 0") is None
+        rebuild_flat(session.connection())
+        session.commit()
+        assert is_flat_fresh(session.connection())
+
+        # CHECK the flat table gives the same records as the join, with extras flattened or as dicts
+        for sql_where in ["study.title like '%study'", "measurement.value >= 1002", "\"group\".model = 'Singel cell'",
+                          "measurement.data_xyz >= 2 or measurement.id is null"]:
+            for flatten in [False, True]:
+                same_records(get_filtered_flat(session, sql_where, flatten=flatten),
+                             get_filtered(session, sql_where, flatten=flatten))
+
+        # CHECK pages come in the same order
+        for order_by, descending in [(None, False), ('measurement.value', True)]:
+            total, page = get_filtered_page(session, "study.id > 0", offset=2, limit=4, order_by=order_by,
+                                            descending=descending)
+            flat_total, flat_page = get_filtered_page_flat(session, "study.id > 0", offset=2, limit=4,
+                                                           order_by=order_by, descending=descending)
+            assert flat_total == total
+            assert list(flat_page['measurement.id'].fillna(0)) == list(page['measurement.id'].fillna(0))
+
+
+def test_append_on_ingest(Session, make_study):
+    records = parse_workbook(read_workbook(str(test_input)))
+    records['measurement_data'] = [{'measurement': 0, 'key': 'new key', 'datum': 'abc'}]
+    with Session() as session:
+        rebuild_flat(session.connection())
+        study_id = insert_study(session, records, b'workbook', 'tester')
+        session.commit()
+
+        # CHECK the new study (and its new extras key) was appended, so the flat table is still fresh
+        assert is_flat_fresh(session.connection())
+        sql_where = f'study.id = {study_id}'
+        flat = get_filtered_flat(session, sql_where, flatten=True)
+        assert flat['measurement.data_new key'].notna().sum() == 1
+        same_records(flat, get_filtered(session, sql_where, flatten=True))
+
+    # CHECK a study added any other way leaves the flat table stale, so queries go back to the join
+    with Session.begin() as session:
+        session.add(make_study("Third study", measurements=1))
+    with Session() as session:
+        assert not is_flat_fresh(session.connection())
+        assert get_filtered_flat(session, "study.id > 0") is None
+
+
+def test_extras_keys_differing_in_case(Session):
+    study_ids = list()
+    with Session() as session:
+        rebuild_flat(session.connection())
+        for key in ['Viability', 'viability']:
+            records = parse_workbook(read_workbook(str(test_input)))
+            records['measurement_data'] = [{'measurement': 0, 'key': key, 'datum': key}]
+            study_ids.append(insert_study(session, records, key.encode(), 'tester'))
+            session.commit()
+
+        # CHECK both keys got their own column (SQLite column names ignore case), so the ingest succeeded
+        assert is_flat_fresh(session.connection())
+        sql_where = f'study.id in ({study_ids[0]}, {study_ids[1]})'
+        for flatten in [False, True]:
+            same_records(get_filtered_flat(session, sql_where, flatten=flatten),
+                         get_filtered(session, sql_where, flatten=flatten))
+        flat = get_filtered_flat(session, "measurement.data_viability = 'viability'", flatten=True)
+        assert list(flat['study.id']) == [study_ids[1]]
+
+        # CHECK rebuilding with both keys stored works too
+        rebuild_flat(session.connection())
+        session.commit()
+        for flatten in [False, True]:
+            same_records(get_filtered_flat(session, sql_where, flatten=flatten),
+                         get_filtered(session, sql_where, flatten=flatten))
+
+
+def test_more_extras_keys_than_joins(Session):
+    # SQLite joins at most 64 tables, so the extras can't take a join each
+    keys = [f'key {k}' for k in range(70)]
+    with Session() as session:
+        rebuild_flat(session.connection())
+        records = parse_workbook(read_workbook(str(test_input)))
+        records['measurement_data'] = [{'measurement': 0, 'key': key, 'datum': str(k)} for k, key in enumerate(keys)]
+        study_id = insert_study(session, records, b'many keys', 'tester')
+        session.commit()
+
+        # CHECK appending the study, and rebuilding with all its keys, give the same records as the join
+        assert is_flat_fresh(session.connection())
+        sql_where = f'study.id = {study_id}'
+        flat = get_filtered_flat(session, sql_where, flatten=True)
+        assert flat['measurement.data_key 69'].notna().sum() == 1
+        same_records(flat, get_filtered(session, sql_where, flatten=True))
+        rebuild_flat(session.connection())
+        session.commit()
+        for flatten in [False, True]:
+            same_records(get_filtered_flat(session, sql_where, flatten=flatten),
+                         get_filtered(session, sql_where, flatten=flatten))
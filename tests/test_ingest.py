@@ -1,15 +1,17 @@
+import importlib.util
 from pathlib import Path
 
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, event, func, select
 from sqlalchemy.orm import sessionmaker
 
-from cm3d.ingest import read_file
-from cm3d.model import Base, Study
+from cm3d.ingest import (ingest_file, ingest_files, parse_workbook, read_file,
+                         read_study_file, read_workbook)
+from cm3d.model import Base, Measurement, MeasurementData, Study
 
 engine = create_engine('sqlite://', future=True, echo=False)
 Session = sessionmaker(bind=engine)
 
-test_input = Path(__file__).parent / 'resources/CM3D_input_template.xlsx'
+test_input = Path(__file__).parent / 'resources/CM3d_input_template.xlsx'
 
 
 def test_read_excel(filename=test_input):
@@ -37,3 +39,97 @@ def test_read_excel(filename=test_input):
 
         # CHECK no study with this name
         assert(len(result) == 0)
+
+
+def test_ingest_file(filename=test_input):
+    with Session() as session:
+        Base.metadata.create_all(session.get_bind())
+
+    with Session.begin() as session:
+        study_id, stats = ingest_file(session, str(filename), 'tester')
+    assert stats['seconds'] > 0
+
+    with Session() as session:
+        study = session.get(Study, study_id)
+
+        # CHECK the bulk inserted study matches the one built from ORM objects
+        expected = read_file(str(filename))
+        assert (study.title, study.authors, study.added_by) == (expected.title, expected.authors, 'tester')
+        assert [g.model for g in study.groups] == [g.model for g in expected.groups]
+        assert [[len(r.measurements) for r in g.biological_replicas] for g in study.groups] == \
+               [[len(r.measurements) for r in g.biological_replicas] for g in expected.groups]
+        assert study.uploaded_file == expected.uploaded_file
+
+        # CHECK the test type comes from the worksheet name
+        test_types = session.execute(select(Measurement.test_type).distinct()).scalars().all()
+        assert sorted(test_types) == ['Gean essay', 'Imono flurecence', 'Proliferation assay', 'Protein essay']
+        assert session.execute(select(func.count()).select_from(MeasurementData)).scalar() == 0
+
+
+def test_readers_agree(filename=test_input):
+    # CHECK the streaming readers parse the same study as the full pandas reader
+    expected = parse_workbook(read_workbook(str(filename), reader='pandas'))
+    for reader in ['openpyxl', 'calamine']:
+        if reader == 'calamine' and importlib.util.find_spec('python_calamine') is None:
+            continue
+        workbook = read_workbook(str(filename), reader=reader)
+        assert all(name in {'Study', 'Groups', 'Biological replicas'} or name.startswith('Test-') for name in workbook)
+        assert parse_workbook(workbook) == expected
+
+
+def test_ingest_files(tmp_path, filename=test_input):
+    # a file database, so the worker processes and the savepoints behave as they do in the real database
+    file_engine = create_engine(f'sqlite:///{tmp_path / "bulk.db"}', future=True)
+    Base.metadata.create_all(file_engine)
+    broken = tmp_path / 'broken.xlsx'
+    broken.write_bytes(b'not really an xlsx file')
+    filenames = [str(filename), str(broken), str(filename)]
+
+    with sessionmaker(bind=file_engine)() as session:
+        results = list(ingest_files(session, filenames, 'tester', workers=2, batch_size=1))
+
+    # CHECK every file is reported, the broken one as a failure that doesn't stop the others
+    assert sorted(r[0] for r in results) == sorted(filenames)
+    failures = [r for r in results if r[3] is not None]
+    assert [r[0] for r in failures] == [str(broken)]
+    assert all(r[1] is not None and len(r[2]['measurements']) == 10 for r in results if r[3] is None)
+
+    with sessionmaker(bind=file_engine)() as session:
+        # CHECK both good files were committed, sharing one stored spreadsheet
+        assert session.execute(select(func.count()).select_from(Study)).scalar() == 2
+        assert session.execute(select(func.count()).select_from(Measurement)).scalar() == 20
+    file_engine.dispose()
+
+
+def test_ingest_files_batches(tmp_path, filename=test_input):
+    file_engine = create_engine(f'sqlite:///{tmp_path / "batches.db"}', future=True)
+    statements = list()
+
+    @event.listens_for(file_engine, 'connect')
+    def trace(dbapi_connection, connection_record):
+        dbapi_connection.set_trace_callback(statements.append)
+
+    Base.metadata.create_all(file_engine)
+    statements.clear()
+
+    with sessionmaker(bind=file_engine)() as session:
+        in_transaction = list()
+        for _ in ingest_files(session, [str(filename)] * 5, 'tester', workers=1, batch_size=2):
+            in_transaction.append(session.connection().connection.dbapi_connection.in_transaction)
+
+    # CHECK releasing each study's savepoint doesn't commit it: studies are committed in batches of two
+    assert in_transaction == [True, False, True, False, True]
+    assert statements.count('COMMIT') == 3
+    with sessionmaker(bind=file_engine)() as session:
+        assert session.execute(select(func.count()).select_from(Study)).scalar() == 5
+    file_engine.dispose()
+
+
+def test_peak_memory_growth(monkeypatch):
+    # the process' peak before and after each parse: the first raises it, the second stays within it
+    peaks = iter([100 * 2 ** 20, 150 * 2 ** 20, 150 * 2 ** 20, 150 * 2 ** 20])
+    monkeypatch.setattr('cm3d.ingest.get_peak_memory', lambda: next(peaks))
+
+    # CHECK each parse reports how much it raised the peak, not the process' lifetime peak
+    assert read_study_file(str(test_input))[2]['peak_memory_growth'] == 50 * 2 ** 20
+    assert read_study_file(str(test_input))[2]['peak_memory_growth'] == 0
@@ -0,0 +1,61 @@
+import logging
+
+from flask import Flask, render_template_string
+from sqlalchemy import create_engine, text
+
+from cm3d import instrumentation
+
+
+def make_app(tmp_path, **options):
+    engine = create_engine('sqlite://', future=True)
+    app = Flask(__name__)
+
+    @app.route('/')
+    def index():
+        with engine.connect() as connection:
+            for _ in range(3):
+                connection.execute(text('SELECT 1'))
+        return render_template_string('{{ value }}', value='ok')
+
+    instrumentation.instrument(app, [engine], profile_dir=tmp_path, **options)
+    return app
+
+
+def test_server_timing(tmp_path, caplog):
+    app = make_app(tmp_path, slow_query_ms=10_000)
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        response = app.test_client().get('/')
+    # CHECK the time is split into phases, with the statements counted, and nothing was slow
+    timing = response.headers['Server-Timing']
+    assert 'sql;dur=' in timing and 'desc="3 statements"' in timing
+    assert 'render;dur=' in timing and 'app;dur=' in timing and 'total;dur=' in timing
+    assert not caplog.records
+    assert not list(tmp_path.iterdir())
+
+
+def test_slow_queries_and_profiles(tmp_path, caplog):
+    app = make_app(tmp_path, slow_query_ms=0, profile_ms=0)
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        app.test_client().get('/')
+    # CHECK every statement is logged as slow, with its plan, and the request's profile is saved
+    slow = [r.getMessage() for r in caplog.records if r.getMessage().startswith('Slow query')]
+    assert len(slow) == 3 and 'SELECT 1' in slow[0] and 'SCAN CONSTANT ROW' in slow[0]
+    assert len(list(tmp_path.glob('*_index_*.prof'))) == 1
+
+
+def test_one_profile_at_a_time(tmp_path):
+    app = make_app(tmp_path, profile_ms=0)
+
+    @app.route('/fail')
+    def fail():
+        raise RuntimeError('failed')
+
+    # CHECK a request arriving while another is profiled is served, just not profiled
+    with instrumentation._profile_lock:
+        assert app.test_client().get('/').status_code == 200
+    assert not list(tmp_path.glob('*.prof'))
+
+    # CHECK a request that fails still lets the next one be profiled
+    assert app.test_client().get('/fail').status_code == 500
+    app.test_client().get('/')
+    assert len(list(tmp_path.glob('*_index_*.prof'))) == 1
@@ -0,0 +1,99 @@
+import concurrent.futures
+import os
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from cm3d import jobs
+from cm3d.model import Base, Measurement, Study
+
+test_input = Path(__file__).parent / 'resources/CM3d_input_template.xlsx'
+
+
+def wait_for(job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get_job(job_id)
+        if job['state'] in (jobs.DONE, jobs.FAILED):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+def test_submit_upload(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "jobs.db"}', future=True)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    broken = tmp_path / 'broken.xlsx'
+    broken.write_bytes(b'not really an xlsx file')
+    uploaded = tmp_path / 'uploaded.xlsx'
+    shutil.copy(test_input, uploaded)
+
+    job_id = jobs.submit_upload(uploaded, 'tester', session_factory=Session)
+    failed_id = jobs.submit_upload(broken, 'tester', session_factory=Session)
+
+    # CHECK submitting returns straight away, before the file is parsed
+    assert jobs.get_job(job_id)['state'] in (jobs.PARSING, jobs.INSERTING, jobs.DONE)
+
+    job = wait_for(job_id)
+    assert job['state'] == jobs.DONE and job['stats']['reader']
+    with Session() as session:
+        study = session.get(Study, job['study_id'])
+        assert study.added_by == 'tester'
+        assert session.execute(select(func.count()).select_from(Measurement)).scalar() == 10
+    # CHECK the uploaded file goes once it's in the database, a broken one stays
+    assert not uploaded.exists()
+
+    # CHECK a spreadsheet that can't be read fails its own job only
+    failed = wait_for(failed_id)
+    assert failed['state'] == jobs.FAILED and failed['error']
+    assert broken.exists()
+    assert jobs.get_job('unknown') is None
+    engine.dispose()
+
+
+def test_shared_statuses(tmp_path):
+    jobs.share_statuses(tmp_path)
+    try:
+        jobs.set_job('abc123', state=jobs.DONE, added_by='tester', study_id=7)
+        # CHECK another process (without the job in memory) reads its status from the directory
+        del jobs._jobs['abc123']
+        assert jobs.get_job('abc123') == {'id': 'abc123', 'state': jobs.DONE, 'added_by': 'tester', 'study_id': 7}
+        assert jobs.get_job('../abc123') is None
+    finally:
+        jobs.share_statuses(None)
+
+
+def test_broken_parser_replaced(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "jobs.db"}', future=True)
+    Base.metadata.create_all(engine)
+    uploaded = tmp_path / 'uploaded.xlsx'
+    shutil.copy(test_input, uploaded)
+    # a worker dying breaks the pool
+    parser, _ = jobs.get_executors()
+    try:
+        parser.submit(os._exit, 1).result()
+    except concurrent.futures.process.BrokenProcessPool:
+        pass
+
+    # CHECK the next upload gets a new pool rather than failing
+    job = wait_for(jobs.submit_upload(uploaded, 'tester', session_factory=sessionmaker(bind=engine)))
+    assert job['state'] == jobs.DONE
+    assert jobs.get_executors()[0] is not parser
+    engine.dispose()
+
+
+def test_unfinished_jobs_kept(monkeypatch):
+    monkeypatch.setattr(jobs, '_jobs', OrderedDict())
+    monkeypatch.setattr(jobs, 'MAX_JOBS', 2)
+    jobs.set_job('running', state=jobs.PARSING)
+    jobs.set_job('first', state=jobs.DONE)
+    jobs.set_job('second', state=jobs.FAILED)
+    jobs.set_job('third', state=jobs.DONE)
+
+    # CHECK the oldest finished jobs are forgotten, even behind a job that is still running
+    assert list(jobs._jobs) == ['running', 'third']
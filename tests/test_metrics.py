@@ -0,0 +1,31 @@
+from cm3d.metrics import Registry
+
+
+def test_exposition():
+    registry = Registry()
+    requests = registry.counter('requests_total', 'Requests', ['route', 'status'])
+    seconds = registry.histogram('request_seconds', 'Latency', ['route'], buckets=(0.1, 1))
+    registry.gauge('queue_depth', 'Queue', lambda: 3)
+    registry.gauge('broken', 'Not available', lambda: missing.attribute)  # noqa: F821
+
+    requests.inc('/study/<int:study_id>', 200)
+    requests.inc('/study/<int:study_id>', 200, amount=2)
+    requests.inc('/say "hi"', 404)
+    for value in [0.05, 0.1, 0.5, 5]:
+        seconds.observe(value, '/')
+    with seconds.time('/timed'):
+        pass
+
+    lines = registry.exposition().splitlines()
+    # CHECK counters add up per label combination, with label values escaped
+    assert 'requests_total{route="/study/<int:study_id>",status="200"} 3' in lines
+    assert 'requests_total{route="/say \\"hi\\"",status="404"} 1' in lines
+    # CHECK histogram buckets are cumulative, "le" is inclusive and the last bucket is +Inf
+    assert 'request_seconds_bucket{route="/",le="0.1"} 2' in lines
+    assert 'request_seconds_bucket{route="/",le="1"} 3' in lines
+    assert 'request_seconds_bucket{route="/",le="+Inf"} 4' in lines
+    assert 'request_seconds_sum{route="/"} 5.65' in lines
+    assert 'request_seconds_count{route="/timed"} 1' in lines
+    # CHECK gauges are read when collected, and one that can't be read is left out
+    assert '# TYPE queue_depth gauge' in lines and 'queue_depth 3' in lines
+    assert not [line for line in lines if 'broken' in line]
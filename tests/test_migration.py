@@ -0,0 +1,51 @@
+from sqlalchemy import create_engine, func, inspect, select, text
+from sqlalchemy.orm import Session
+
+from cm3d.migration import migrate
+from cm3d.model import Base, Study, StudyFile
+
+
+def test_migrate_adds_indexes():
+    engine = create_engine('sqlite://', future=True, echo=False)
+    Base.metadata.create_all(engine)
+
+    # make an "old" database by dropping the declared indexes
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(text(f'DROP INDEX {index.name}'))
+
+    applied = migrate(engine)
+
+    # CHECK every declared index was created
+    expected = {index.name for table in Base.metadata.sorted_tables for index in table.indexes}
+    assert {change.split()[-1] for change in applied} == expected
+    assert {index['name'] for index in inspect(engine).get_indexes('measurement')} >= {
+        'ix_measurement_biological_replica_id', 'ix_measurement_test_type'}
+
+    # CHECK running again changes nothing
+    assert migrate(engine) == []
+
+
+def test_migrate_moves_uploaded_files(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "old.db"}', future=True, echo=False)
+
+    # the study table as it was when the uploaded file was kept in the study row
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE study (id INTEGER PRIMARY KEY, title VARCHAR, authors VARCHAR NOT NULL, '
+                                'date_input DATE, added_by VARCHAR, uploaded_file BLOB)'))
+        for study_id, content in [(1, b'first file'), (2, b'second file'), (3, b'first file'), (4, None)]:
+            connection.execute(text("INSERT INTO study (id, authors, uploaded_file) VALUES (:id, 'A', :content)"),
+                               {'id': study_id, 'content': content})
+
+    applied = migrate(engine)
+    assert 'moved 3 uploaded files to study_file' in applied
+
+    # CHECK the blob column has gone and identical files are stored once
+    assert 'uploaded_file' not in {column['name'] for column in inspect(engine).get_columns('study')}
+    with Session(engine) as session:
+        assert session.execute(select(func.count()).select_from(StudyFile)).scalar() == 2
+        assert session.get(Study, 1).uploaded_file == b'first file'
+        assert session.get(Study, 2).uploaded_file == b'second file'
+        assert session.get(Study, 3).file_sha256 == session.get(Study, 1).file_sha256
+        assert session.get(Study, 4).uploaded_file is None
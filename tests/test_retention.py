@@ -0,0 +1,78 @@
+import os
+import time
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from cm3d.model import Base, StudyFile
+from cm3d.retention import Sweeper, delete_orphaned_files, sweep
+
+HOUR = 3600
+
+
+def make_file(directory, name, size, hours_ago, now):
+    path = directory / name
+    path.write_bytes(b'x' * size)
+    os.utime(path, (now - hours_ago * HOUR, now - hours_ago * HOUR))
+    return path
+
+
+def test_sweep(tmp_path):
+    now = time.time()
+    old = make_file(tmp_path, 'old.csv', 100, 48, now)
+    large = make_file(tmp_path, 'large.csv', 2 ** 20, 2, now)
+    recent = make_file(tmp_path, 'recent.csv', 2 ** 20, 1, now)
+    in_use = make_file(tmp_path, 'in_use.csv', 2 ** 20, 0, now)
+
+    # CHECK nothing goes while everything is young and within the quota
+    assert sweep(tmp_path, max_age_hours=72, max_mb=10, now=now) == {'files': 0, 'bytes': 0}
+
+    # CHECK old files go first, then the least recently used over the quota, never one just used
+    assert sweep(tmp_path, max_age_hours=24, max_mb=2, now=now) == {'files': 2, 'bytes': 100 + 2 ** 20}
+    assert not old.exists() and not large.exists() and recent.exists()
+    assert sweep(tmp_path, max_age_hours=24, max_mb=0, now=now) == {'files': 1, 'bytes': 2 ** 20}
+    assert in_use.exists()
+
+
+def test_sweeper(tmp_path):
+    make_file(tmp_path, 'old.csv', 100, 48, time.time())
+    sweeper = Sweeper([tmp_path], interval=60, max_age_hours=24)
+    sweeper.start()
+    # CHECK the first sweep happens straight away, and stopping ends the thread
+    sweeper.stop()
+    sweeper.join(timeout=10)
+    assert not sweeper.is_alive()
+    assert sweeper.reclaimed == {'files': 1, 'bytes': 100}
+
+
+def test_sweeper_totals_file(tmp_path):
+    downloads = tmp_path / 'downloads'
+    downloads.mkdir()
+    make_file(downloads, 'old.csv', 100, 48, time.time())
+    totals_file = tmp_path / 'reclaimed.json'
+    # a copy made before the thread starts, as in a forked web server worker
+    worker = Sweeper([downloads], totals_file=totals_file)
+    assert worker.totals() == {'files': 0, 'bytes': 0}
+    sweeper = Sweeper([downloads], interval=60, totals_file=totals_file, max_age_hours=24)
+    sweeper.start()
+    sweeper.stop()
+    sweeper.join(timeout=10)
+
+    # CHECK processes that aren't running the sweeper report its totals
+    assert worker.totals() == {'files': 1, 'bytes': 100}
+
+
+def test_delete_orphaned_files(make_study):
+    engine = create_engine('sqlite://', future=True)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    with Session.begin() as session:
+        session.add(make_study('Kept'))
+        session.add(StudyFile(sha256='0' * 64, size=5, content=b'12345'))
+
+    with Session.begin() as session:
+        # CHECK only the spreadsheet no study refers to goes
+        assert delete_orphaned_files(session) == {'files': 1, 'bytes': 5}
+    with Session() as session:
+        assert session.execute(select(func.count()).select_from(StudyFile)).scalar() == 1
+        assert delete_orphaned_files(session) == {'files': 0, 'bytes': 0}
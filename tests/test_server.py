@@ -0,0 +1,39 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from cm3d.connection import guard_fork
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_guard_fork(tmp_path):
+    engine = guard_fork(create_engine(f'sqlite:///{tmp_path / "fork.db"}', future=True))
+    with engine.connect() as connection:
+        parent_connection = connection.connection.dbapi_connection
+        connection.execute(text('create table t (x integer)'))
+        connection.commit()
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child: the pooled connection is the parent's, so checking out replaces it
+        try:
+            with engine.connect() as connection:
+                replaced = connection.connection.dbapi_connection is not parent_connection
+                connection.execute(text('insert into t values (1)'))
+                connection.commit()
+            os.write(write, b'1' if replaced else b'0')
+        finally:
+            os._exit(0)
+    os.close(write)
+    # CHECK the child got its own connection
+    assert os.read(read, 1) == b'1'
+    os.waitpid(pid, 0)
+    os.close(read)
+
+    # CHECK the parent's connection still works, and sees the child's row
+    with engine.connect() as connection:
+        assert connection.connection.dbapi_connection is parent_connection
+        assert connection.execute(text('select count(*) from t')).scalar() == 1
+    engine.dispose()